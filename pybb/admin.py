@@ -1,10 +1,10 @@
 # -*- coding: utf-8
 from copy import deepcopy
 from django.utils.translation import gettext_lazy as _
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.urls import reverse
 
-from pybb import permissions
+from pybb import permissions, purge
 from pybb.models import Category, Forum, Topic, Post, Profile, Attachment, PollAnswer
 
 from pybb import compat, util
@@ -98,6 +98,7 @@ class ForumReadTrackerAdmin(admin.ModelAdmin):
 
 class PostAdmin(admin.ModelAdmin):
     list_display = ['topic', 'user', 'created', 'updated', 'summary']
+    actions = ['block_authors_and_delete_posts']
     list_per_page = 20
     raw_id_fields = ['user', 'topic']
     ordering = ['-created']
@@ -119,6 +120,17 @@ class PostAdmin(admin.ModelAdmin):
          ),
         )
 
+    def block_authors_and_delete_posts(self, request, queryset):
+        """ blocks the authors of the selected posts and deletes all their topics and posts """
+        users = list(compat.get_user_model().objects.filter(pk__in=queryset.values('user_id')))
+        for user in users:
+            if not permissions.perms.may_block_user(request.user, user):
+                continue
+            counts = purge.block_user(user, delete_posts=True)
+            self.message_user(request, _('%(user)s blocked, %(topics)d topics and %(posts)d posts deleted') % {
+                'user': user, 'topics': counts['topics'], 'posts': counts['posts']}, messages.SUCCESS)
+    block_authors_and_delete_posts.short_description = _('Block authors and delete all their posts')
+
 
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'time_zone', 'language', 'post_count']
@@ -27,14 +27,23 @@ def send_mass_html_mail(emails, *args, **kwargs):
     Sends emails with html alternative if email item has html content.
     Email item is a tuple with an optional html message version :
         (subject, text_msg, sender, recipient, [html_msg])
+    Without django-mailer, all emails are sent through one SMTP connection.
     """
-    for email in emails:
-        subject, text_msg, sender, recipient = email[0:4]
-        html_msg = email[4] if len(email) > 4 else ''
-        if html_msg:
-            send_html_mail(subject, text_msg, html_msg, sender, recipient, *args, **kwargs)
-        else:
-            send_mail(subject, text_msg, sender, recipient, *args, **kwargs)
+    connection = None
+    if not defaults.PYBB_USE_DJANGO_MAILER and not args and 'connection' not in kwargs:
+        connection = kwargs['connection'] = get_connection(fail_silently=kwargs.get('fail_silently', False))
+        connection.open()
+    try:
+        for email in emails:
+            subject, text_msg, sender, recipient = email[0:4]
+            html_msg = email[4] if len(email) > 4 else ''
+            if html_msg:
+                send_html_mail(subject, text_msg, html_msg, sender, recipient, *args, **kwargs)
+            else:
+                send_mail(subject, text_msg, sender, recipient, *args, **kwargs)
+    finally:
+        if connection is not None:
+            connection.close()
 
 def get_image_field_class():
     try:
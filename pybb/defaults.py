@@ -5,6 +5,9 @@ from django.core.exceptions import ImproperlyConfigured
 
 PYBB_TOPIC_PAGE_SIZE = getattr(settings, 'PYBB_TOPIC_PAGE_SIZE', 10)
 PYBB_FORUM_PAGE_SIZE = getattr(settings, 'PYBB_FORUM_PAGE_SIZE', 20)
+PYBB_KEYSET_PAGINATION = getattr(settings, 'PYBB_KEYSET_PAGINATION', False)
+PYBB_PAGINATION_COUNT_CACHE_TIMEOUT = getattr(settings, 'PYBB_PAGINATION_COUNT_CACHE_TIMEOUT', 60)
+PYBB_INDEX_CACHE_TIMEOUT = getattr(settings, 'PYBB_INDEX_CACHE_TIMEOUT', 300)
 PYBB_AVATAR_WIDTH = getattr(settings, 'PYBB_AVATAR_WIDTH', 80)
 PYBB_AVATAR_HEIGHT = getattr(settings, 'PYBB_AVATAR_HEIGHT', 80)
 PYBB_MAX_AVATAR_SIZE = getattr(settings, 'PYBB_MAX_AVATAR_SIZE', 1024 * 50)
@@ -42,6 +45,8 @@ PYBB_SMILES = getattr(settings, 'PYBB_SMILES', {
     ';)': 'wink.png'
 })
 
+PYBB_RENDER_VERSION = getattr(settings, 'PYBB_RENDER_VERSION', 1)
+
 PYBB_NICE_URL = getattr(settings, 'PYBB_NICE_URL', False)
 PYBB_NICE_URL_PERMANENT_REDIRECT = getattr(settings, 'PYBB_NICE_URL_PERMANENT_REDIRECT', True)
 PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT = getattr(settings, 'PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT', 100)
@@ -111,9 +116,21 @@ PYBB_DEFAULT_AUTOSUBSCRIBE = getattr(settings, 'PYBB_DEFAULT_AUTOSUBSCRIBE', Tru
 PYBB_ENABLE_ANONYMOUS_POST = getattr(settings, 'PYBB_ENABLE_ANONYMOUS_POST', False)
 PYBB_ANONYMOUS_USERNAME = getattr(settings, 'PYBB_ANONYMOUS_USERNAME', 'Anonymous')
 PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER = getattr(settings, 'PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER', 100)
+PYBB_TOPIC_VIEWS_CACHE_BUFFER = getattr(settings, 'PYBB_TOPIC_VIEWS_CACHE_BUFFER', PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER)
+PYBB_TOPIC_VIEWS_FLUSH_INTERVAL = getattr(settings, 'PYBB_TOPIC_VIEWS_FLUSH_INTERVAL', 60)
+PYBB_TOPIC_VIEWS_FLUSH_ON_REQUEST = getattr(settings, 'PYBB_TOPIC_VIEWS_FLUSH_ON_REQUEST', True)
 
 PYBB_DISABLE_SUBSCRIPTIONS = getattr(settings, 'PYBB_DISABLE_SUBSCRIPTIONS', False)
 PYBB_DISABLE_NOTIFICATIONS = getattr(settings, 'PYBB_DISABLE_NOTIFICATIONS', False)
+PYBB_NOTIFICATION_EXECUTOR = getattr(settings, 'PYBB_NOTIFICATION_EXECUTOR', 'pybb.subscription.OutboxExecutor')
+PYBB_NOTIFICATION_MAX_ATTEMPTS = getattr(settings, 'PYBB_NOTIFICATION_MAX_ATTEMPTS', 3)
+PYBB_NOTIFICATION_RETRY_DELAY = getattr(settings, 'PYBB_NOTIFICATION_RETRY_DELAY', 60)
+PYBB_NOTIFICATION_CLAIM_TIMEOUT = getattr(settings, 'PYBB_NOTIFICATION_CLAIM_TIMEOUT', 600)
+PYBB_NOTIFICATION_MAIL_BATCH_SIZE = getattr(settings, 'PYBB_NOTIFICATION_MAIL_BATCH_SIZE', 100)
+PYBB_NOTIFICATION_RENDER_PER_RECIPIENT = getattr(settings, 'PYBB_NOTIFICATION_RENDER_PER_RECIPIENT', False)
+PYBB_NOTIFICATION_RECIPIENT_FIELDS = getattr(settings, 'PYBB_NOTIFICATION_RECIPIENT_FIELDS',
+                                             ['username', 'get_username', 'email', 'first_name', 'last_name',
+                                              'get_full_name', 'get_short_name'])
 PYBB_PREMODERATION = getattr(settings, 'PYBB_PREMODERATION', False)
 
 if not hasattr(settings, 'PYBB_BODY_CLEANERS'):
@@ -131,6 +148,11 @@ PYBB_USE_DJANGO_MAILER = getattr(settings, 'PYBB_USE_DJANGO_MAILER', False)
 
 PYBB_PERMISSION_HANDLER = getattr(settings, 'PYBB_PERMISSION_HANDLER', 'pybb.permissions.DefaultPermissionHandler')
 
+PYBB_READ_STATE_BACKEND = getattr(settings, 'PYBB_READ_STATE_BACKEND', 'pybb.read_state.WatermarkReadStateBackend')
+PYBB_READ_STATE_MAX_TOPICS = getattr(settings, 'PYBB_READ_STATE_MAX_TOPICS', 500)
+PYBB_SEARCH_BACKEND = getattr(settings, 'PYBB_SEARCH_BACKEND', None)
+PYBB_SEARCH_POSTGRES_CONFIG = getattr(settings, 'PYBB_SEARCH_POSTGRES_CONFIG', 'simple')
+
 PYBB_PROFILE_RELATED_NAME = getattr(settings, 'PYBB_PROFILE_RELATED_NAME', 'pybb_profile')
 
 PYBB_ENABLE_ADMIN_POST_FORM = getattr(settings, 'PYBB_ENABLE_ADMIN_POST_FORM', True)
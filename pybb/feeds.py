@@ -4,6 +4,7 @@ from django.urls import reverse
 from django.utils.feedgenerator import Atom1Feed
 from django.utils.translation import gettext_lazy as _
 
+from pybb import defaults
 from pybb.models import Post, Topic
 
 from pybb.permissions import perms
@@ -32,7 +33,10 @@ class LastPosts(PybbFeed):
 
     def items(self, user):
         ids = [p.id for p in perms.filter_posts(user, Post.objects.only('id')).order_by('-created', '-id')[:15]]
-        return Post.objects.filter(id__in=ids).select_related('topic', 'topic__forum', 'user')
+        qs = Post.objects.filter(id__in=ids).select_related('topic', 'topic__forum', 'user')
+        if defaults.PYBB_PROFILE_RELATED_NAME:
+            qs = qs.select_related('user__%s' % defaults.PYBB_PROFILE_RELATED_NAME)
+        return qs
 
 
 class LastTopics(PybbFeed):
@@ -45,4 +49,7 @@ class LastTopics(PybbFeed):
         return request.user
 
     def items(self, user):
-        return perms.filter_topics(user, Topic.objects.all()).select_related('forum').order_by('-created', '-id')[:15]
+        qs = perms.filter_topics(user, Topic.objects.all()).select_related('forum', 'head__user')
+        if defaults.PYBB_PROFILE_RELATED_NAME:
+            qs = qs.select_related('head__user__%s' % defaults.PYBB_PROFILE_RELATED_NAME)
+        return qs.order_by('-created', '-id')[:15]
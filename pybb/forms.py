@@ -81,14 +81,14 @@ class PostForm(forms.ModelForm):
         print(f"PostForm init - request.user: {self.request.user if self.request else 'None'}, topic: {self.topic.id if self.topic else None}")
         if not (self.topic or self.forum or ('instance' in kwargs)):
             raise ValueError('You should provide topic, forum or instance')
-        if kwargs.get('instance', None) and (kwargs['instance'].topic.head == kwargs['instance']):
+        if kwargs.get('instance', None) and (kwargs['instance'].topic.head_id == kwargs['instance'].pk):
             kwargs.setdefault('initial', {})['name'] = kwargs['instance'].topic.name
             kwargs.setdefault('initial', {})['poll_type'] = kwargs['instance'].topic.poll_type
             kwargs.setdefault('initial', {})['poll_question'] = kwargs['instance'].topic.poll_question
 
         super(PostForm, self).__init__(*args, **kwargs)
 
-        if not (self.forum or (self.instance.pk and (self.instance.topic.head == self.instance))):
+        if not (self.forum or (self.instance.pk and (self.instance.topic.head_id == self.instance.pk))):
             del self.fields['name']
             del self.fields['poll_type']
             del self.fields['poll_question']
@@ -135,7 +135,7 @@ class PostForm(forms.ModelForm):
             post = super(PostForm, self).save(commit=False)
             if self.request:
                 post.user = self.request.user
-            if post.topic.head == post:
+            if post.topic.head_id == post.pk:
                 post.topic.name = self.cleaned_data['name']
                 if self.may_create_poll:
                     post.topic.poll_type = self.cleaned_data['poll_type']
@@ -285,17 +285,13 @@ class MovePostForm(forms.Form):
             # we can not update with subqueries on same table with mysql 5.5
             # it raises: You can't specify target table 'pybb_post' for update in FROM clause
             # so we need to get all pks... It's bad for perfs, but posts are not often splitted...
+            posts = list(posts)
             posts_pks = [p.pk for p in posts]
             Post.objects.filter(pk__in=posts_pks).update(topic_id=topic.pk)
 
-        topic.update_counters()
-        topic.forum.update_counters()
-
-        if topic.pk != self.topic.pk:
-            # we just created a new topic. let's update the counters
-            self.topic.update_counters()
-        if self.forum.pk != topic.forum.pk:
-            self.forum.update_counters()
+            # move counters from the splitted topic to the new one
+            topic.increment_counters(post_count=len(posts), head=posts[0], last_post=posts[-1])
+            self.topic.decrement_counters(post_count=len(posts), last_post_id=posts[-1].pk)
         return Post.objects.get(pk=self.post.pk)
 
 
@@ -0,0 +1,129 @@
+"""
+Snapshot of the categories and forums hierarchy
+
+The ids, parents, categories, names, slugs and hidden flags of all categories and forums are loaded
+once, shared by the processes through the cache and kept in each process. Saving or deleting
+a category or a forum changes the generation of the tree; other processes notice it within
+`LOCAL_CHECK_INTERVAL` seconds. A snapshot loaded during a change keeps its older generation,
+so it is not used once cached.
+
+Processes only notice changes made by others through a shared cache backend: with a per-process cache
+(e.g. `LocMemCache`), a snapshot may be stale for `TREE_CACHE_TIMEOUT` seconds. It is only used for
+display (breadcrumbs, urls), permission checks query the hidden forums.
+"""
+
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+from pybb.models import Category, Forum
+
+TREE_CACHE_KEY = 'pybbm_forum_tree'
+TREE_GENERATION_KEY = 'pybbm_forum_tree_generation'
+TREE_CACHE_TIMEOUT = 24 * 60 * 60
+LOCAL_CHECK_INTERVAL = 1
+
+CATEGORY_FIELDS = ('id', 'name', 'slug', 'hidden', 'position')
+FORUM_FIELDS = ('id', 'name', 'slug', 'hidden', 'position', 'category_id', 'parent_id')
+
+_local = {'tree': None, 'checked': 0}
+
+
+class ForumTree(object):
+    """
+    Categories and forums hierarchy. Returned instances only have the snapshot fields set, and are
+    new for each call, so callers may change them.
+    """
+
+    def __init__(self, data):
+        self.version = data['version']
+        self.categories = data['categories']
+        self.forums = data['forums']
+        self.ancestors = {}
+        for forum_id in self.forums:
+            self.get_ancestor_ids(forum_id)
+        self.hidden_forum_ids = frozenset(
+            forum_id for forum_id, forum in self.forums.items()
+            if forum['hidden'] or self.categories[forum['category_id']]['hidden'])
+
+    @classmethod
+    def load_data(cls):
+        return {
+            'version': uuid.uuid4().hex,
+            'categories': dict((category['id'], category)
+                               for category in Category.objects.order_by().values(*CATEGORY_FIELDS)),
+            'forums': dict((forum['id'], forum) for forum in Forum.objects.order_by().values(*FORUM_FIELDS)),
+        }
+
+    def get_ancestor_ids(self, forum_id):
+        """ returns the ids of the parent forums of `forum_id`, from the root one """
+        if forum_id not in self.ancestors:
+            parent_id = self.forums[forum_id]['parent_id']
+            self.ancestors[forum_id] = () if parent_id is None else self.get_ancestor_ids(parent_id) + (parent_id,)
+        return self.ancestors[forum_id]
+
+    def __contains__(self, forum_id):
+        return forum_id in self.forums
+
+    def get_slugs(self, forum_id):
+        """ returns the slugs of the category and of `forum_id`, for nice urls """
+        forum = self.forums[forum_id]
+        return self.categories[forum['category_id']]['slug'], forum['slug']
+
+    def get_category(self, category_id):
+        return Category(**self.categories[category_id])
+
+    def get_forum(self, forum_id):
+        forum = Forum(**self.forums[forum_id])
+        forum.category = self.get_category(forum.category_id)
+        return forum
+
+    def get_parents(self, forum_id):
+        """ returns the category and the parent forums of `forum_id`, for breadcrumbs """
+        category = self.get_category(self.forums[forum_id]['category_id'])
+        parents = [category]
+        for parent_id in self.get_ancestor_ids(forum_id):
+            parent = Forum(**self.forums[parent_id])
+            parent.category = category
+            parents.append(parent)
+        return parents
+
+
+def get_forum_tree():
+    """ returns the current `ForumTree` """
+    tree = _local['tree']
+    now = time.time()
+    if tree is not None and now - _local['checked'] < LOCAL_CHECK_INTERVAL:
+        return tree
+    cached = cache.get_many([TREE_CACHE_KEY, TREE_GENERATION_KEY])
+    generation = cached.get(TREE_GENERATION_KEY)
+    if generation is None:
+        cache.add(TREE_GENERATION_KEY, uuid.uuid4().hex, None)
+        generation = cache.get(TREE_GENERATION_KEY)
+    data = cached.get(TREE_CACHE_KEY)
+    if data is None or data['generation'] != generation:
+        data = ForumTree.load_data()
+        data['generation'] = generation
+        cache.set(TREE_CACHE_KEY, data, TREE_CACHE_TIMEOUT)
+    if tree is None or tree.version != data['version']:
+        tree = ForumTree(data)
+    _local['tree'], _local['checked'] = tree, now
+    return tree
+
+
+def invalidate_forum_tree(instance=None, created=True, **kwargs):
+    # saves which do not change the fields of the snapshot (counters, activity dates) keep it;
+    # `created` is only sent by post_save
+    if instance is not None and not created and not instance.has_changed(*instance.tracked_fields):
+        return
+    drop_forum_tree()
+    # readers may have loaded the tree before the change was committed
+    transaction.on_commit(drop_forum_tree)
+
+
+def drop_forum_tree():
+    _local['tree'] = None
+    cache.set(TREE_GENERATION_KEY, uuid.uuid4().hex, None)
+    cache.delete(TREE_CACHE_KEY)
@@ -0,0 +1,49 @@
+"""
+Cache of the categories and forums listed by the forum index
+
+The listing is cached per permission signature (see `DefaultPermissionHandler.get_signature`), all
+signatures in one cache key, which is deleted when a category or a forum changes, including the
+counters and the last post of a forum.
+Per-user data, like unread markers, are computed on the listing taken from the cache.
+"""
+
+from django.core.cache import cache
+
+from pybb import defaults
+from pybb.models import Category, Forum
+from pybb.permissions import perms
+
+INDEX_CACHE_KEY = 'pybbm_index'
+
+
+def build_categories(user):
+    """ returns the categories visible by `user` with their visible root forums as `forums_accessed` """
+    categories = list(perms.filter_categories(user, Category.objects.all()))
+    forums = perms.filter_forums(user, Forum.objects.filter(parent=None, category__in=categories))
+    forums_by_category = {}
+    for forum in forums.select_related('category', 'last_post__user'):
+        forums_by_category.setdefault(forum.category_id, []).append(forum)
+    for category in categories:
+        category.forums_accessed = forums_by_category.get(category.id, [])
+    return categories
+
+
+def get_categories(user):
+    """ returns `build_categories(user)`, from the cache when possible """
+    get_signature = getattr(perms, 'get_signature', None)
+    if not defaults.PYBB_INDEX_CACHE_TIMEOUT or get_signature is None:
+        return build_categories(user)
+    signature = '%s.%s:%s' % (perms.__class__.__module__, perms.__class__.__name__, get_signature(user))
+    index = cache.get(INDEX_CACHE_KEY) or {}
+    if signature not in index:
+        index[signature] = build_categories(user)
+        # a concurrent request may have stored another signature: it is only computed again
+        cache.set(INDEX_CACHE_KEY, index, defaults.PYBB_INDEX_CACHE_TIMEOUT)
+    return index[signature]
+
+
+def invalidate_index(**kwargs):
+    # signal triggered by loaddata command, ignore
+    if kwargs.get('raw', False):
+        return
+    cache.delete(INDEX_CACHE_KEY)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pybb.topic_views import flush_views, get_stats
+
+
+class Command(BaseCommand):
+    help = 'Write the topic views buffered in the cache to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of topics updated by each UPDATE statement')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep running and flush the views periodically')
+        parser.add_argument('--sleep', type=float, default=60,
+                            help='Seconds to wait between two flushes with --loop')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        while True:
+            count = flush_views(chunk_size=options['chunk_size'])
+            stats = get_stats()
+            self.stdout.write('Successfully updated topics: %d (views buffered: %d, persisted: %d)\n' % (
+                count, stats['buffered'], stats['persisted']))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pybb import compat
+from pybb.purge import block_user, purge_user
+
+
+class Command(BaseCommand):
+    help = 'Delete the topics and posts of users and repair the affected counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='+', help='Users whose topics and posts are deleted')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of rows deleted by each DELETE statement')
+        parser.add_argument('--keep-active', action='store_true', default=False,
+                            help='Do not block the users')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        User = compat.get_user_model()
+        username_field = compat.get_username_field()
+        for username in options['usernames']:
+            try:
+                user = User.objects.get(**{username_field: username})
+            except User.DoesNotExist:
+                raise CommandError('User "%s" does not exist' % username)
+            if options['keep_active']:
+                counts = purge_user(user, chunk_size=options['chunk_size'])
+            else:
+                counts = block_user(user, delete_posts=True, chunk_size=options['chunk_size'])
+            self.stdout.write('Successfully purged %s: %d topics and %d posts deleted\n' % (
+                username, counts['topics'], counts['posts']))
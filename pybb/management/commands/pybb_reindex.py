@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pybb.search.indexer import reindex
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search index of posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of posts loaded and indexed at once')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        count = 0
+        for count in reindex(chunk_size=options['chunk_size']):
+            if options['verbosity'] >= 2:
+                self.stdout.write('%d posts indexed\n' % count)
+        self.stdout.write('Successfully indexed posts: %d\n' % count)
@@ -0,0 +1,85 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from pybb import search, util
+from pybb.models import Post
+from pybb.util import get_render_version
+
+
+def init_worker():
+    # spawned worker processes have to set up Django
+    django.setup()
+
+
+def rerender_posts(start, end, force=False):
+    """
+    Renders the stale posts with ids in [start, end) and saves them without calling `Post.save`.
+    Returns the number of rendered posts.
+    """
+    posts = Post.objects.filter(pk__gte=start, pk__lt=end)
+    if not force:
+        posts = posts.exclude(render_version=get_render_version())
+    posts = [post for post in posts if post.render(force=force)]
+    with transaction.atomic():
+        for post in posts:
+            Post.objects.filter(pk=post.pk).update(body_html=post.body_html, body_text=post.body_text,
+                                                   body_hash=post.body_hash, render_version=post.render_version)
+        search.search_backend.index_posts(posts)
+    return len(posts)
+
+
+def rerender_signatures(start, end):
+    """
+    Renders the signatures of profiles with ids in [start, end). Returns the number of rendered signatures.
+    """
+    Profile = util.get_pybb_profile_model()
+    formatter = util._get_markup_formatter()
+    profiles = Profile.objects.filter(pk__gte=start, pk__lt=end).exclude(signature='')
+    profiles = list(profiles.values_list('pk', 'signature'))
+    with transaction.atomic():
+        for pk, signature in profiles:
+            Profile.objects.filter(pk=pk).update(signature_html=formatter(signature))
+    return len(profiles)
+
+
+class Command(BaseCommand):
+    help = 'Render again the posts rendered with another markup configuration'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Range of ids rendered by each task')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes')
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Render all posts, even the up-to-date ones')
+        parser.add_argument('--signatures', action='store_true', default=False,
+                            help='Render the signatures of profiles too')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--chunk-size and --workers must be positive')
+        self.chunk_size = options['chunk_size']
+        self.workers = options['workers']
+
+        count = self.run(rerender_posts, Post, options['all'])
+        self.stdout.write('Successfully rendered posts: %d\n' % count)
+        if options['signatures']:
+            count = self.run(rerender_signatures, util.get_pybb_profile_model())
+            self.stdout.write('Successfully rendered signatures: %d\n' % count)
+
+    def run(self, func, model, *args):
+        bounds = model.objects.aggregate(min_id=Min('pk'), max_id=Max('pk'))
+        if bounds['min_id'] is None:
+            return 0
+        starts = range(bounds['min_id'], bounds['max_id'] + 1, self.chunk_size)
+        ends = [start + self.chunk_size for start in starts]
+        if self.workers > 1:
+            # worker processes must not inherit the database connections of this process
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker) as executor:
+                return sum(executor.map(func, starts, ends, *[[arg] * len(ends) for arg in args]))
+        return sum(map(func, starts, ends, *[[arg] * len(ends) for arg in args]))
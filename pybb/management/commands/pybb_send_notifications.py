@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pybb.subscription import process_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send the subscription notifications waiting in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of notifications delivered per transaction')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep running and poll the outbox when it is empty')
+        parser.add_argument('--sleep', type=float, default=5,
+                            help='Seconds to wait between two polls of an empty outbox with --loop')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = process_outbox(limit=options['batch_size'])
+            total += count
+            if count:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+        self.stdout.write('%d notifications processed\n' % total)
@@ -3,18 +3,92 @@
 
 __author__ = 'zeus'
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from django.core.management.base import BaseCommand, CommandError
-from pybb.models import Topic, Forum
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from pybb import index_cache, util
+from pybb.models import Topic, Forum, topic_counters_expressions, forum_counters_expressions, \
+    profile_counters_expressions
+
 
 class Command(BaseCommand):
-    help = 'Recalc post counters for forums and topics'
+    help = 'Recalc post counters for forums, topics and profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Number of ids recomputed by each UPDATE statement')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of chunks processed in parallel')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report the counters which differ from their recomputed value')
 
     def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--chunk-size and --workers must be positive')
+        self.chunk_size = options['chunk_size']
+        self.workers = options['workers']
+        self.dry_run = options['dry_run']
+        self.verbosity = options['verbosity']
+        self.lock = threading.Lock()
+
+        for model, expressions in ((Topic, topic_counters_expressions()), (Forum, forum_counters_expressions()),
+                                   (util.get_pybb_profile_model(), profile_counters_expressions())):
+            count = self.process_model(model, expressions)
+            if self.dry_run:
+                self.stdout.write('%s with wrong counters: %d\n' % (model._meta.verbose_name_plural, count))
+            else:
+                self.stdout.write('Successfully updated %s: %d\n' % (model._meta.verbose_name_plural, count))
+        if not self.dry_run:
+            index_cache.invalidate_index()
+
+    def process_model(self, model, expressions):
+        bounds = model.objects.aggregate(min_id=Min('pk'), max_id=Max('pk'))
+        if bounds['min_id'] is None:
+            return 0
+        chunks = [(start, start + self.chunk_size)
+                  for start in range(bounds['min_id'], bounds['max_id'] + 1, self.chunk_size)]
+        self.done_chunks = 0
+
+        def process(chunk):
+            try:
+                return self.process_chunk(model, expressions, chunk, len(chunks))
+            finally:
+                if self.workers > 1:
+                    # each worker thread owns its database connection
+                    connection.close()
+
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return sum(executor.map(process, chunks))
+        return sum(map(process, chunks))
 
-        for topic in Topic.objects.all():
-            topic.update_counters()
-            self.stdout.write('Successfully updated topic "%s"\n' % topic)
+    def process_chunk(self, model, expressions, chunk, chunks_count):
+        queryset = model.objects.filter(pk__gte=chunk[0], pk__lt=chunk[1])
+        if self.dry_run:
+            count = self.report_chunk(model, queryset, expressions)
+        else:
+            with transaction.atomic():
+                count = queryset.update(**expressions)
+        with self.lock:
+            self.done_chunks += 1
+            if self.verbosity >= 1:
+                self.stdout.write('%s ids %d-%d done (%d/%d chunks)\n' % (
+                    model._meta.verbose_name_plural, chunk[0], chunk[1] - 1, self.done_chunks, chunks_count))
+        return count
 
-        for forum in Forum.objects.all():
-            forum.update_counters()
-            self.stdout.write('Successfully updated forum "%s"\n' % forum)
+    def report_chunk(self, model, queryset, expressions):
+        fields = sorted(expressions)
+        annotations = dict(('new_%s' % field, expression) for field, expression in expressions.items())
+        rows = queryset.annotate(**annotations).values('pk', *(fields + sorted(annotations))).order_by('pk')
+        count = 0
+        for row in rows:
+            diffs = ['%s %s -> %s' % (field, row[field], row['new_%s' % field])
+                     for field in fields if row[field] != row['new_%s' % field]]
+            if diffs:
+                count += 1
+                self.stdout.write('%s #%d: %s\n' % (model._meta.verbose_name, row['pk'], ', '.join(diffs)))
+        return count
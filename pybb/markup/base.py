@@ -6,10 +6,54 @@ from pybb.defaults import PYBB_SMILES, PYBB_SMILES_PREFIX
 from django.forms import Textarea
 
 
+_SMILES_REPLACERS = {}
+
+ATTACHMENT_REF_RE = re.compile(r'\[file-([1-9][0-9]*)\]')
+
+
+def _trie_regex(words):
+    """
+    Returns a regex matching any of `words`, built from their prefix tree so that the regex engine
+    follows one branch per character instead of trying every word. Longest words are matched first.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        return '(?:%s)%s' % ('|'.join(alternatives), '?' if '' in node else '')
+
+    return build(trie)
+
+
+def get_smiles_replacer():
+    """
+    Returns the regex matching any of `PYBB_SMILES` and the dict of their HTML,
+    built once for the current STATIC_URL
+    """
+    static_url = settings.STATIC_URL
+    replacer = _SMILES_REPLACERS.get(static_url)
+    if replacer is None:
+        smiles_html = dict((smile, '<img src="%s%s%s" alt="smile" />' % (static_url, PYBB_SMILES_PREFIX, url))
+                           for smile, url in PYBB_SMILES.items())
+        pattern = re.compile(_trie_regex(smiles_html)) if smiles_html else None
+        replacer = _SMILES_REPLACERS[static_url] = (pattern, smiles_html)
+    return replacer
+
+
 def smile_it(s):
-    for smile, url in PYBB_SMILES.items():
-        s = s.replace(smile, '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL, PYBB_SMILES_PREFIX, url))
-    return s
+    pattern, smiles_html = get_smiles_replacer()
+    if pattern is None:
+        return s
+    return pattern.sub(lambda match: smiles_html[match.group(0)], s)
 
 
 def filter_blanks(user, str):
@@ -36,25 +80,21 @@ class BaseParser(object):
 
         :param text: text which contains attachment's references
         :type text: str or unicode
-        :param attachments: related attached files
-        :type attachments: Quersyset from a model with a "file" attribute.
+        :param attachments: related attached files, only evaluated if the text contains references
+        :type attachments: Queryset or list of objects with a "file" attribute.
         :returns: str or unicode with [file-\d+] replaced by related file's (web) URL
         """
-
-        refs = re.findall( '\[file-([1-9][0-9]*)\]', text)
-        if not refs:
+        if not ATTACHMENT_REF_RE.search(text):
             return text
-        refs = sorted(set(refs))
+        attachments = sorted(attachments, key=lambda attachment: attachment.pk)
 
-        max_ref = attachments.count()
-        if not max_ref:
-            return text
-        refs = [int(ref) for ref in refs if int(ref) <= max_ref]
-        attachments = [a for a  in attachments.order_by('pk')[0:max(refs)]]
-        for ref in refs:
-            text = text.replace('[file-%d]' % ref, attachments[ref-1].file.url)
+        def replace(match):
+            ref = int(match.group(1))
+            if ref > len(attachments):
+                return match.group(0)
+            return attachments[ref - 1].file.url
 
-        return text
+        return ATTACHMENT_REF_RE.sub(replace, text)
 
     def format(self, text, instance=None):
         if instance and instance.pk:
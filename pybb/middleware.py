@@ -1,9 +1,13 @@
 
 
+import uuid
+
 import django
+from django.core.cache import cache
 from django.utils import translation
 from django.db.models import ObjectDoesNotExist
 from pybb import util
+from pybb.permissions import start_permission_scope, end_permission_scope
 
 if django.VERSION < (1, 10):  # pragma: no cover
     MiddlewareParentClass = object
@@ -12,27 +16,85 @@ else:  # pragma: no cover
     MiddlewareParentClass = MiddlewareMixin
 
 
+PROFILE_SESSION_KEY = 'pybb_profile'
+PROFILE_VERSION_CACHE_KEY = 'pybbm_profile_version_%s'
+LANGUAGE_SESSION_KEY = 'django_language'
+
+
+def load_profile(user):
+    try:
+        # Here we try to load profile, but can get error
+        # if user created during syncdb but profile model
+        # under south control. (Like pybb.Profile).
+        return util.get_pybb_profile(user)
+    except ObjectDoesNotExist:
+        # Ok, we should create new profile for this user
+        # and grant permissions for add posts
+        # It should be caused rarely, so we move import signal here
+        # to prevent circular import
+        from pybb.signals import user_saved
+        user_saved(user, created=True)
+        return util.get_pybb_profile(user)
+
+
+def get_profile_version(user_id):
+    """ returns the version of the profile of `user_id`, which changes each time the profile is saved """
+    key = PROFILE_VERSION_CACHE_KEY % user_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def profile_saved(instance, **kwargs):
+    user_id = instance.serializable_value(util.get_pybb_profile_user_field())
+    cache.set(PROFILE_VERSION_CACHE_KEY % user_id, uuid.uuid4().hex, None)
+
+
+def store_profile_settings(request, profile):
+    """ caches the language and the time zone of `profile`, the profile of the request user, in the session """
+    profile_settings = {
+        'user': str(request.user.pk),
+        'version': get_profile_version(request.user.pk),
+        'language': profile.language,
+        'time_zone': profile.time_zone,
+    }
+    if request.session.get(PROFILE_SESSION_KEY) != profile_settings:
+        request.session[PROFILE_SESSION_KEY] = profile_settings
+    return profile_settings
+
+
+def get_profile_settings(request):
+    """
+    returns the language and the time zone of the request user's profile, from the session when possible, so
+    the profile is only loaded when the session does not know them yet or when the profile was saved since
+    """
+    profile_settings = request.session.get(PROFILE_SESSION_KEY)
+    if (profile_settings and profile_settings.get('user') == str(request.user.pk) and
+            profile_settings.get('version') == get_profile_version(request.user.pk)):
+        return profile_settings
+    profile = load_profile(request.user)
+    if not profile.language:
+        profile.language = translation.get_language_from_request(request)
+        profile.save()
+    return store_profile_settings(request, profile)
+
+
 class PybbMiddleware(MiddlewareParentClass):
     def process_request(self, request):
+        # permission data are loaded once per request
+        start_permission_scope()
         if request.user.is_authenticated:
-            try:
-                # Here we try to load profile, but can get error
-                # if user created during syncdb but profile model
-                # under south control. (Like pybb.Profile).
-                profile = util.get_pybb_profile(request.user)
-            except ObjectDoesNotExist:
-                # Ok, we should create new profile for this user
-                # and grant permissions for add posts
-                # It should be caused rarely, so we move import signal here
-                # to prevent circular import
-                from pybb.signals import user_saved
-                user_saved(request.user, created=True)
-                profile = util.get_pybb_profile(request.user)
-
-            if not profile.language:
-                profile.language = translation.get_language_from_request(request)
-                profile.save()
-
-            request.session['django_language'] = profile.language
-            translation.activate(profile.language)
+            profile_settings = get_profile_settings(request)
+            language = profile_settings['language']
+            # the session is only saved again when a value changes
+            if request.session.get(LANGUAGE_SESSION_KEY) != language:
+                request.session[LANGUAGE_SESSION_KEY] = language
+            request.pybb_time_zone = profile_settings['time_zone']
+            translation.activate(language)
             request.LANGUAGE_CODE = translation.get_language()
+
+    def process_response(self, request, response):
+        end_permission_scope()
+        return response
@@ -0,0 +1,37 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def fill_last_post_head(apps, schema_editor):
+    Forum = apps.get_model("pybb", "Forum")
+    Topic = apps.get_model("pybb", "Topic")
+    Post = apps.get_model("pybb", "Post")
+
+    topic_posts = Post.objects.filter(topic=OuterRef('pk'))
+    Topic.objects.all().update(
+        head=Subquery(topic_posts.order_by('created', 'id').values('pk')[:1]),
+        last_post=Subquery(topic_posts.order_by('-created', '-id').values('pk')[:1]),
+    )
+    forum_posts = Post.objects.filter(topic__forum=OuterRef('pk'))
+    Forum.objects.all().update(
+        last_post=Subquery(forum_posts.order_by('-created', '-id').values('pk')[:1]),
+    )
+
+
+def clear_last_post_head(apps, schema_editor):
+    Forum = apps.get_model("pybb", "Forum")
+    Topic = apps.get_model("pybb", "Topic")
+
+    Topic.objects.all().update(head=None, last_post=None)
+    Forum.objects.all().update(last_post=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pybb', '0008_topic_forum_last_post_head'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_last_post_head, clear_last_post_head),
+    ]
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pybb', '0009_last_post_head_fill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForumReadState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('watermark', models.DateTimeField(blank=True, null=True, verbose_name='Watermark')),
+                ('topics', models.JSONField(blank=True, default=dict, verbose_name='Topics read after watermark')),
+                ('forum', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pybb.forum')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Forum read state',
+                'verbose_name_plural': 'Forum read states',
+                'unique_together': {('user', 'forum')},
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+USERS_CHUNK_SIZE = 1000
+
+
+def fill_read_states(apps, schema_editor):
+    ForumReadTracker = apps.get_model("pybb", "ForumReadTracker")
+    TopicReadTracker = apps.get_model("pybb", "TopicReadTracker")
+    ForumReadState = apps.get_model("pybb", "ForumReadState")
+
+    user_ids = sorted(set(ForumReadTracker.objects.values_list('user_id', flat=True).distinct()) |
+                      set(TopicReadTracker.objects.values_list('user_id', flat=True).distinct()))
+    for i in range(0, len(user_ids), USERS_CHUNK_SIZE):
+        chunk = user_ids[i:i + USERS_CHUNK_SIZE]
+        states = {}
+        forum_marks = ForumReadTracker.objects.filter(user__in=chunk, forum__isnull=False)
+        for user_id, forum_id, time_stamp in forum_marks.values_list('user_id', 'forum_id', 'time_stamp'):
+            states[(user_id, forum_id)] = ForumReadState(user_id=user_id, forum_id=forum_id,
+                                                         watermark=time_stamp, topics={})
+        topic_marks = TopicReadTracker.objects.filter(user__in=chunk, topic__isnull=False)
+        for user_id, topic_id, forum_id, time_stamp in topic_marks.values_list('user_id', 'topic_id',
+                                                                               'topic__forum_id', 'time_stamp'):
+            state = states.setdefault((user_id, forum_id),
+                                      ForumReadState(user_id=user_id, forum_id=forum_id, topics={}))
+            if state.watermark is None or time_stamp > state.watermark:
+                state.topics[str(topic_id)] = time_stamp.isoformat()
+        ForumReadState.objects.bulk_create(states.values())
+
+
+def clear_read_states(apps, schema_editor):
+    ForumReadState = apps.get_model("pybb", "ForumReadState")
+    ForumReadState.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pybb', '0010_forumreadstate'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_read_states, clear_read_states),
+    ]
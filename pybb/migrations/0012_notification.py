@@ -0,0 +1,30 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pybb', '0011_forumreadstate_fill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.PositiveSmallIntegerField(choices=[(1, 'New post for topic subscribers'), (2, 'New topic for forum subscribers')], verbose_name='Notification type')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Delivery attempts')),
+                ('next_attempt', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Next attempt')),
+                ('progress', models.JSONField(blank=True, default=dict, verbose_name='Delivery progress')),
+                ('post', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pybb.post')),
+                ('topic', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pybb.topic')),
+            ],
+            options={
+                'verbose_name': 'Notification',
+                'verbose_name_plural': 'Notifications',
+                'ordering': ['id'],
+            },
+        ),
+    ]
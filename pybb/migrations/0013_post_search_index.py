@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # the index storage is not a model: the tables of the default search backends are created
+    # with the SQL of this migration. Custom backends are set up, and existing posts are indexed,
+    # by the `pybb_reindex` management command.
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS pybb_post_fts USING fts5(body)')
+    elif vendor == 'postgresql':
+        post_table = schema_editor.quote_name(apps.get_model('pybb', 'Post')._meta.db_table)
+        schema_editor.execute(
+            'CREATE TABLE IF NOT EXISTS pybb_post_search ('
+            'post_id bigint PRIMARY KEY REFERENCES %s (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+            'document tsvector NOT NULL)' % post_table)
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS pybb_post_search_document ON pybb_post_search USING GIN (document)')
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS pybb_post_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP TABLE IF EXISTS pybb_post_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pybb', '0012_notification'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
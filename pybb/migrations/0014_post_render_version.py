@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pybb', '0013_post_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='body_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40, verbose_name='Message hash'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='render_version',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=40, verbose_name='Render version'),
+        ),
+    ]
@@ -1,21 +1,88 @@
+import hashlib
+import re
 
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 from django.db import models, transaction, DatabaseError
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
 from django.utils.html import strip_tags
 from django.utils.translation import gettext_lazy as _
 from django.utils.timezone import now as tznow
 
 from pybb.compat import get_user_model_path, get_username_field, get_atomic_func, slugify
 from pybb import defaults
+from pybb.markup.base import ATTACHMENT_REF_RE
 from pybb.profiles import PybbProfile
-from pybb.util import unescape, FilePathGenerator, _get_markup_formatter
+from pybb.util import unescape, FilePathGenerator, _get_markup_formatter, get_render_version, \
+    get_pybb_profile_user_field
 
 from annoying.fields import AutoOneToOneField
 
 
-class Category(models.Model):
+class TrackedFieldsMixin(object):
+    """
+    Keeps the values of `tracked_fields` (attribute names) loaded from the database or saved, so changed
+    fields are known before saving without fetching the old row.
+
+    `counter_fields` (attribute names) are kept up to date with atomic updates: saving a loaded instance
+    without `update_fields` only writes the ones changed on the instance, so its stale values do not
+    overwrite concurrent updates.
+    """
+    tracked_fields = ()
+    counter_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(TrackedFieldsMixin, cls).from_db(db, field_names, values)
+        instance.reset_tracked_fields()
+        return instance
+
+    def save(self, *args, **kwargs):
+        if (self.counter_fields and not args and kwargs.get('update_fields') is None and
+                not kwargs.get('force_insert') and not self._state.adding and self.pk is not None):
+            unchanged = set(name for name in self.counter_fields
+                            if name in getattr(self, '_tracked_values', {}) and not self.has_changed(name))
+            if unchanged:
+                deferred = self.get_deferred_fields()
+                kwargs['update_fields'] = [field.attname for field in self._meta.concrete_fields
+                                           if not field.primary_key and field.attname not in unchanged and
+                                           field.attname not in deferred]
+        super(TrackedFieldsMixin, self).save(*args, **kwargs)
+        self.reset_tracked_fields()
+
+    def reset_tracked_fields(self, *names):
+        """ keeps the current values of `names`, or of all tracked and counter fields, as the saved ones """
+        deferred = self.get_deferred_fields()
+        if not names:
+            self._tracked_values = {}
+            names = self.tracked_fields + self.counter_fields
+        elif not hasattr(self, '_tracked_values'):
+            return
+        self._tracked_values.update((name, getattr(self, name)) for name in names if name not in deferred)
+
+    def has_changed(self, *names):
+        """ returns True if one of the tracked fields `names` changed, or if the instance was not loaded """
+        if self.pk is None or not hasattr(self, '_tracked_values'):
+            return True
+        deferred = self.get_deferred_fields()
+        for name in names:
+            if name in deferred:
+                continue
+            if name not in self._tracked_values or self._tracked_values[name] != getattr(self, name):
+                return True
+        return False
+
+    def get_old_value(self, name):
+        """ returns the value of the tracked field `name` loaded or saved last, from the database if unknown """
+        if name in getattr(self, '_tracked_values', {}):
+            return self._tracked_values[name]
+        return type(self)._default_manager.filter(pk=self.pk).values_list(name, flat=True).first()
+
+
+class Category(TrackedFieldsMixin, models.Model):
     name = models.CharField(_('Name'), max_length=80)
     position = models.IntegerField(_('Position'), blank=True, default=0)
     hidden = models.BooleanField(_('Hidden'), default=False,
@@ -27,6 +94,8 @@ class Category(models.Model):
         verbose_name = _('Category')
         verbose_name_plural = _('Categories')
 
+    tracked_fields = ('name', 'slug', 'hidden', 'position')
+
     def __str__(self):
         return self.name
 
@@ -47,7 +116,7 @@ class Category(models.Model):
         return Post.objects.filter(topic__forum__category=self).select_related()
 
 
-class Forum(models.Model):
+class Forum(TrackedFieldsMixin, models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='forums', verbose_name=_('Category'))
     parent = models.ForeignKey('self', on_delete=models.CASCADE, related_name='child_forums', verbose_name=_('Parent forum'),
                                blank=True, null=True)
@@ -62,6 +131,8 @@ class Forum(models.Model):
     readed_by = models.ManyToManyField(get_user_model_path(), through='ForumReadTracker', related_name='readed_forums')
     headline = models.TextField(_('Headline'), blank=True, null=True)
     slug = models.SlugField(verbose_name=_("Slug"), max_length=255)
+    last_post = models.ForeignKey('Post', on_delete=models.SET_NULL, related_name='+', verbose_name=_('Last post'),
+                                  blank=True, null=True)
 
     class Meta(object):
         ordering = ['position']
@@ -69,44 +140,71 @@ class Forum(models.Model):
         verbose_name_plural = _('Forums')
         unique_together = ('category', 'slug')
 
+    tracked_fields = ('name', 'slug', 'category_id', 'parent_id', 'hidden', 'position')
+    counter_fields = ('updated', 'post_count', 'topic_count', 'last_post_id')
+
     def __str__(self):
         return self.name
 
     def update_counters(self):
+        """
+        Recounts forum's topics and posts. Counters are kept up to date incrementally
+        by topics and posts, so this is only a repair path.
+        """
         self.topic_count = Topic.objects.filter(forum=self).count()
         if self.topic_count:
             posts = Post.objects.filter(topic__forum_id=self.id)
             self.post_count = posts.count()
             if self.post_count:
                 try:
-                    last_post = posts.order_by('-created', '-id')[0]
-                    self.updated = last_post.updated or last_post.created
+                    self.last_post = posts.order_by('-created', '-id')[0]
+                    self.updated = self.last_post.updated or self.last_post.created
                 except IndexError:
                     pass
         else:
             self.post_count = 0
-        self.save()
+            self.last_post = None
+        Forum.objects.filter(pk=self.pk).update(topic_count=self.topic_count, post_count=self.post_count,
+                                                last_post=self.last_post, updated=self.updated)
+        self.reset_tracked_fields(*self.counter_fields)
+        _invalidate_index()
+
+    def refresh_last_post(self):
+        """
+        Recomputes the forum's last post and last activity date from its topics.
+        Used when the forum's last post was removed.
+        """
+        topic = Topic.objects.filter(forum=self, post_count__gt=0).order_by('-updated', '-id').first()
+        if topic is None:
+            self.last_post = None
+        else:
+            self.last_post_id = topic.last_post_id
+            self.updated = topic.updated
+        Forum.objects.filter(pk=self.pk).update(last_post=self.last_post_id, updated=self.updated)
+        self.reset_tracked_fields('last_post_id', 'updated')
+        _invalidate_index()
 
     def get_absolute_url(self):
         if defaults.PYBB_NICE_URL:
-            return reverse('pybb:forum', kwargs={'slug': self.slug, 'category_slug': self.category.slug})
+            tree = _get_forum_tree()
+            if self.category_id in tree.categories:
+                category_slug = tree.categories[self.category_id]['slug']
+            else:
+                category_slug = self.category.slug
+            return reverse('pybb:forum', kwargs={'slug': self.slug, 'category_slug': category_slug})
         return reverse('pybb:forum', kwargs={'pk': self.id})
 
     @property
     def posts(self):
         return Post.objects.filter(topic__forum=self).select_related()
 
-    @cached_property
-    def last_post(self):
-        try:
-            return self.posts.order_by('-created', '-id')[0]
-        except IndexError:
-            return None
-
     def get_parents(self):
         """
-        Used in templates for breadcrumb building
+        Used in templates for breadcrumb building, resolved from the forum tree snapshot without queries
         """
+        tree = _get_forum_tree()
+        if self.id in tree:
+            return tree.get_parents(self.id)
         parents = [self.category]
         parent = self.parent
         while parent is not None:
@@ -161,7 +259,7 @@ class ForumSubscription(models.Model):
             self.user.subscriptions.remove(*topics)
         super(ForumSubscription, self).delete(**kwargs)
 
-class Topic(models.Model):
+class Topic(TrackedFieldsMixin, models.Model):
     POLL_TYPE_NONE = 0
     POLL_TYPE_SINGLE = 1
     POLL_TYPE_MULTIPLE = 2
@@ -188,6 +286,10 @@ class Topic(models.Model):
     poll_type = models.IntegerField(_('Poll type'), choices=POLL_TYPE_CHOICES, default=POLL_TYPE_NONE)
     poll_question = models.TextField(_('Poll question'), blank=True, null=True)
     slug = models.SlugField(verbose_name=_("Slug"), max_length=255)
+    head = models.ForeignKey('Post', on_delete=models.SET_NULL, related_name='+', verbose_name=_('Head post'),
+                             blank=True, null=True)
+    last_post = models.ForeignKey('Post', on_delete=models.SET_NULL, related_name='+', verbose_name=_('Last post'),
+                                  blank=True, null=True)
 
     class Meta(object):
         ordering = ['-created']
@@ -195,62 +297,126 @@ class Topic(models.Model):
         verbose_name_plural = _('Topics')
         unique_together = ('forum', 'slug')
 
+    tracked_fields = ('name', 'slug', 'forum_id')
+    counter_fields = ('updated', 'views', 'post_count', 'head_id', 'last_post_id')
+
     def __str__(self):
         return self.name
 
-    @cached_property
-    def head(self):
-        try:
-            return self.posts.all().order_by('created', 'id')[0]
-        except IndexError:
-            return None
-
-    @cached_property
-    def last_post(self):
-        try:
-            return self.posts.order_by('-created', '-id').select_related('user')[0]
-        except IndexError:
-            return None
-
     def get_absolute_url(self):
         if defaults.PYBB_NICE_URL:
-            return reverse('pybb:topic', kwargs={'slug': self.slug, 'forum_slug': self.forum.slug, 'category_slug': self.forum.category.slug})
+            tree = _get_forum_tree()
+            if self.forum_id in tree:
+                category_slug, forum_slug = tree.get_slugs(self.forum_id)
+            else:
+                category_slug, forum_slug = self.forum.category.slug, self.forum.slug
+            return reverse('pybb:topic', kwargs={'slug': self.slug, 'forum_slug': forum_slug, 'category_slug': category_slug})
         return reverse('pybb:topic', kwargs={'pk': self.id})
 
     def save(self, *args, **kwargs):
-        if self.id is None:
+        created = self.id is None
+        if created:
             self.created = self.updated = tznow()
 
-        forum_changed = False
-        old_topic = None
-        if self.id is not None:
-            old_topic = Topic.objects.get(id=self.id)
-            if self.forum != old_topic.forum:
-                forum_changed = True
+        old_forum_id = None
+        if self.id is not None and self.has_changed('forum_id'):
+            old_forum_id = self.get_old_value('forum_id')
+        forum_changed = old_forum_id is not None and old_forum_id != self.forum_id
 
         super(Topic, self).save(*args, **kwargs)
 
-        if forum_changed:
-            old_topic.forum.update_counters()
-            self.forum.update_counters()
+        if created:
+            # topics are counted from their creation, as listings show them before their first post
+            apply_counters_delta(self.forum, topic_count=1)
+        elif forum_changed:
+            old_forum = Forum.objects.get(pk=old_forum_id)
+            apply_counters_delta(old_forum, post_count=-self.post_count, topic_count=-1)
+            if self.post_count and self.forum_lost_last_post(old_forum):
+                old_forum.refresh_last_post()
+            apply_counters_delta(self.forum, last_post=self.last_post, post_count=self.post_count, topic_count=1)
 
     def delete(self, using=None):
         super(Topic, self).delete(using)
-        self.forum.update_counters()
+        forum = self.forum
+        apply_counters_delta(forum, post_count=-self.post_count, topic_count=-1)
+        if self.post_count and self.forum_lost_last_post(forum):
+            forum.refresh_last_post()
+
+    def forum_lost_last_post(self, forum):
+        """
+        Returns True if the last post of `forum` may have been one of this topic's posts
+        """
+        return (forum.last_post_id is None or forum.last_post_id == self.last_post_id or
+                forum.updated is None or (self.updated is not None and self.updated >= forum.updated))
 
     def update_counters(self):
+        """
+        Recounts topic's posts. Post creation, deletion and moves keep counters up to date
+        with `increment_counters` and `decrement_counters`, so this is only a repair path.
+        """
         self.post_count = self.posts.count()
-        # force cache overwrite to get the real latest updated post
-        if hasattr(self, 'last_post'):
-            del self.last_post
+        self.head = self.posts.order_by('created', 'id').first()
+        self.last_post = self.posts.order_by('-created', '-id').first()
+        if self.last_post:
+            self.updated = self.last_post.updated or self.last_post.created
+        Topic.objects.filter(pk=self.pk).update(post_count=self.post_count, head=self.head,
+                                                last_post=self.last_post, updated=self.updated)
+        self.reset_tracked_fields('post_count', 'head_id', 'last_post_id', 'updated')
+
+    def refresh_head(self):
+        """
+        Recomputes the topic's head post. Used when the head post was moved.
+        """
+        self.head = self.posts.order_by('created', 'id').first()
+        Topic.objects.filter(pk=self.pk).update(head=self.head)
+        self.reset_tracked_fields('head_id')
+
+    def refresh_last_post(self):
+        """
+        Recomputes the topic's last post and last activity date.
+        Used when the topic's last post was removed.
+        """
+        self.last_post = self.posts.order_by('-created', '-id').first()
         if self.last_post:
             self.updated = self.last_post.updated or self.last_post.created
-        self.save()
+        Topic.objects.filter(pk=self.pk).update(last_post=self.last_post, updated=self.updated)
+        self.reset_tracked_fields('last_post_id', 'updated')
+
+    def increment_counters(self, post_count=1, head=None, last_post=None):
+        """
+        Adds `post_count` posts to topic and forum counters with atomic updates.
+
+        :param head: first added post, it becomes the topic's head if the topic has no head yet
+        :param last_post: latest added post, it becomes the topic's and forum's last post
+                          if it's more recent than their current last post
+        """
+        apply_counters_delta(self, head=head, last_post=last_post, post_count=post_count)
+        apply_counters_delta(self.forum, last_post=last_post, post_count=post_count)
+
+    def decrement_counters(self, post_count=1, last_post_id=None):
+        """
+        Removes `post_count` posts from topic and forum counters with atomic updates.
+
+        :param last_post_id: id of the latest removed post. If it was the topic's or the forum's
+                             last post, a new last post is computed.
+        """
+        forum = self.forum
+        lost_last_post = last_post_id is None or self.last_post_id in (None, last_post_id)
+        forum_lost_last_post = lost_last_post and self.forum_lost_last_post(forum)
+        apply_counters_delta(self, post_count=-post_count)
+        apply_counters_delta(forum, post_count=-post_count)
+        if lost_last_post:
+            self.refresh_last_post()
+        if forum_lost_last_post:
+            forum.refresh_last_post()
 
     def get_parents(self):
         """
         Used in templates for breadcrumb building
         """
+        tree = _get_forum_tree()
+        if self.forum_id in tree:
+            return tree.get_parents(self.forum_id) + [tree.get_forum(self.forum_id)]
         parents = self.forum.get_parents()
         parents.append(self.forum)
         return parents
@@ -273,16 +439,45 @@ class RenderableItem(models.Model):
     body = models.TextField(_('Message'))
     body_html = models.TextField(_('HTML version'))
     body_text = models.TextField(_('Text version'))
+    body_hash = models.CharField(_('Message hash'), max_length=40, blank=True, editable=False)
+    render_version = models.CharField(_('Render version'), max_length=40, blank=True, editable=False,
+                                      db_index=True)
 
-    def render(self):
+    def get_body_hash(self):
+        """ returns the hash of everything `body_html` is rendered from, except the markup configuration """
+        return hashlib.sha1(self.body.encode('utf-8')).hexdigest()
+
+    def render(self, force=False):
+        """
+        Renders `body_html` and `body_text`, unless they were rendered from the same body with the same
+        markup configuration. Returns True if the body was rendered.
+        """
+        body_hash = self.get_body_hash()
+        render_version = get_render_version()
+        if not force and self.body_html and self.body_hash == body_hash and self.render_version == render_version:
+            return False
         self.body_html = _get_markup_formatter()(self.body, instance=self)
         # Remove tags which was generated with the markup processor
         text = strip_tags(self.body_html)
         # Unescape entities which was generated with the markup processor
         self.body_text = unescape(text)
+        self.body_hash = body_hash
+        self.render_version = render_version
+        return True
+
+    def save_rendering(self):
+        """
+        Renders the saved item again if needed, and only updates its rendered fields. Returns True if it was rendered.
+        """
+        if not self.render():
+            return False
+        type(self)._default_manager.filter(pk=self.pk).update(
+            body_html=self.body_html, body_text=self.body_text,
+            body_hash=self.body_hash, render_version=self.render_version)
+        return True
 
 
-class Post(RenderableItem):
+class Post(TrackedFieldsMixin, RenderableItem):
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='posts', verbose_name=_('Topic'))
     user = models.ForeignKey(get_user_model_path(), on_delete=models.CASCADE, related_name='posts', verbose_name=_('User'))
     created = models.DateTimeField(_('Created'), blank=True, db_index=True)
@@ -295,6 +490,8 @@ class Post(RenderableItem):
         verbose_name = _('Post')
         verbose_name_plural = _('Posts')
 
+    tracked_fields = ('topic_id',)
+
     def summary(self):
         limit = 50
         tail = len(self.body) > limit and '...' or ''
@@ -305,7 +502,17 @@ class Post(RenderableItem):
 
     @cached_property
     def is_topic_head(self):
-        return self.pk and self.topic.head.pk == self.pk
+        return self.pk and self.topic.head_id == self.pk
+
+    def get_body_hash(self):
+        if not self.pk or not ATTACHMENT_REF_RE.search(self.body):
+            return super(Post, self).get_body_hash()
+        # the body references attachments, which are rendered as their url:
+        # load them once, for the hash and for the markup engine
+        getattr(self, '_prefetched_objects_cache', {}).pop('attachments', None)
+        prefetch_related_objects([self], 'attachments')
+        files = [attachment.file.name for attachment in sorted(self.attachments.all(), key=lambda a: a.pk)]
+        return hashlib.sha1('\n'.join([self.body] + files).encode('utf-8')).hexdigest()
 
     def save(self, *args, **kwargs):
         created_at = tznow()
@@ -315,39 +522,49 @@ class Post(RenderableItem):
 
         new = self.pk is None
 
-        topic_changed = False
-        old_post = None
-        if not new:
-            old_post = Post.objects.get(pk=self.pk)
-            if old_post.topic != self.topic:
-                topic_changed = True
+        old_topic_id = None
+        if not new and self.has_changed('topic_id'):
+            old_topic_id = self.get_old_value('topic_id')
+        topic_changed = old_topic_id is not None and old_topic_id != self.topic_id
 
         super(Post, self).save(*args, **kwargs)
 
-        # If post is topic head and moderated, moderate topic too
-        if self.topic.head == self and not self.on_moderation and self.topic.on_moderation:
-            self.topic.on_moderation = False
-
-        self.topic.update_counters()
-        self.topic.forum.update_counters()
+        if new or topic_changed:
+            self.topic.increment_counters(head=self, last_post=self)
+        elif self.updated and self.topic.last_post_id == self.pk:
+            # the edited last post brings topic and forum activity dates forward
+            apply_counters_delta(self.topic, last_post=self)
+            apply_counters_delta(self.topic.forum, last_post=self)
 
         if topic_changed:
-            old_post.topic.update_counters()
-            old_post.topic.forum.update_counters()
+            old_topic = Topic.objects.get(pk=old_topic_id)
+            old_topic.decrement_counters(last_post_id=self.pk)
+            if old_topic.head_id == self.pk:
+                old_topic.refresh_head()
+            self.topic.refresh_head()
+
+        # If post is topic head and moderated, moderate topic too
+        if self.topic.head_id == self.pk and not self.on_moderation and self.topic.on_moderation:
+            self.topic.on_moderation = False
+            Topic.objects.filter(pk=self.topic_id).update(on_moderation=False)
 
     def get_absolute_url(self):
         return reverse('pybb:post', kwargs={'pk': self.id})
 
+    def save_rendering(self):
+        rendered = super(Post, self).save_rendering()
+        if rendered:
+            # `body_text` is updated without sending post_save
+            _get_search_backend().index_posts([self])
+        return rendered
+
     def delete(self, *args, **kwargs):
         self_id = self.id
-        head_post_id = self.topic.posts.order_by('created', 'id')[0].id
-
-        if self_id == head_post_id:
+        if self_id == self.topic.head_id:
             self.topic.delete()
         else:
             super(Post, self).delete(*args, **kwargs)
-            self.topic.update_counters()
-            self.topic.forum.update_counters()
+            self.topic.decrement_counters(last_post_id=self_id)
 
     def get_parents(self):
         """
@@ -476,6 +693,96 @@ class ForumReadTracker(models.Model):
         unique_together = ('user', 'forum')
 
 
+class ForumReadState(models.Model):
+    """
+    Compact per user forum read tracking used by `pybb.read_state.WatermarkReadStateBackend`:
+    every topic updated before `watermark` is read, and `topics` maps the ids of the topics
+    read after `watermark` to their read date.
+    """
+    user = models.ForeignKey(get_user_model_path(), on_delete=models.CASCADE, blank=False, null=False)
+    forum = models.ForeignKey(Forum, on_delete=models.CASCADE, blank=False, null=False)
+    watermark = models.DateTimeField(_('Watermark'), blank=True, null=True)
+    topics = models.JSONField(_('Topics read after watermark'), default=dict, blank=True)
+
+    class Meta(object):
+        verbose_name = _('Forum read state')
+        verbose_name_plural = _('Forum read states')
+        unique_together = ('user', 'forum')
+
+    def get_topic_read_date(self, topic):
+        """
+        Returns the date up to which `topic` was read, or None if it was never read
+        """
+        read_date = self.topics.get(str(topic.id))
+        read_date = parse_datetime(read_date) if read_date else None
+        if self.watermark is not None and (read_date is None or read_date < self.watermark):
+            read_date = self.watermark
+        return read_date
+
+    def is_topic_read(self, topic):
+        read_date = self.get_topic_read_date(topic)
+        return read_date is not None and (topic.updated or topic.created) <= read_date
+
+    def is_forum_read(self, forum):
+        return self.watermark is not None and (forum.updated is None or forum.updated <= self.watermark)
+
+    def has_unread_topics(self):
+        """
+        Returns True if a topic of the forum is not read: a topic updated after the watermark which is not
+        one of the read topics, or a read topic updated since it was read. Both queries are bounded by the
+        number of read topics.
+        """
+        topics = Topic.objects.filter(forum_id=self.forum_id)
+        if self.watermark is not None:
+            topics = topics.filter(Q(updated__gt=self.watermark) |
+                                   Q(updated__isnull=True, created__gt=self.watermark))
+        read_ids = [int(topic_id) for topic_id in self.topics]
+        if topics.exclude(pk__in=read_ids).exists():
+            return True
+        for topic_id, updated, created in topics.filter(pk__in=read_ids).values_list('id', 'updated', 'created'):
+            if (updated or created) > parse_datetime(self.topics[str(topic_id)]):
+                return True
+        return False
+
+    def prune_topics(self, max_topics):
+        """
+        Forgets the topics read before the watermark and, above `max_topics` topics, the ones read first
+        (they become unread again)
+        """
+        read_dates = sorted(((parse_datetime(read_date), topic_id) for topic_id, read_date in self.topics.items()),
+                            reverse=True)
+        if self.watermark is not None:
+            read_dates = [(read_date, topic_id) for read_date, topic_id in read_dates if read_date > self.watermark]
+        self.topics = dict((topic_id, read_date.isoformat()) for read_date, topic_id in read_dates[:max_topics])
+
+
+class Notification(models.Model):
+    """
+    Outbox of subscription notifications waiting to be delivered
+    by the `pybb_send_notifications` management command
+    """
+    TYPE_NEW_POST = 1
+    TYPE_NEW_TOPIC = 2
+    TYPE_CHOICES = (
+        (TYPE_NEW_POST, _('New post for topic subscribers')),
+        (TYPE_NEW_TOPIC, _('New topic for forum subscribers')),
+    )
+
+    type = models.PositiveSmallIntegerField(_('Notification type'), choices=TYPE_CHOICES)
+    post = models.ForeignKey('Post', on_delete=models.CASCADE, related_name='+', blank=True, null=True)
+    topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='+', blank=True, null=True)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(_('Delivery attempts'), default=0)
+    next_attempt = models.DateTimeField(_('Next attempt'), blank=True, null=True, db_index=True)
+    # last delivered recipient pk per language, so a retry resumes after the delivered batches
+    progress = models.JSONField(_('Delivery progress'), default=dict, blank=True)
+
+    class Meta(object):
+        ordering = ['id']
+        verbose_name = _('Notification')
+        verbose_name_plural = _('Notifications')
+
+
 class PollAnswer(models.Model):
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name='poll_answers', verbose_name=_('Topic'))
     text = models.CharField(max_length=255, verbose_name=_('Text'))
@@ -512,40 +819,153 @@ class PollAnswerUser(models.Model):
         return '%s - %s' % (self.poll_answer.topic, self.user)
 
 
+def apply_counters_delta(instance, last_post=None, head=None, **deltas):
+    """
+    Shifts the counter fields of a forum or a topic by the given deltas
+    (eg: `post_count=1`) with one atomic `UPDATE ... SET field = field + delta`
+    and mirrors the new values on `instance`.
+
+    :param instance: forum or topic instance
+    :param last_post: post which becomes the instance's `last_post` and gives its activity
+                      date to `updated`, unless the instance has a more recent activity
+    :param head: post which becomes the topic's `head` if the topic has no head yet
+    :param deltas: counter fields and the value to add to them
+    """
+    values = dict((field, F(field) + delta) for field, delta in deltas.items() if delta)
+    if last_post is not None:
+        updated = last_post.updated or last_post.created
+        is_more_recent = Q(last_post__isnull=True) | Q(updated__isnull=True) | Q(updated__lte=updated)
+        values['updated'] = Case(When(is_more_recent, then=Value(updated)), default=F('updated'),
+                                 output_field=models.DateTimeField())
+        values['last_post'] = Case(When(is_more_recent, then=Value(last_post.pk)), default=F('last_post'),
+                                   output_field=models.IntegerField())
+    if head is not None and instance.head_id is None:
+        values['head'] = Coalesce(F('head'), Value(head.pk))
+    if not values:
+        return
+    type(instance).objects.filter(pk=instance.pk).update(**values)
+    for field, delta in deltas.items():
+        setattr(instance, field, getattr(instance, field) + delta)
+    if last_post is not None and (instance.last_post_id is None or instance.updated is None or
+                                  instance.updated <= updated):
+        instance.updated = updated
+        instance.last_post = last_post
+    if head is not None and instance.head_id is None:
+        instance.head = head
+    instance.reset_tracked_fields(*instance.counter_fields)
+    if isinstance(instance, Forum):
+        _invalidate_index()
+
+
+def _subquery_count(queryset, group_by):
+    counts = queryset.order_by().values(group_by).annotate(count=Count('pk')).values('count')
+    return Coalesce(Subquery(counts[:1]), Value(0))
+
+
+def _last_post_expressions(posts):
+    last_posts = posts.order_by('-created', '-id')
+    return {
+        'last_post': Subquery(last_posts.values('pk')[:1]),
+        'updated': Coalesce(
+            Subquery(last_posts.annotate(activity=Coalesce('updated', 'created')).values('activity')[:1]),
+            F('updated'),
+        ),
+    }
+
+
+def topic_counters_expressions():
+    """
+    Returns the `QuerySet.update()` keyword arguments which recompute topics'
+    `post_count`, `head`, `last_post` and `updated` fields with set-based subqueries:
+    `Topic.objects.filter(...).update(**topic_counters_expressions())`
+    """
+    posts = Post.objects.filter(topic=OuterRef('pk'))
+    expressions = _last_post_expressions(posts)
+    expressions['post_count'] = _subquery_count(posts, 'topic')
+    expressions['head'] = Subquery(posts.order_by('created', 'id').values('pk')[:1])
+    return expressions
+
+
+def forum_counters_expressions():
+    """
+    Returns the `QuerySet.update()` keyword arguments which recompute forums'
+    `topic_count`, `post_count`, `last_post` and `updated` fields with set-based subqueries:
+    `Forum.objects.filter(...).update(**forum_counters_expressions())`
+    """
+    posts = Post.objects.filter(topic__forum=OuterRef('pk'))
+    expressions = _last_post_expressions(posts)
+    expressions['topic_count'] = _subquery_count(Topic.objects.filter(forum=OuterRef('pk')), 'forum')
+    expressions['post_count'] = _subquery_count(posts, 'topic__forum')
+    return expressions
+
+
+def profile_counters_expressions():
+    """
+    Returns the `QuerySet.update()` keyword arguments which recompute profiles' `post_count`
+    with a set-based subquery: `get_pybb_profile_model().objects.filter(...).update(**profile_counters_expressions())`
+    """
+    user_field = get_pybb_profile_user_field()
+    return {'post_count': _subquery_count(Post.objects.filter(user=OuterRef(user_field)), 'user')}
+
+
+SLUG_PROBE_CHUNK_SIZE = 100
+
+
 def create_or_check_slug(instance, model, **extra_filters):
     """
-    returns a unique slug
+    returns a unique slug: the slug of the instance (or its slugified name), else this slug followed by
+    the next free numeric suffix, found with one query per suffix length. When the next suffix reaches
+    `PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT`, the lowest free suffix is used.
 
     :param instance : target instance
     :param model: needed as instance._meta.model is available since django 1.6
     :param extra_filters: filters needed for Forum and Topic for their unique_together field
     """
     initial_slug = instance.slug or slugify(instance.name)
-    count = -1
-    last_count_len = 0
-    slug_is_not_unique = True
-    while slug_is_not_unique:
-        count += 1
-
-        if count >= defaults.PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT:
-            msg = _('After %(limit)s attemps, there is not any unique slug value for "%(slug)s"')
-            raise ValidationError(msg % {'limit': defaults.PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT,
-                                         'slug': initial_slug})
-
-        count_len = len(str(count))
-
-        if last_count_len != count_len:
-            last_count_len = count_len
-            filters = {'slug__startswith': initial_slug[:(254-count_len)], }
-            if extra_filters:
-                filters.update(extra_filters)
-            objs = model.objects.filter(**filters).exclude(pk=instance.pk)
-            slug_list = [obj.slug for obj in objs]
-
-        if count == 0:
-            slug = initial_slug
-        else:
-            slug = '%s-%d' % (initial_slug[:(254-count_len)], count)
-        slug_is_not_unique = slug in slug_list
-
-    return slug
+    objs = model.objects.filter(**extra_filters).exclude(pk=instance.pk)
+    if not objs.filter(slug=initial_slug).exists():
+        return initial_slug
+
+    limit = defaults.PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT
+    count = 0
+    for count_len in range(1, len(str(max(limit - 1, 1))) + 1):
+        prefix = '%s-' % initial_slug[:(254-count_len)]
+        # suffixes of a same length are ordered like their numbers
+        slugs = objs.filter(slug__startswith=prefix, slug__regex=r'^%s[0-9]{%d}$' % (re.escape(prefix), count_len))
+        last_slug = slugs.order_by('-slug').values_list('slug', flat=True).first()
+        if last_slug is not None:
+            count = max(count, int(last_slug[len(prefix):]))
+    count += 1
+    if count < limit:
+        return '%s-%d' % (initial_slug[:(254-len(str(count)))], count)
+
+    # the highest suffixes are taken: look for a lower free one, checking the suffixes by chunks
+    for start in range(1, limit, SLUG_PROBE_CHUNK_SIZE):
+        candidates = ['%s-%d' % (initial_slug[:(254-len(str(count)))], count)
+                      for count in range(start, min(start + SLUG_PROBE_CHUNK_SIZE, limit))]
+        taken = set(objs.filter(slug__in=candidates).values_list('slug', flat=True))
+        for slug in candidates:
+            if slug not in taken:
+                return slug
+    msg = _('After %(limit)s attemps, there is not any unique slug value for "%(slug)s"')
+    raise ValidationError(msg % {'limit': limit, 'slug': initial_slug})
+
+
+def _get_forum_tree():
+    # pybb.forum_tree imports the models
+    from pybb.forum_tree import get_forum_tree
+    return get_forum_tree()
+
+
+def _get_search_backend():
+    # pybb.search imports the models
+    from pybb import search
+    return search.search_backend
+
+
+def _invalidate_index():
+    # pybb.index_cache imports the models
+    from pybb.index_cache import invalidate_index
+    invalidate_index()
+    # requests may have cached the forum index before the transaction was committed
+    transaction.on_commit(invalidate_index)
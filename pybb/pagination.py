@@ -0,0 +1,195 @@
+"""
+Keyset (seek) pagination for pybbm listings
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import InvalidPage
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from pybb import compat
+
+Paginator, pure_pagination = compat.get_paginator_class()
+
+
+class CountedPaginator(Paginator):
+    """
+    Paginator which does not count its objects when their number is already known (`known_count`,
+    e.g. a denormalized counter), or which caches their count at `cache_key` for `cache_timeout` seconds.
+    """
+
+    def __init__(self, object_list, per_page, known_count=None, cache_key=None, cache_timeout=0, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.known_count = known_count
+        self.cache_key = cache_key
+        self.cache_timeout = cache_timeout
+
+    @cached_property
+    def count(self):
+        if self.known_count is not None:
+            return self.known_count
+        if not (self.cache_key and self.cache_timeout):
+            return super(CountedPaginator, self).count
+        count = cache.get(self.cache_key)
+        if count is None:
+            count = super(CountedPaginator, self).count
+            cache.set(self.cache_key, count, self.cache_timeout)
+        return count
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value, datetime.timezone.utc)
+        delta = value - EPOCH
+        return str((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+    return str(value)
+
+
+def decode_value(field, value):
+    if value == '' and field.null:
+        return None
+    internal_type = field.get_internal_type()
+    if internal_type == 'BooleanField':
+        if value not in ('0', '1'):
+            raise ValueError(value)
+        return value == '1'
+    value = int(value)
+    if internal_type == 'DateTimeField':
+        value = EPOCH + datetime.timedelta(microseconds=value)
+        if settings.USE_TZ:
+            value = timezone.make_aware(value, datetime.timezone.utc)
+    return value
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a queryset by seeking rows after (or before) a cursor, the ordering key of a row,
+    instead of counting and offsetting rows. The queryset must be ordered by fields ending with a unique
+    one, e.g. `('-sticky', '-updated', '-id')`. Null values of nullable fields are ordered as the lowest ones.
+    """
+
+    def __init__(self, object_list, per_page):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.ordering = [(name.lstrip('-'), name.startswith('-')) for name in object_list.query.order_by]
+        if not self.ordering:
+            raise ValueError('KeysetPaginator requires an ordered queryset')
+        opts = object_list.model._meta
+        self.fields = [opts.pk if name == 'pk' else opts.get_field(name) for name, descending in self.ordering]
+        if any(field.null for field in self.fields):
+            # the same position of nulls on every database backend
+            self.object_list = object_list.order_by(*[
+                (F(name).desc(nulls_last=True) if descending else F(name).asc(nulls_first=True)) if field.null
+                else ('-%s' % name if descending else name)
+                for (name, descending), field in zip(self.ordering, self.fields)])
+
+    def get_cursor(self, obj):
+        """ returns the cursor of `obj`, an instance or a dict of the ordering fields values """
+        if isinstance(obj, dict):
+            values = [obj[name] for name, descending in self.ordering]
+        else:
+            values = [getattr(obj, field.attname) for field in self.fields]
+        return '.'.join(encode_value(value) for value in values)
+
+    def parse_cursor(self, cursor):
+        values = cursor.split('.')
+        if len(values) != len(self.fields):
+            raise InvalidCursor('Invalid cursor')
+        try:
+            return [decode_value(field, value) for field, value in zip(self.fields, values)]
+        except (ValueError, OverflowError):
+            raise InvalidCursor('Invalid cursor')
+
+    def seek(self, values, forward=True):
+        """ returns the Q object selecting the rows after (or before) the ordering key `values` """
+        # (a, b) > (x, y) is expanded to a > x OR (a = x AND b > y), nulls being lower than any value
+        query = None
+        for i in reversed(range(len(self.ordering))):
+            name, descending = self.ordering[i]
+            value = values[i]
+            if value is None:
+                equal = Q(**{'%s__isnull' % name: True})
+                # nothing is lower than null
+                condition = Q(**{'%s__isnull' % name: False}) if descending != forward else None
+            else:
+                equal = Q(**{name: value})
+                if descending == forward:
+                    condition = Q(**{'%s__lt' % name: value})
+                    if self.fields[i].null:
+                        condition |= Q(**{'%s__isnull' % name: True})
+                else:
+                    condition = Q(**{'%s__gt' % name: value})
+            if query is not None:
+                query = equal & query if condition is None else condition | (equal & query)
+            else:
+                query = condition if condition is not None else Q(pk__in=[])
+        return query
+
+    def page(self, after=None, before=None):
+        if before:
+            values = self.parse_cursor(before)
+            qs = self.object_list.filter(self.seek(values, forward=False)).reverse()
+            rows = list(qs[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            object_list = rows[:self.per_page][::-1]
+            has_next = True
+        else:
+            qs = self.object_list
+            if after:
+                qs = qs.filter(self.seek(self.parse_cursor(after)))
+            rows = list(qs[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            object_list = rows[:self.per_page]
+            has_previous = bool(after)
+        return KeysetPage(object_list, self, has_next, has_previous)
+
+
+class KeysetPage(object):
+    """ a page of `KeysetPaginator`, linked to its neighbours with `?after=` and `?before=` cursors """
+    keyset = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous and bool(object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_querystring(self):
+        return 'after=%s' % self.paginator.get_cursor(self.object_list[-1])
+
+    def previous_querystring(self):
+        return 'before=%s' % self.paginator.get_cursor(self.object_list[0])
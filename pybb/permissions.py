@@ -2,9 +2,76 @@
 Extensible permission system for pybbm
 """
 
+from contextlib import contextmanager
+
+from asgiref.local import Local
 from django.db.models import Q
+from django.utils.functional import cached_property
 
 from pybb import defaults, util
+from pybb.models import Forum
+
+_scope = Local()
+
+
+class PermissionContext(object):
+    """
+    Permission data of a user, each loaded at most once: results of `has_perm`, ids of the forums
+    moderated by the user and ids of the hidden forums (or in hidden categories).
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.perms = {}
+
+    def has_perm(self, perm):
+        if perm not in self.perms:
+            self.perms[perm] = self.user.has_perm(perm)
+        return self.perms[perm]
+
+    @cached_property
+    def moderated_forum_ids(self):
+        if not self.user.is_authenticated:
+            return frozenset()
+        return frozenset(Forum.objects.filter(moderators=self.user).values_list('pk', flat=True))
+
+    @cached_property
+    def hidden_forum_ids(self):
+        # not taken from the forum tree: it may be stale in other processes when the cache is not shared
+        return frozenset(Forum.objects.filter(Q(hidden=True) | Q(category__hidden=True)).values_list('pk', flat=True))
+
+
+def start_permission_scope():
+    """ starts sharing the permission contexts of users between permission checks """
+    _scope.contexts = {}
+
+
+def end_permission_scope():
+    _scope.contexts = None
+
+
+@contextmanager
+def permission_scope():
+    """ shares the permission contexts of users in the block (`PybbMiddleware` does it for each request) """
+    start_permission_scope()
+    try:
+        yield
+    finally:
+        end_permission_scope()
+
+
+def get_permission_context(user):
+    """
+    Returns the `PermissionContext` of `user`, shared in the current permission scope,
+    or a new one outside of a scope
+    """
+    contexts = getattr(_scope, 'contexts', None)
+    if contexts is None:
+        return PermissionContext(user)
+    key = user.pk if user.is_authenticated else None
+    if key not in contexts:
+        contexts[key] = PermissionContext(user)
+    return contexts[key]
 
 
 class DefaultPermissionHandler(object):
@@ -18,7 +85,34 @@ class DefaultPermissionHandler(object):
 
     To activate your custom permission handler, set `settings.PYBB_PERMISSION_HANDLER` to
     the full qualified name of your class, e.g. "`myapp.pybb_adapter.MyPermissionHandler`".
+
+    Permission data are read through `get_context(user)`, which loads them once per request.
+
+    `is_topic_filter_noop` and `is_post_filter_noop` tell the views when `filter_topics` and
+    `filter_posts` keep all the topics of a forum or the posts of a topic, so their denormalized
+    counters are used to paginate. They return False when the matching `filter_*` method is
+    overridden: override them too to keep this optimization.
     """
+
+    def _overrides(self, name):
+        return getattr(type(self), name) is not getattr(DefaultPermissionHandler, name)
+
+    def get_context(self, user):
+        """ returns the `PermissionContext` of `user` """
+        return get_permission_context(user)
+
+    def get_signature(self, user):
+        """
+        return a string shared by the users who see the same categories and forums listings,
+        used to cache the forum index. Override it if your handler filters them on other criteria,
+        e.g. return 'moderator:<ids of the moderated forums>' if moderators see more forums.
+        """
+        if user.is_superuser or user.is_staff:
+            return 'staff'
+        if not user.is_authenticated:
+            return 'anonymous'
+        return 'user'
+
     #
     # permission checks on categories
     #
@@ -47,7 +141,7 @@ class DefaultPermissionHandler(object):
             # FIXME: is_staff only allow user to access /admin but does not mean user has extra
             # permissions on pybb models. We should add pybb perm test
             return qs
-        return qs.filter(Q(hidden=False) & Q(category__hidden=False))
+        return qs.exclude(pk__in=self.get_context(user).hidden_forum_ids)
 
     def may_view_forum(self, user, forum):
         """ return True if user may view this forum, False if not """
@@ -55,13 +149,13 @@ class DefaultPermissionHandler(object):
             # FIXME: is_staff only allow user to access /admin but does not mean user has extra
             # permissions on pybb models. We should add pybb perm test
             return True
-        return forum.hidden == False and forum.category.hidden == False
+        return forum.id not in self.get_context(user).hidden_forum_ids
 
     def may_create_topic(self, user, forum):
         """ return True if `user` is allowed to create a new topic in `forum` """
         if user.is_superuser:
             return True
-        return user.has_perm('pybb.add_post')
+        return self.get_context(user).has_perm('pybb.add_post')
 
     #
     # permission checks on topics
@@ -70,17 +164,18 @@ class DefaultPermissionHandler(object):
         """ return a queryset with topics `user` is allowed to see """
         if user.is_superuser:
             return qs
-        if user.has_perm('pybb.change_topic'):
+        context = self.get_context(user)
+        if context.has_perm('pybb.change_topic'):
             # if I can edit, I can view
             return qs
         if not user.is_staff:
             # FIXME: is_staff only allow user to access /admin but does not mean user has extra
             # permissions on pybb models. We should add pybb perm test
-            qs = qs.filter(Q(forum__hidden=False) & Q(forum__category__hidden=False))
+            qs = qs.exclude(forum__in=context.hidden_forum_ids)
         if user.is_authenticated:
             qs = qs.filter(
                 # moderator can view on_moderation
-                Q(forum__moderators=user) |
+                Q(forum__in=context.moderated_forum_ids) |
                 # author can view on_moderation only if there is one post in the topic
                 # (mean that post is owned by author)
                 Q(user=user, post_count=1) |
@@ -89,7 +184,19 @@ class DefaultPermissionHandler(object):
             )
         else:
             qs = qs.filter(on_moderation=False)
-        return qs.distinct()
+        # forums are filtered by precomputed ids: no join multiplies rows, so no DISTINCT is needed
+        return qs
+
+    def is_topic_filter_noop(self, user, forum):
+        """ return True if `filter_topics` keeps all the topics of `forum` for `user` """
+        if self._overrides('filter_topics'):
+            return False
+        if user.is_superuser or self.get_context(user).has_perm('pybb.change_topic'):
+            return True
+        # without premoderation, new topics are not put on moderation
+        if defaults.PYBB_PREMODERATION:
+            return False
+        return user.is_staff or forum.id not in self.get_context(user).hidden_forum_ids
 
     def may_view_topic(self, user, topic):
         """ return True if user may view this topic, False otherwise """
@@ -107,14 +214,15 @@ class DefaultPermissionHandler(object):
                 return False
         # FIXME: is_staff only allow user to access /admin but does not mean user has extra
         # permissions on pybb models. We should add pybb perm test
-        return user.is_staff or (not topic.forum.hidden and not topic.forum.category.hidden)
+        return user.is_staff or topic.forum_id not in self.get_context(user).hidden_forum_ids
 
     def may_moderate_topic(self, user, topic):
         if user.is_superuser:
             return True
         if not user.is_authenticated:
             return False
-        return user.has_perm('pybb.change_topic') or user in topic.forum.moderators.all()
+        context = self.get_context(user)
+        return context.has_perm('pybb.change_topic') or topic.forum_id in context.moderated_forum_ids
 
     def may_close_topic(self, user, topic):
         """ return True if `user` may close `topic` """
@@ -151,7 +259,7 @@ class DefaultPermissionHandler(object):
             return False
         if not self.may_view_topic(user, topic):
             return False
-        if not user.has_perm('pybb.add_post'):
+        if not self.get_context(user).has_perm('pybb.add_post'):
             return False
         if topic.closed or topic.on_moderation:
             return self.may_moderate_topic(user, topic)
@@ -179,12 +287,13 @@ class DefaultPermissionHandler(object):
         # first filter by topic availability
         if user.is_superuser:
             return qs
-        if user.has_perm('pybb.change_post'):
+        context = self.get_context(user)
+        if context.has_perm('pybb.change_post'):
             # If I can edit all posts, I can view all posts
             return qs
         if not user.is_staff:
             # remove hidden forum/cats posts
-            query = Q(topic__forum__hidden=False, topic__forum__category__hidden=False)
+            query = ~Q(topic__forum__in=context.hidden_forum_ids)
         else:
             query = Q(pk__isnull=False)
         if defaults.PYBB_PREMODERATION:
@@ -192,8 +301,18 @@ class DefaultPermissionHandler(object):
             query = query & Q(on_moderation=False, topic__on_moderation=False)
         if user.is_authenticated:
             # cancel previous remove if it's my post, or if I'm moderator of the forum
-            query = query | Q(user=user) | Q(topic__forum__moderators=user)
-        return qs.filter(query).distinct()
+            query = query | Q(user=user) | Q(topic__forum__in=context.moderated_forum_ids)
+        return qs.filter(query)
+
+    def is_post_filter_noop(self, user, topic):
+        """ return True if `filter_posts` keeps all the posts of `topic` for `user` """
+        if self._overrides('filter_posts'):
+            return False
+        if user.is_superuser or self.get_context(user).has_perm('pybb.change_post'):
+            return True
+        if defaults.PYBB_PREMODERATION:
+            return False
+        return user.is_staff or topic.forum_id not in self.get_context(user).hidden_forum_ids
 
     def may_view_post(self, user, post):
         """ return True if `user` may view `post`, False otherwise """
@@ -206,19 +325,18 @@ class DefaultPermissionHandler(object):
             return False
         # FIXME: is_staff only allow user to access /admin but does not mean user has extra
         # permissions on pybb models. We should add pybb perm test
-        return user.is_staff or (not post.topic.forum.hidden and
-                                 not post.topic.forum.category.hidden)
+        return user.is_staff or post.topic.forum_id not in self.get_context(user).hidden_forum_ids
 
     def may_moderate_post(self, user, post):
         if user.is_superuser:
             return True
-        return user.has_perm('pybb.change_post') or self.may_moderate_topic(user, post.topic)
+        return self.get_context(user).has_perm('pybb.change_post') or self.may_moderate_topic(user, post.topic)
 
     def may_edit_post(self, user, post):
         """ return True if `user` may edit `post` """
         if user.is_superuser:
             return True
-        return post.user == user or self.may_moderate_post(user, post)
+        return post.user_id == user.pk or self.may_moderate_post(user, post)
 
     def may_delete_post(self, user, post):
         """ return True if `user` may delete `post` """
@@ -226,9 +344,10 @@ class DefaultPermissionHandler(object):
             return True
         if not user.is_authenticated:
             return False
-        return (defaults.PYBB_ALLOW_DELETE_OWN_POST and post.user == user) or \
-               user.has_perm('pybb.delete_post') or \
-               user in post.topic.forum.moderators.all()
+        context = self.get_context(user)
+        return (defaults.PYBB_ALLOW_DELETE_OWN_POST and post.user_id == user.pk) or \
+               context.has_perm('pybb.delete_post') or \
+               post.topic.forum_id in context.moderated_forum_ids
         # may_moderate_post does not mean that user is a moderator: a user who is not a moderator
         # may_moderate_post if he has change_post perms. For this reason, we need to check
         # if user is really a post's topic moderator.
@@ -238,7 +357,7 @@ class DefaultPermissionHandler(object):
         """ return True if `user` may use the admin interface to administrate the `post` """
         if user.is_superuser:
             return True
-        return user.is_staff and user.has_perm('pybb.change_post')
+        return user.is_staff and self.get_context(user).has_perm('pybb.change_post')
 
     #
     # permission checks on users
@@ -247,7 +366,7 @@ class DefaultPermissionHandler(object):
         """ return True if `user` may block `user_to_block` """
         if user.is_superuser:
             return True
-        return user.has_perm('pybb.block_users')
+        return self.get_context(user).has_perm('pybb.block_users')
 
     def may_attach_files(self, user):
         """
@@ -278,7 +397,7 @@ class DefaultPermissionHandler(object):
         """
         if user.is_superuser:
             return True
-        return user.has_perm('pybb.change_forum')
+        return self.get_context(user).has_perm('pybb.change_forum')
 
     def may_manage_moderators(self, user):
         """ return True if `user` may manage moderators"""
@@ -44,8 +44,17 @@ class PybbProfile(models.Model):
                                         help_text=_('Automatically subscribe to topics that you answer'),
                                         default=defaults.PYBB_DEFAULT_AUTOSUBSCRIBE)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(PybbProfile, cls).from_db(db, field_names, values)
+        instance._loaded_signature = instance.__dict__.get('signature')
+        return instance
+
     def save(self, *args, **kwargs):
-        self.signature_html = util._get_markup_formatter()(self.signature)
+        # the signature is rendered only when it changed
+        if self.signature != getattr(self, '_loaded_signature', None) or not self.signature:
+            self.signature_html = util._get_markup_formatter()(self.signature)
+            self._loaded_signature = self.signature
         super(PybbProfile, self).save(*args, **kwargs)
 
     @property
@@ -0,0 +1,89 @@
+"""
+Bulk deletion of the topics and posts of a user, e.g. a blocked spammer
+
+Rows are deleted by chunks without the per-row handlers of deletions, then the counters of the affected topics,
+forums and profiles are recomputed with a few set-based updates, instead of one recount per deleted post.
+"""
+
+from django.db import transaction
+
+from pybb import index_cache, search, util
+from pybb.models import Forum, Post, Topic, forum_counters_expressions, profile_counters_expressions, \
+    topic_counters_expressions
+from pybb.signals import muted_delete_handlers
+
+
+def chunks(ids, chunk_size):
+    ids = sorted(ids)
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i:i + chunk_size]
+
+
+def delete_post_chunks(posts, chunk_size, affected):
+    """ deletes `posts`, a queryset, by chunks and collects the ids of their topics, forums and authors """
+    count = 0
+    while True:
+        rows = list(posts.order_by('pk').values_list('pk', 'topic_id', 'topic__forum_id', 'user_id')[:chunk_size])
+        if not rows:
+            return count
+        post_ids = [row[0] for row in rows]
+        affected['topics'].update(row[1] for row in rows)
+        affected['forums'].update(row[2] for row in rows)
+        affected['users'].update(row[3] for row in rows)
+        with transaction.atomic():
+            Post.objects.filter(pk__in=post_ids).delete()
+        search.search_backend.remove_posts(post_ids)
+        count += len(post_ids)
+
+
+def delete_topic_chunks(topics, chunk_size, affected):
+    """ deletes `topics`, a queryset, with their posts by chunks, and collects the ids of the affected rows """
+    count = 0
+    while True:
+        topic_ids = list(topics.order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not topic_ids:
+            return count
+        posts = Post.objects.filter(topic__in=topic_ids)
+        affected['forums'].update(topics.filter(pk__in=topic_ids).values_list('forum_id', flat=True).distinct())
+        affected['users'].update(posts.values_list('user_id', flat=True).distinct())
+        post_ids = list(posts.values_list('pk', flat=True))
+        with transaction.atomic():
+            Topic.objects.filter(pk__in=topic_ids).delete()
+        search.search_backend.remove_posts(post_ids)
+        count += len(topic_ids)
+
+
+def purge_user(user, chunk_size=1000):
+    """
+    deletes the topics (with their replies) and the posts of `user` by chunks of `chunk_size` rows, then
+    repairs the counters of the affected topics, forums and profiles.
+    Returns the numbers of deleted topics and posts as a dict.
+    """
+    affected = {'topics': set(), 'forums': set(), 'users': set([user.pk])}
+    with muted_delete_handlers():
+        topic_count = delete_topic_chunks(Topic.objects.filter(user=user), chunk_size, affected)
+        post_count = delete_post_chunks(Post.objects.filter(user=user), chunk_size, affected)
+        # topics which only had posts of the user
+        for ids in chunks(affected['topics'], chunk_size):
+            empty_topics = Topic.objects.filter(pk__in=ids, posts__isnull=True)
+            topic_count += delete_topic_chunks(empty_topics, chunk_size, affected)
+
+    for ids in chunks(affected['topics'], chunk_size):
+        Topic.objects.filter(pk__in=ids).update(**topic_counters_expressions())
+    for ids in chunks(affected['forums'], chunk_size):
+        Forum.objects.filter(pk__in=ids).update(**forum_counters_expressions())
+    profile_model = util.get_pybb_profile_model()
+    user_lookup = '%s__in' % util.get_pybb_profile_user_field()
+    for ids in chunks(affected['users'], chunk_size):
+        profile_model.objects.filter(**{user_lookup: ids}).update(**profile_counters_expressions())
+    index_cache.invalidate_index()
+    return {'topics': topic_count, 'posts': post_count}
+
+
+def block_user(user, delete_posts=False, chunk_size=1000):
+    """ deactivates `user` and, with `delete_posts`, purges their topics and posts """
+    user.is_active = False
+    user.save()
+    if delete_posts:
+        return purge_user(user, chunk_size=chunk_size)
+    return {'topics': 0, 'posts': 0}
@@ -0,0 +1,248 @@
+"""
+Pluggable read state tracking for pybbm
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.timezone import now as tznow
+
+from pybb import defaults, util
+from pybb.compat import get_atomic_func
+from pybb.models import Forum, ForumReadState, ForumReadTracker, TopicReadTracker
+
+
+class BaseReadStateBackend(object):
+    """
+    Read state backends track which topics and forums users have read.
+
+    To activate a custom backend, set `settings.PYBB_READ_STATE_BACKEND` to the full
+    qualified name of a class implementing these methods.
+    """
+
+    def mark_topic_read(self, user, topic):
+        """ marks `topic` as read by `user` """
+        raise NotImplementedError
+
+    def mark_forums_read(self, user, forums):
+        """ marks all topics of `forums` as read by `user` """
+        raise NotImplementedError
+
+    def get_topic_read_date(self, user, topic):
+        """ returns the date up to which `user` read `topic`, or None if it was never read """
+        raise NotImplementedError
+
+    def annotate_topics(self, user, topics):
+        """ returns the list of `topics` with their `unread` attribute set for `user` """
+        raise NotImplementedError
+
+    def annotate_forums(self, user, forums):
+        """ returns the list of `forums` with their `unread` attribute set for `user` """
+        raise NotImplementedError
+
+    def is_topic_unread(self, user, topic):
+        """ returns True if `user` did not read the last post of `topic` """
+        if not user.is_authenticated:
+            return False
+        return self.annotate_topics(user, [topic])[0].unread
+
+
+class WatermarkReadStateBackend(BaseReadStateBackend):
+    """
+    Default read state backend. It stores one `ForumReadState` row per user and forum:
+    a watermark date before which all topics are read, and the sparse set of topics read
+    after it. Topics and forums listings are annotated with one query.
+    """
+
+    def get_states(self, user, forum_ids):
+        """ returns the read states of `user` for `forum_ids`, as a dict by forum id """
+        return dict((state.forum_id, state)
+                    for state in ForumReadState.objects.filter(user=user, forum__in=set(forum_ids)))
+
+    def get_locked_state(self, user, forum_id):
+        """ returns the read state of `user` for `forum_id`, created if missing, locked until the transaction ends """
+        states = ForumReadState.objects.select_for_update().filter(user=user, forum_id=forum_id)
+        state = states.first()
+        if state is None:
+            try:
+                with transaction.atomic():
+                    state = ForumReadState.objects.create(user=user, forum_id=forum_id)
+            except IntegrityError:
+                # created by a concurrent request
+                state = states.get()
+        return state
+
+    def mark_topic_read(self, user, topic):
+        state = self.get_states(user, [topic.forum_id]).get(topic.forum_id)
+        if state is not None and state.is_topic_read(topic):
+            return
+        with transaction.atomic():
+            # concurrent requests of the user (e.g. two tabs) add their topic to the state in turn
+            state = self.get_locked_state(user, topic.forum_id)
+            read_date = tznow()
+            state.topics[str(topic.id)] = read_date.isoformat()
+            state.prune_topics(defaults.PYBB_READ_STATE_MAX_TOPICS)
+            if not state.has_unread_topics():
+                # all topics are read: move the watermark and forget read topics
+                state.watermark = read_date
+                state.topics = {}
+            ForumReadState.objects.filter(pk=state.pk).update(watermark=state.watermark, topics=state.topics)
+
+    def mark_forums_read(self, user, forums):
+        forum_ids = set(forum.id for forum in forums)
+        read_date = tznow()
+        states = ForumReadState.objects.filter(user=user, forum__in=forum_ids)
+        states.update(watermark=read_date, topics={})
+        missing_ids = forum_ids - set(states.values_list('forum_id', flat=True))
+        ForumReadState.objects.bulk_create(
+            [ForumReadState(user=user, forum_id=forum_id, watermark=read_date) for forum_id in missing_ids],
+            ignore_conflicts=True,
+        )
+
+    def get_topic_read_date(self, user, topic):
+        state = self.get_states(user, [topic.forum_id]).get(topic.forum_id)
+        return state.get_topic_read_date(topic) if state else None
+
+    def annotate_topics(self, user, topics):
+        topic_list = list(topics)
+        if user.is_authenticated:
+            states = self.get_states(user, [topic.forum_id for topic in topic_list])
+            for topic in topic_list:
+                state = states.get(topic.forum_id)
+                topic.unread = state is None or not state.is_topic_read(topic)
+        return topic_list
+
+    def annotate_forums(self, user, forums):
+        forum_list = list(forums)
+        if user.is_authenticated:
+            states = self.get_states(user, [forum.id for forum in forum_list])
+            read_forums = {}
+            for forum in forum_list:
+                state = states.get(forum.id)
+                forum.unread = forum.topic_count > 0 and not (state and state.is_forum_read(forum))
+                if not forum.unread:
+                    read_forums[forum.id] = forum
+            if read_forums:
+                # a forum is unread if one of its child forums is unread
+                children = self.annotate_forums(user, Forum.objects.filter(parent__in=list(read_forums)))
+                for child in children:
+                    if child.unread:
+                        read_forums[child.parent_id].unread = True
+        return forum_list
+
+
+class TrackerReadStateBackend(BaseReadStateBackend):
+    """
+    Legacy read state backend storing one `ForumReadTracker` row per user and read forum,
+    and one `TopicReadTracker` row per user and topic read after the forum tracker.
+    """
+
+    def mark_topic_read(self, user, topic):
+        with get_atomic_func()():
+            self._mark_topic_read(user, topic)
+
+    def _mark_topic_read(self, user, topic):
+        try:
+            forum_mark = ForumReadTracker.objects.get(forum=topic.forum, user=user)
+        except ForumReadTracker.DoesNotExist:
+            forum_mark = None
+        if (forum_mark is None) or (forum_mark.time_stamp <= topic.updated):
+            topic_mark, topic_mark_new = TopicReadTracker.objects.get_or_create_tracker(topic=topic, user=user)
+            if not topic_mark_new:
+                # Bail early if we already read this thread.
+                if topic_mark.time_stamp >= topic.updated:
+                    return
+                topic_mark.save()  # update read time
+
+            # Check, if there are any unread topics in forum
+            readed_trackers = TopicReadTracker.objects.filter(
+                user=user, topic__forum=topic.forum, time_stamp__gte=F('topic__updated'))
+            unread = topic.forum.topics.exclude(topicreadtracker__in=readed_trackers)
+            if forum_mark is not None:
+                unread = unread.filter(updated__gte=forum_mark.time_stamp)
+
+            if not unread.exists():
+                # Clear all topic marks for this forum, mark forum as read
+                TopicReadTracker.objects.filter(user=user, topic__forum=topic.forum).delete()
+                forum_mark, forum_mark_new = ForumReadTracker.objects.get_or_create_tracker(
+                    forum=topic.forum, user=user)
+                if not forum_mark_new:
+                    forum_mark.save()  # update read time
+
+    def mark_forums_read(self, user, forums):
+        for forum in forums:
+            forum_mark, new = ForumReadTracker.objects.get_or_create_tracker(forum=forum, user=user)
+            forum_mark.save()
+        TopicReadTracker.objects.filter(user=user).delete()
+
+    def get_topic_read_date(self, user, topic):
+        read_dates = []
+        try:
+            read_dates.append(TopicReadTracker.objects.get(user=user, topic=topic).time_stamp)
+        except TopicReadTracker.DoesNotExist:
+            pass
+        try:
+            read_dates.append(ForumReadTracker.objects.get(user=user, forum=topic.forum).time_stamp)
+        except ForumReadTracker.DoesNotExist:
+            pass
+        return max(read_dates) if read_dates else None
+
+    def annotate_topics(self, user, topics):
+        topic_list = list(topics)
+
+        if user.is_authenticated:
+            for topic in topic_list:
+                topic.unread = True
+
+            forums_ids = [f.forum_id for f in topic_list]
+            forum_marks = dict([(m.forum_id, m.time_stamp)
+                                for m
+                                in ForumReadTracker.objects.filter(user=user, forum__in=forums_ids)])
+            if len(forum_marks):
+                for topic in topic_list:
+                    topic_updated = topic.updated or topic.created
+                    if topic.forum.id in forum_marks and topic_updated <= forum_marks[topic.forum.id]:
+                        topic.unread = False
+
+            qs = TopicReadTracker.objects.filter(user=user, topic__in=topic_list).select_related('topic')
+            topic_marks = list(qs)
+            topic_dict = dict(((topic.id, topic) for topic in topic_list))
+            for mark in topic_marks:
+                if topic_dict[mark.topic.id].updated <= mark.time_stamp:
+                    topic_dict[mark.topic.id].unread = False
+        return topic_list
+
+    def annotate_forums(self, user, forums):
+        forum_list = list(forums)
+        if user.is_authenticated:
+            for forum in forum_list:
+                forum.unread = forum.topic_count > 0
+            forum_marks = ForumReadTracker.objects.filter(
+                user=user,
+                forum__in=forum_list
+            ).select_related('forum')
+            forum_dict = dict(((forum.id, forum) for forum in forum_list))
+            for mark in forum_marks:
+                curr_forum = forum_dict[mark.forum.id]
+                if (curr_forum.updated is None) or (curr_forum.updated <= mark.time_stamp):
+                    if not any((f.unread for f in self.annotate_forums(user, curr_forum.child_forums.all()))):
+                        forum_dict[mark.forum.id].unread = False
+        return forum_list
+
+    def is_topic_unread(self, user, topic):
+        if not user.is_authenticated:
+            return False
+
+        last_topic_update = topic.updated or topic.created
+
+        unread = not ForumReadTracker.objects.filter(
+            forum=topic.forum,
+            user=user.id,
+            time_stamp__gte=last_topic_update).exists()
+        unread &= not TopicReadTracker.objects.filter(
+            topic=topic,
+            user=user.id,
+            time_stamp__gte=last_topic_update).exists()
+        return unread
+
+
+read_state = util.resolve_class(defaults.PYBB_READ_STATE_BACKEND)
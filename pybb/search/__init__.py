@@ -0,0 +1,24 @@
+"""
+Full-text search of posts for pybbm
+"""
+
+from django.db import connection
+
+from pybb import defaults, util
+
+DEFAULT_BACKENDS = {
+    'postgresql': 'pybb.search.backends.PostgresSearchBackend',
+    'sqlite': 'pybb.search.backends.SqliteSearchBackend',
+}
+
+
+def get_search_backend():
+    """
+    Returns the backend set by `PYBB_SEARCH_BACKEND`, or the default backend of the database vendor
+    """
+    path = defaults.PYBB_SEARCH_BACKEND or DEFAULT_BACKENDS.get(connection.vendor,
+                                                                'pybb.search.backends.DatabaseSearchBackend')
+    return util.resolve_class(path)
+
+
+search_backend = get_search_backend()
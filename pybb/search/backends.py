@@ -0,0 +1,180 @@
+"""
+Search backends of pybbm
+"""
+
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from pybb import defaults
+from pybb.models import Post
+
+
+class BaseSearchBackend(object):
+    """
+    Search backends index the text of posts and filter posts querysets by a search query.
+
+    To use a custom backend, set `settings.PYBB_SEARCH_BACKEND` to the full qualified name
+    of a class implementing these methods.
+    """
+
+    def setup(self):
+        """ creates the index storage if it does not exist """
+        pass
+
+    def index_posts(self, posts):
+        """ adds `posts` to the index, or updates them """
+        raise NotImplementedError
+
+    def remove_posts(self, post_ids):
+        """ removes the posts with `post_ids` from the index """
+        raise NotImplementedError
+
+    def clear(self):
+        """ removes all posts from the index """
+        raise NotImplementedError
+
+    def filter(self, queryset, query):
+        """ returns the posts of `queryset` which contain all the terms of `query` """
+        raise NotImplementedError
+
+    def get_document(self, post):
+        """ returns the indexed text of `post` """
+        return post.body_text
+
+    def get_terms(self, text):
+        return re.findall(r'\w+', text.lower())
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Fallback backend for databases without a dedicated backend: no index, each term
+    is looked up with a case-insensitive `LIKE` query.
+    """
+
+    def index_posts(self, posts):
+        pass
+
+    def remove_posts(self, post_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def filter(self, queryset, query):
+        terms = self.get_terms(query)
+        if not terms:
+            return queryset.none()
+        for term in terms:
+            queryset = queryset.filter(body_text__icontains=term)
+        return queryset
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    """
+    SQLite backend: the text of posts is stored in a FTS5 virtual table, by post id.
+    """
+    table = 'pybb_post_fts'
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body)' % self.table)
+
+    def index_posts(self, posts):
+        rows = [(post.pk, self.get_document(post)) for post in posts]
+        with connection.cursor() as cursor:
+            cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % self.table, [row[:1] for row in rows])
+            cursor.executemany('INSERT INTO %s (rowid, body) VALUES (%%s, %%s)' % self.table, rows)
+
+    def remove_posts(self, post_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % self.table, [(pk,) for pk in post_ids])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % self.table)
+
+    def filter(self, queryset, query):
+        terms = self.get_terms(query)
+        if not terms:
+            return queryset.none()
+        match = ' '.join('"%s"' % term for term in terms)
+        return queryset.filter(pk__in=RawSQL('SELECT rowid FROM %s WHERE %s MATCH %%s' % (self.table, self.table),
+                                             [match]))
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    PostgreSQL backend: a `tsvector` of each post is stored in a table with a GIN index.
+    The text search configuration is set by `PYBB_SEARCH_POSTGRES_CONFIG`.
+    """
+    table = 'pybb_post_search'
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS %s ('
+                'post_id bigint PRIMARY KEY REFERENCES %s (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+                'document tsvector NOT NULL)' % (self.table, connection.ops.quote_name(Post._meta.db_table)))
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s_document ON %s USING GIN (document)' % (
+                self.table, self.table))
+
+    def index_posts(self, posts):
+        rows = [(post.pk, defaults.PYBB_SEARCH_POSTGRES_CONFIG, self.get_document(post)) for post in posts]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO %s (post_id, document) VALUES (%%s, to_tsvector(%%s::regconfig, %%s)) '
+                'ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document' % self.table, rows)
+
+    def remove_posts(self, post_ids):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE post_id = ANY(%%s)' % self.table, [list(post_ids)])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE %s' % self.table)
+
+    def filter(self, queryset, query):
+        terms = self.get_terms(query)
+        if not terms:
+            return queryset.none()
+        return queryset.filter(pk__in=RawSQL(
+            'SELECT post_id FROM %s WHERE document @@ plainto_tsquery(%%s::regconfig, %%s)' % self.table,
+            [defaults.PYBB_SEARCH_POSTGRES_CONFIG, ' '.join(terms)]))
+
+
+class MemorySearchBackend(BaseSearchBackend):
+    """
+    Pure-Python inverted index kept in the memory of the process, for tests and development.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def index_posts(self, posts):
+        posts = list(posts)
+        self.remove_posts([post.pk for post in posts])
+        for post in posts:
+            terms = set(self.get_terms(self.get_document(post)))
+            self.documents[post.pk] = terms
+            for term in terms:
+                self.index.setdefault(term, set()).add(post.pk)
+
+    def remove_posts(self, post_ids):
+        for pk in post_ids:
+            for term in self.documents.pop(pk, ()):
+                self.index[term].discard(pk)
+                if not self.index[term]:
+                    del self.index[term]
+
+    def clear(self):
+        self.index = {}
+        self.documents = {}
+
+    def filter(self, queryset, query):
+        terms = set(self.get_terms(query))
+        if not terms:
+            return queryset.none()
+        post_ids = set.intersection(*[self.index.get(term, set()) for term in terms])
+        return queryset.filter(pk__in=post_ids)
@@ -0,0 +1,14 @@
+from django import forms
+from django.utils.translation import gettext_lazy as _
+
+from pybb import search
+
+
+class SearchForm(forms.Form):
+    q = forms.CharField(label=_('Search'), max_length=200)
+
+    def filter(self, qs):
+        """ returns the posts of `qs` matching the query, or no posts if the form is not valid """
+        if self.is_valid():
+            return search.search_backend.filter(qs, self.cleaned_data['q'])
+        return qs.none()
@@ -0,0 +1,45 @@
+"""
+Keeps the search index in sync with posts
+"""
+
+from pybb import search
+from pybb.models import Post
+
+INDEXED_FIELDS = frozenset(['body', 'body_text'])
+
+
+def post_saved(instance, **kwargs):
+    # signal triggered by loaddata command, ignore
+    if kwargs.get('raw', False):
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and not INDEXED_FIELDS.intersection(update_fields):
+        return
+    search.search_backend.index_posts([instance])
+
+
+def post_deleted(instance, **kwargs):
+    search.search_backend.remove_posts([instance.pk])
+
+
+def reindex(chunk_size=1000):
+    """
+    Rebuilds the search index from all posts, streamed by chunks of `chunk_size` posts.
+    Yields the number of indexed posts after each chunk.
+    """
+    backend = search.search_backend
+    backend.setup()
+    backend.clear()
+    count = 0
+    last_pk = None
+    while True:
+        posts = Post.objects.order_by('pk')
+        if last_pk is not None:
+            posts = posts.filter(pk__gt=last_pk)
+        posts = list(posts[:chunk_size])
+        if not posts:
+            break
+        backend.index_posts(posts)
+        count += len(posts)
+        last_pk = posts[-1].pk
+        yield count
@@ -0,0 +1,24 @@
+from django.views import generic
+
+from pybb import defaults
+from pybb.models import Post
+from pybb.permissions import perms
+from pybb.search.forms import SearchForm
+from pybb.views import PaginatorMixin
+
+
+class SearchView(PaginatorMixin, generic.ListView):
+    model = Post
+    paginate_by = defaults.PYBB_TOPIC_PAGE_SIZE
+    template_name = 'pybb/search.html'
+
+    def get_queryset(self):
+        self.form = SearchForm(self.request.GET or None)
+        qs = super(SearchView, self).get_queryset()
+        qs = self.form.filter(perms.filter_posts(self.request.user, qs))
+        return qs.select_related('topic', 'user').order_by('-created', '-id')
+
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        context['form'] = self.form
+        return context
@@ -1,15 +1,22 @@
+import functools
+from contextlib import contextmanager
+
+from asgiref.local import Local
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import F
 from django.db.models.signals import post_save, post_delete, pre_save
-from pybb.models import Post, Category, Topic, Forum, create_or_check_slug
-from pybb.subscription import notify_topic_subscribers, notify_forum_subscribers
-from pybb import util, defaults, compat
+from pybb.models import Post, Category, Topic, Forum, Notification, create_or_check_slug
+from pybb.subscription import enqueue_notification, subscribe_forum_subscribers
+from pybb.search import indexer
+from pybb import util, defaults, compat, forum_tree, index_cache, middleware
 from pybb.permissions import perms
 
 
 def topic_saved(instance, **kwargs):
     if kwargs['created']:
-        notify_forum_subscribers(instance)
+        subscribe_forum_subscribers(instance)
+        enqueue_notification(Notification.TYPE_NEW_TOPIC, topic=instance)
 
 def post_saved(instance, **kwargs):
     # signal triggered by loaddata command, ignore
@@ -23,29 +30,38 @@ def post_saved(instance, **kwargs):
 
     instance._post_saved_done = True
     if not defaults.PYBB_DISABLE_NOTIFICATIONS:
-        notify_topic_subscribers(instance)
+        enqueue_notification(Notification.TYPE_NEW_POST, post=instance)
 
         if util.get_pybb_profile(instance.user).autosubscribe and \
             perms.may_subscribe_topic(instance.user, instance.topic):
             instance.topic.subscribers.add(instance.user)
 
     if kwargs['created']:
-        profile = util.get_pybb_profile(instance.user)
-        profile.post_count = instance.user.posts.count()
-        profile.save()
+        shift_profile_post_count(instance, 1)
 
 
 def post_deleted(instance, **kwargs):
-    Profile = util.get_pybb_profile_model()
-    User = compat.get_user_model()
-    try:
-        profile = util.get_pybb_profile(instance.user)
-    except (Profile.DoesNotExist, User.DoesNotExist) as e:
-        #When we cascade delete an user, profile and posts are also deleted
-        pass
+    # when we cascade delete an user, profile and posts are also deleted: nothing is updated
+    shift_profile_post_count(instance, -1)
+
+
+def shift_profile_post_count(post, delta):
+    """
+    Adds `delta` to the post count of the profile of `post`'s author with an atomic update,
+    and mirrors it on the profile if it is already loaded.
+    """
+    util.get_pybb_profile_model().objects.filter(**{util.get_pybb_profile_user_field(): post.user_id}).update(
+        post_count=F('post_count') + delta)
+    if not Post._meta.get_field('user').is_cached(post):
+        return
+    user = post.user
+    if defaults.PYBB_PROFILE_RELATED_NAME:
+        if not user._meta.get_field(defaults.PYBB_PROFILE_RELATED_NAME).is_cached(user):
+            return
+        profile = getattr(user, defaults.PYBB_PROFILE_RELATED_NAME)
     else:
-        profile.post_count = instance.user.posts.count()
-        profile.save()
+        profile = user
+    profile.post_count += delta
 
 
 def user_saved(instance, created, **kwargs):
@@ -73,20 +89,47 @@ def user_saved(instance, created, **kwargs):
 
 def get_save_slug(extra_field=None):
     '''
-    Returns a function to add or make an instance's slug unique
+    Returns a function to add or make an instance's slug unique, when the instance is created or when
+    its name, slug or `extra_field` changed.
 
     :param extra_field: field needed in case of a unique_together.
     '''
-    if extra_field:
-        def save_slug(**kwargs):
-            extra_filters = {}
-            extra_filters[extra_field] = getattr(kwargs.get('instance'), extra_field)
-            kwargs['instance'].slug = create_or_check_slug(kwargs['instance'], kwargs['sender'], **extra_filters)
-    else:
-        def save_slug(**kwargs):
-            kwargs['instance'].slug = create_or_check_slug(kwargs['instance'], kwargs['sender'])
+    def save_slug(sender, instance, update_fields=None, **kwargs):
+        if update_fields is not None and 'slug' not in update_fields:
+            return
+        extra_filters = {}
+        if extra_field:
+            attname = sender._meta.get_field(extra_field).attname
+            extra_filters[attname] = getattr(instance, attname)
+        if instance.slug and not instance.has_changed('name', 'slug', *extra_filters):
+            return
+        instance.slug = create_or_check_slug(instance, sender, **extra_filters)
     return save_slug
 
+_muted = Local()
+
+
+@contextmanager
+def muted_delete_handlers():
+    """
+    skips the handlers of post and topic deletions (profile post counts, search index)
+    in the current thread, for bulk deletions which repair them afterwards
+    """
+    _muted.active = True
+    try:
+        yield
+    finally:
+        _muted.active = False
+
+
+def unless_muted(handler):
+    @functools.wraps(handler)
+    def wrapper(**kwargs):
+        if not getattr(_muted, 'active', False):
+            handler(**kwargs)
+    return wrapper
+
+
 pre_save_category_slug = get_save_slug()
 pre_save_forum_slug = get_save_slug('category')
 pre_save_topic_slug = get_save_slug('forum')
@@ -98,6 +141,16 @@ def setup():
     pre_save.connect(pre_save_topic_slug, sender=Topic)
     post_save.connect(topic_saved, sender=Topic)
     post_save.connect(post_saved, sender=Post)
-    post_delete.connect(post_deleted, sender=Post)
+    post_delete.connect(unless_muted(post_deleted), sender=Post, weak=False)
+    post_save.connect(indexer.post_saved, sender=Post)
+    post_delete.connect(unless_muted(indexer.post_deleted), sender=Post, weak=False)
+    for sender in (Category, Forum):
+        post_save.connect(forum_tree.invalidate_forum_tree, sender=sender)
+        post_delete.connect(forum_tree.invalidate_forum_tree, sender=sender)
+    # the counters and last posts of forums invalidate the forum index when they change
+    for sender in (Category, Forum):
+        post_save.connect(index_cache.invalidate_index, sender=sender)
+        post_delete.connect(index_cache.invalidate_index, sender=sender)
+    post_save.connect(middleware.profile_saved, sender=util.get_pybb_profile_model())
     if defaults.PYBB_AUTO_USER_PERMISSIONS:
         post_save.connect(user_saved, sender=compat.get_user_model())
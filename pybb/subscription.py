@@ -1,97 +1,353 @@
+import datetime
+import logging
+import re
 
 from django.conf import settings
 from django.urls import reverse
+from django.core.exceptions import FieldDoesNotExist
 from django.core.validators import validate_email
+from django.db import connection, transaction
+from django.db.models import Q, QuerySet
 from django.template import TemplateDoesNotExist
 from django.template.loader import render_to_string
 from django.utils import translation
+from django.utils.timezone import now as tznow
+from django.utils.html import escape
 from django.contrib.sites.models import Site
 
 from pybb import defaults, util, compat
-from pybb.models import ForumSubscription
+from pybb.models import ForumSubscription, Notification
 
 from pybb.compat import send_mass_html_mail
 
+logger = logging.getLogger(__name__)
 
-def notify_forum_subscribers(topic):
-    forum = topic.forum
-    qs = ForumSubscription.objects.exclude(user=topic.user).filter(forum=topic.forum)
-    notifications = qs.filter(type=ForumSubscription.TYPE_NOTIFY)
-    if notifications.count():
-        users = [n.user for n in notifications.select_related('user')]
-        context = {
-            'manage_url': reverse('pybb:forum_subscription', kwargs={'pk': forum.id}),
-            'topic': topic,
-        }
-        send_notification(users, 'forum_subscription_email', context)
-    subscriptions = qs.filter(type=ForumSubscription.TYPE_SUBSCRIBE)
+
+class BaseNotificationExecutor(object):
+    """
+    Executors receive the notifications to deliver when a post or a topic is created.
+    To use a custom executor (for example, one which delivers notifications from a task
+    queue with `deliver_notification`), set `settings.PYBB_NOTIFICATION_EXECUTOR` to the
+    full qualified name of your class.
+    """
+
+    def submit(self, notification):
+        """ `notification` is an unsaved `pybb.models.Notification` instance """
+        raise NotImplementedError
+
+
+class OutboxExecutor(BaseNotificationExecutor):
+    """
+    Default executor: stores the notification in the outbox table. The outbox is drained
+    by the `pybb_send_notifications` management command.
+    """
+
+    def submit(self, notification):
+        notification.save()
+
+
+class SynchronousExecutor(BaseNotificationExecutor):
+    """
+    Delivers the notification immediately, in the poster's request.
+    """
+
+    def submit(self, notification):
+        deliver_notification(notification)
+
+
+def enqueue_notification(notification_type, post=None, topic=None):
+    executor = util.resolve_class(defaults.PYBB_NOTIFICATION_EXECUTOR)
+    executor.submit(Notification(type=notification_type, post=post, topic=topic))
+
+
+def deliver_notification(notification, fail_silently=True):
+    """
+    Sends the emails of `notification`, skipping the recipients already recorded in its `progress`,
+    which is updated after each batch sent.
+    """
+    if notification.type == Notification.TYPE_NEW_POST:
+        notify_topic_subscribers(notification.post, fail_silently=fail_silently, progress=notification.progress)
+    elif notification.type == Notification.TYPE_NEW_TOPIC:
+        notify_forum_subscribers(notification.topic, fail_silently=fail_silently, progress=notification.progress)
+
+
+def claim_notifications(notifications, until):
+    """
+    Postpones the next attempt of `notifications` to `until`, and returns the ones claimed. A notification is
+    claimed only if its next attempt is still the one which was read, so a concurrent worker which read it too
+    does not deliver it again.
+    """
+    claimed = []
+    for notification in notifications:
+        if Notification.objects.filter(pk=notification.pk, next_attempt=notification.next_attempt).update(
+                next_attempt=until):
+            claimed.append(notification)
+    return claimed
+
+
+def process_outbox(limit=100):
+    """
+    Delivers at most `limit` due notifications from the outbox, and returns the number of processed
+    notifications. Notifications are claimed in a short transaction (their next attempt is postponed by
+    `PYBB_NOTIFICATION_CLAIM_TIMEOUT`, in case the worker dies), then delivered outside of it.
+    Delivered notifications are deleted, failed ones are retried after `PYBB_NOTIFICATION_RETRY_DELAY`
+    seconds, doubled at each attempt, and dropped after `PYBB_NOTIFICATION_MAX_ATTEMPTS` attempts.
+    A failed notification keeps the recipients already delivered in its `progress`, so its retry does not send
+    them the email again. Concurrent workers skip the rows locked by others when the database supports it.
+    """
+    now = tznow()
+    with transaction.atomic():
+        notifications = Notification.objects.filter(Q(next_attempt__isnull=True) | Q(next_attempt__lte=now),
+                                                    attempts__lt=defaults.PYBB_NOTIFICATION_MAX_ATTEMPTS)
+        claim_until = now + datetime.timedelta(seconds=defaults.PYBB_NOTIFICATION_CLAIM_TIMEOUT)
+        if connection.features.has_select_for_update_skip_locked:
+            notifications = list(notifications.select_for_update(skip_locked=True)[:limit])
+            Notification.objects.filter(pk__in=[notification.pk for notification in notifications]).update(
+                next_attempt=claim_until)
+        else:
+            # rows are not locked: claim each one only if no other worker did it since it was read
+            notifications = claim_notifications(notifications[:limit], claim_until)
+
+    done = []
+    for notification in notifications:
+        try:
+            deliver_notification(notification, fail_silently=False)
+        except Exception:
+            attempts = notification.attempts + 1
+            if attempts >= defaults.PYBB_NOTIFICATION_MAX_ATTEMPTS:
+                logger.exception('Delivery of notification %s failed %d times, dropping it', notification.pk, attempts)
+                done.append(notification.pk)
+                continue
+            logger.exception('Delivery of notification %s failed', notification.pk)
+            delay = defaults.PYBB_NOTIFICATION_RETRY_DELAY * 2 ** (attempts - 1)
+            Notification.objects.filter(pk=notification.pk).update(
+                attempts=attempts, next_attempt=tznow() + datetime.timedelta(seconds=delay),
+                progress=notification.progress)
+        else:
+            done.append(notification.pk)
+    Notification.objects.filter(pk__in=done).delete()
+    return len(notifications)
+
+
+def subscribe_forum_subscribers(topic):
+    """
+    Subscribes the users auto-subscribed to the topic's forum to the new topic
+    """
+    subscriptions = ForumSubscription.objects.exclude(user=topic.user).filter(
+        forum=topic.forum, type=ForumSubscription.TYPE_SUBSCRIBE)
     if subscriptions.count():
         users = (s.user for s in subscriptions.select_related('user'))
         topic.subscribers.add(*users)
 
 
-def notify_topic_subscribers(post):
+def notify_forum_subscribers(topic, fail_silently=True, progress=None):
+    forum = topic.forum
+    subscriptions = ForumSubscription.objects.filter(forum=forum, type=ForumSubscription.TYPE_NOTIFY)
+    users = compat.get_user_model().objects.filter(pk__in=subscriptions.values('user')).exclude(pk=topic.user_id)
+    context = {
+        'manage_url': reverse('pybb:forum_subscription', kwargs={'pk': forum.id}),
+        'topic': topic,
+    }
+    send_notification(users, 'forum_subscription_email', context, fail_silently=fail_silently, progress=progress)
+
+
+def notify_topic_subscribers(post, fail_silently=True, progress=None):
     topic = post.topic
-    users = topic.subscribers.exclude(pk=post.user.pk)
-    if users.count():
-        # Define constants for templates rendering
-        delete_url = reverse('pybb:delete_subscription', args=[post.topic.id])
-        current_site = Site.objects.get_current()
-        context = {
-            'post': post,
-            'post_url': 'http://%s%s' % (current_site, post.get_absolute_url()),
-            'topic_url': 'http://%s%s' % (current_site, post.topic.get_absolute_url()),
-            'delete_url_full': 'http://%s%s' % (current_site, delete_url),
-
-            # backward compat only. TODO Delete those vars in next major release
-            # and rename delete_url_full with delete_url for consistency
-            'site': current_site,
-            'delete_url': delete_url,
-        }
-        send_notification(users, 'subscription_email', context)
-
-
-def send_notification(users, template, context=None):
+    users = topic.subscribers.exclude(pk=post.user_id)
+    # Define constants for templates rendering
+    delete_url = reverse('pybb:delete_subscription', args=[post.topic.id])
+    current_site = Site.objects.get_current()
+    context = {
+        'post': post,
+        'post_url': 'http://%s%s' % (current_site, post.get_absolute_url()),
+        'topic_url': 'http://%s%s' % (current_site, post.topic.get_absolute_url()),
+        'delete_url_full': 'http://%s%s' % (current_site, delete_url),
+
+        # backward compat only. TODO Delete those vars in next major release
+        # and rename delete_url_full with delete_url for consistency
+        'site': current_site,
+        'delete_url': delete_url,
+    }
+    send_notification(users, 'subscription_email', context, fail_silently=fail_silently, progress=progress)
+
+
+class RecipientField(str):
+    """
+    Placeholder of a recipient's field, which renders differently when it is autoescaped
+    """
+    def __new__(cls, name):
+        field = super(RecipientField, cls).__new__(cls, '%sraw-%s@@' % (RecipientPlaceholder.marker, name))
+        field._name = name
+        return field
+
+    def __html__(self):
+        return '%shtml-%s@@' % (RecipientPlaceholder.marker, self._name)
+
+
+class RecipientPlaceholder(RecipientField):
+    """
+    Stands for the recipient as `user` in notification templates rendered once per language.
+    `PYBB_NOTIFICATION_RECIPIENT_FIELDS` attributes render as placeholders, which are then
+    replaced with the values of each recipient.
+    """
+    marker = '@@pybb-recipient-'
+    pattern = re.compile(r'%s(raw|html)-(\w+)@@' % re.escape(marker))
+
+    def __new__(cls):
+        return super(RecipientPlaceholder, cls).__new__(cls, '__str__')
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in defaults.PYBB_NOTIFICATION_RECIPIENT_FIELDS:
+            raise AttributeError(name)
+        return RecipientField(name)
+
+    @classmethod
+    def get_values(cls, user):
+        values = {'__str__': str(user)}
+        for field in defaults.PYBB_NOTIFICATION_RECIPIENT_FIELDS:
+            value = getattr(user, field, '')
+            values[field] = '%s' % (value() if callable(value) else value)
+        return values
+
+    @classmethod
+    def substitute(cls, text, values):
+        if text is None or cls.marker not in text:
+            return text
+
+        def replace(match):
+            value = values[match.group(2)]
+            return escape(value) if match.group(1) == 'html' else value
+        return cls.pattern.sub(replace, text)
+
+
+def iter_recipients(users, progress=None):
+    """
+    Iterates over `users`. Querysets are streamed by chunks of `PYBB_NOTIFICATION_MAIL_BATCH_SIZE`
+    users, with their profile joined and without the users who don't receive emails, language after
+    language and by pk, starting after the pk `progress` records for each language (if given).
+    """
+    if not isinstance(users, QuerySet):
+        for user in users:
+            yield user
+        return
+
+    related_name = defaults.PYBB_PROFILE_RELATED_NAME
+    prefix = '%s__' % related_name if related_name else ''
+    try:
+        util.get_pybb_profile_model()._meta.get_field('receive_emails')
+    except FieldDoesNotExist:
+        pass
+    else:
+        users = users.exclude(**{'%sreceive_emails' % prefix: False})
+    if related_name:
+        users = users.select_related(related_name)
+
+    # one language after another, so each language is activated once
+    languages = users.order_by().values_list('%slanguage' % prefix, flat=True).distinct()
+    for language in sorted(languages, key=lambda language: language or ''):
+        if language is None:
+            language_filter = Q(**{'%slanguage__isnull' % prefix: True})
+        else:
+            language_filter = Q(**{'%slanguage' % prefix: language})
+        chunk_qs = users.filter(language_filter).order_by('pk')
+        last_pk = (progress or {}).get(language or '')
+        while True:
+            chunk = chunk_qs if last_pk is None else chunk_qs.filter(pk__gt=last_pk)
+            chunk = list(chunk[:defaults.PYBB_NOTIFICATION_MAIL_BATCH_SIZE])
+            for user in chunk:
+                yield user
+            if len(chunk) < defaults.PYBB_NOTIFICATION_MAIL_BATCH_SIZE:
+                break
+            last_pk = chunk[-1].pk
+
+
+def render_notification(template, context):
+    """
+    Renders the subject, the text body and the optional HTML body of a notification email
+    """
+    subject = render_to_string('pybb/mail_templates/%s_subject.html' % template, context)
+    # Email subject *must not* contain newlines
+    subject = ''.join(subject.splitlines())
+    context['subject'] = subject
+
+    txt_message = render_to_string('pybb/mail_templates/%s_body.html' % template, context)
+    try:
+        html_message = render_to_string('pybb/mail_templates/%s_body-html.html' % template, context)
+    except TemplateDoesNotExist:
+        html_message = None
+    return subject, txt_message, html_message
+
+
+def send_notification(users, template, context=None, fail_silently=True, progress=None):
+    """
+    Sends the notification emails to `users` (an iterable or a queryset of users). Emails are sent
+    by batches of `PYBB_NOTIFICATION_MAIL_BATCH_SIZE`. Sending errors are raised unless `fail_silently`.
+
+    When `users` is a queryset and `progress` a dict, the recipients up to the pk it records for their
+    language are skipped, and it is updated after each batch sent.
+
+    Templates are rendered once per language with a `RecipientPlaceholder` as `user`, unless
+    `PYBB_NOTIFICATION_RENDER_PER_RECIPIENT` is set for templates which need more than
+    the recipient's fields.
+    """
     context = context or {}
     if not 'site' in context:
         context['site'] = Site.objects.get_current()
     old_lang = translation.get_language()
     from_email = settings.DEFAULT_FROM_EMAIL
+    per_recipient = defaults.PYBB_NOTIFICATION_RENDER_PER_RECIPIENT
+    if not per_recipient:
+        context['user'] = RecipientPlaceholder()
 
+    rendered = {}
     mails = []
-    for user in users:
-        if not getattr(util.get_pybb_profile(user), 'receive_emails', True):
-            continue
-
-        try:
-            validate_email(user.email)
-        except:
-            # Invalid email
-            continue
+    # recipients handled since the last batch sent
+    pending_progress = {}
+    try:
+        for user in iter_recipients(users, progress):
+            profile = util.get_pybb_profile(user)
+            pending_progress[profile.language or ''] = user.pk
+            if not getattr(profile, 'receive_emails', True):
+                continue
 
-        if user.email == '%s@example.com' % getattr(user, compat.get_username_field()):
-            continue
+            try:
+                validate_email(user.email)
+            except:
+                # Invalid email
+                continue
 
-        context['user'] = user
+            if user.email == '%s@example.com' % getattr(user, compat.get_username_field()):
+                continue
 
-        lang = util.get_pybb_profile(user).language or settings.LANGUAGE_CODE
-        translation.activate(lang)
+            lang = profile.language or settings.LANGUAGE_CODE
+            if per_recipient:
+                translation.activate(lang)
+                subject, txt_message, html_message = render_notification(template, dict(context, user=user))
+            else:
+                if lang not in rendered:
+                    translation.activate(lang)
+                    rendered[lang] = render_notification(template, dict(context))
+                subject, txt_message, html_message = rendered[lang]
+                values = RecipientPlaceholder.get_values(user)
+                subject = RecipientPlaceholder.substitute(subject, values)
+                txt_message = RecipientPlaceholder.substitute(txt_message, values)
+                html_message = RecipientPlaceholder.substitute(html_message, values)
 
-        subject = render_to_string('pybb/mail_templates/%s_subject.html' % template, context)
-        # Email subject *must not* contain newlines
-        subject = ''.join(subject.splitlines())
-        context['subject'] = subject
-
-        txt_message = render_to_string('pybb/mail_templates/%s_body.html' % template, context)
-        try:
-            html_message = render_to_string('pybb/mail_templates/%s_body-html.html' % template, context)
-        except TemplateDoesNotExist as e:
-            mails.append((subject, txt_message, from_email, [user.email]))
-        else:
-            mails.append((subject, txt_message, from_email, [user.email], html_message))
+            if html_message is None:
+                mails.append((subject, txt_message, from_email, [user.email]))
+            else:
+                mails.append((subject, txt_message, from_email, [user.email], html_message))
 
-    # Send mails
-    send_mass_html_mail(mails, fail_silently=True)
+            if len(mails) >= defaults.PYBB_NOTIFICATION_MAIL_BATCH_SIZE:
+                send_mass_html_mail(mails, fail_silently=fail_silently)
+                mails = []
+                if progress is not None:
+                    progress.update(pending_progress)
 
-    # Reactivate previous language
-    translation.activate(old_lang)
+        # Send mails
+        send_mass_html_mail(mails, fail_silently=fail_silently)
+        if progress is not None:
+            progress.update(pending_progress)
+    finally:
+        # Reactivate previous language
+        translation.activate(old_lang)
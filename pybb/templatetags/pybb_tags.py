@@ -6,7 +6,6 @@ import warnings
 
 import django
 from django import template
-from django.core.cache import cache
 from django.utils.safestring import mark_safe
 from django.utils.encoding import smart_str
 from django.utils.html import escape
@@ -15,9 +14,10 @@ from django.utils import dateformat
 from django.utils.timezone import timedelta
 from django.utils.timezone import now as tznow
 
-from pybb.models import TopicReadTracker, ForumReadTracker, PollAnswerUser, Topic, Post
+from pybb.models import PollAnswerUser, Topic, Post
 from pybb.permissions import perms
-from pybb import defaults, util, compat
+from pybb.read_state import read_state
+from pybb import defaults, topic_views, util, compat
 
 
 register = template.Library()
@@ -38,7 +38,14 @@ def pybb_time(parser, token):
 
 @register.assignment_tag(takes_context=True)
 def pybb_get_time(context, context_time):
-    return pybb_user_time(context_time, context['user'])
+    return pybb_user_time(context_time, context['user'], get_context_time_zone(context, context['user']))
+
+
+def get_context_time_zone(context, user):
+    """ returns the time zone of `user` cached by `PybbMiddleware` when `user` is the request user, else None """
+    request = context.get('request')
+    if request is not None and getattr(request, 'user', None) == user:
+        return getattr(request, 'pybb_time_zone', None)
 
 
 class PybbTimeNode(template.Node):
@@ -48,10 +55,10 @@ class PybbTimeNode(template.Node):
 
     def render(self, context):
         context_time = self.time.resolve(context)
-        return pybb_user_time(context_time, context['user'])
+        return pybb_user_time(context_time, context['user'], get_context_time_zone(context, context['user']))
 
 
-def pybb_user_time(context_time, user):
+def pybb_user_time(context_time, user, time_zone=None):
     delta = tznow() - context_time
     today = tznow().replace(hour=0, minute=0, second=0)
     yesterday = today - timedelta(days=1)
@@ -70,7 +77,9 @@ def pybb_user_time(context_time, user):
             tz1 = time.altzone
         else: # pragma: no cover
             tz1 = time.timezone
-        tz = tz1 + util.get_pybb_profile(user).time_zone * 60 * 60
+        if time_zone is None:
+            time_zone = util.get_pybb_profile(user).time_zone
+        tz = tz1 + time_zone * 60 * 60
         context_time = context_time + timedelta(seconds=tz)
     if today < context_time < tomorrow:
         return _('today, %s') % context_time.strftime('%H:%M')
@@ -123,20 +132,7 @@ def pybb_posted_by(post, user):
 
 @register.filter
 def pybb_is_topic_unread(topic, user):
-    if not user.is_authenticated:
-        return False
-
-    last_topic_update = topic.updated or topic.created
-
-    unread = not ForumReadTracker.objects.filter(
-        forum=topic.forum,
-        user=user.id,
-        time_stamp__gte=last_topic_update).exists()
-    unread &= not TopicReadTracker.objects.filter(
-        topic=topic,
-        user=user.id,
-        time_stamp__gte=last_topic_update).exists()
-    return unread
+    return read_state.is_topic_unread(user, topic)
 
 
 @register.filter
@@ -144,29 +140,7 @@ def pybb_topic_unread(topics, user):
     """
     Mark all topics in queryset/list with .unread for target user
     """
-    topic_list = list(topics)
-
-    if user.is_authenticated:
-        for topic in topic_list:
-            topic.unread = True
-
-        forums_ids = [f.forum_id for f in topic_list]
-        forum_marks = dict([(m.forum_id, m.time_stamp)
-                            for m
-                            in ForumReadTracker.objects.filter(user=user, forum__in=forums_ids)])
-        if len(forum_marks):
-            for topic in topic_list:
-                topic_updated = topic.updated or topic.created
-                if topic.forum.id in forum_marks and topic_updated <= forum_marks[topic.forum.id]:
-                    topic.unread = False
-
-        qs = TopicReadTracker.objects.filter(user=user, topic__in=topic_list).select_related('topic')
-        topic_marks = list(qs)
-        topic_dict = dict(((topic.id, topic) for topic in topic_list))
-        for mark in topic_marks:
-            if topic_dict[mark.topic.id].updated <= mark.time_stamp:
-                topic_dict[mark.topic.id].unread = False
-    return topic_list
+    return read_state.annotate_topics(user, topics)
 
 
 @register.filter
@@ -174,21 +148,7 @@ def pybb_forum_unread(forums, user):
     """
     Check if forum has unread messages.
     """
-    forum_list = list(forums)
-    if user.is_authenticated:
-        for forum in forum_list:
-            forum.unread = forum.topic_count > 0
-        forum_marks = ForumReadTracker.objects.filter(
-            user=user,
-            forum__in=forum_list
-        ).select_related('forum')
-        forum_dict = dict(((forum.id, forum) for forum in forum_list))
-        for mark in forum_marks:
-            curr_forum = forum_dict[mark.forum.id]
-            if (curr_forum.updated is None) or (curr_forum.updated <= mark.time_stamp):
-                if not any((f.unread for f in pybb_forum_unread(curr_forum.child_forums.all(), user))):
-                    forum_dict[mark.forum.id].unread = False
-    return forum_list
+    return read_state.annotate_forums(user, forums)
 
 
 @register.filter
@@ -253,15 +213,15 @@ def load_perms_filters():
             continue  # pragma: no cover - only methods are used to dynamically build templatetags
         if not method_name.startswith('may') and not method_name.startswith('filter'):
             continue  # pragma: no cover - only (may|filter)* methods are used to dynamically build templatetags
-        method_args = list(inspect.signature(method).parameters.keys())
+        method_args = inspect.getfullargspec(method).args
         args_count = len(method_args)
         if args_count not in (2, 3):
             continue  # pragma: no cover - only methods with 2 or 3 params
         if method_args[0] != 'self' or method_args[1] != 'user':
             continue  # pragma: no cover - only methods with self and user as first args
-        if len(inspect.getargspec(method).args) == 3:
+        if args_count == 3:
             register.filter('%s%s' % ('pybb_', method_name), partial(method_name, perms))
-        elif len(inspect.getargspec(method).args) == 2:
+        elif args_count == 2:
             register.filter('%s%s' % ('pybb_', method_name), partial_no_param(method_name, perms))
 load_perms_filters()
 
@@ -273,5 +233,15 @@ def check_app_installed(app_name):
 
 @register.filter
 def pybbm_calc_topic_views(topic):
-    cache_key = util.build_cache_key('anonymous_topic_views', topic_id=topic.id)
-    return topic.views + cache.get(cache_key, 0)
+    buffered_views = getattr(topic, 'buffered_views', None)
+    if buffered_views is None:
+        buffered_views = topic_views.get_buffered_views([topic.id]).get(topic.id, 0)
+    return topic.views + buffered_views
+
+
+@register.filter
+def pybbm_calc_topics_views(topics):
+    """
+    Reads the buffered views of all topics in queryset/list at once, for `pybbm_calc_topic_views`
+    """
+    return topic_views.annotate_topics(topics)
@@ -1,29 +1,45 @@
 
 import datetime, time
+import functools
 import logging
 import inspect
 import math
 import os
-from unittest import skip
+import smtplib
+from importlib import import_module
+from io import StringIO
+from unittest import mock, skip, skipUnless
+from django.apps import apps as django_apps
 from django.contrib.auth.models import AnonymousUser, Permission
 from django.conf import settings
 from django.core import mail
 from django.core.cache import cache
+from django.core.management import call_command
 
 from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.paginator import InvalidPage
 from django.db import connection
 from django.db.models import Q
+from django.db.models.signals import post_save
 from django.template import Context, Template
-from django.test import TestCase
+from django.template.loader import render_to_string
+from django.test import RequestFactory, TestCase
 from django.test.client import Client
-from django.test.utils import override_settings
-from django.utils import dateformat, timezone
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import dateformat, timezone, translation
 from django.utils.translation.trans_real import get_supported_language_variant
 
 
-from pybb import permissions, views as pybb_views
+from pybb import forum_tree, index_cache, middleware, permissions, purge, read_state, search, topic_views, views as pybb_views
+from pybb.forms import MovePostForm
+from pybb.markup import base as markup_base
+from pybb.pagination import KeysetPaginator
+from pybb.search import backends as search_backends
+from pybb.search.views import SearchView
+from pybb.subscription import claim_notifications, deliver_notification, process_outbox, send_notification
+from pybb.templatetags import pybb_tags
 from pybb.templatetags.pybb_tags import pybb_is_topic_unread, pybb_topic_unread, pybb_forum_unread, \
     pybb_get_latest_topics, pybb_get_latest_posts
 
@@ -39,8 +55,8 @@ except ImportError:  # pragma: no cover
     raise Exception('PyBB requires lxml for self testing')
 
 from pybb import defaults
-from pybb.models import Category, Forum, Topic, Post, PollAnswer, PollAnswerUser, \
-    TopicReadTracker, ForumReadTracker, ForumSubscription
+from pybb.models import Attachment, Category, Forum, Topic, Post, PollAnswer, PollAnswerUser, \
+    TopicReadTracker, ForumReadTracker, ForumReadState, ForumSubscription, Notification, create_or_check_slug
 
 if getattr(connection.features, 'supports_microsecond_precision', False):
     def sleep_only_if_required(s):
@@ -53,6 +69,24 @@ Profile = util.get_pybb_profile_model()
 __author__ = 'zeus'
 
 
+def use_read_state_backend(class_name):
+    """
+    run the decorated test with another read state backend. read_state.read_state is
+    already imported at import point, so we got to monkeypatch the modules
+    """
+    def decorator(test_func):
+        @functools.wraps(test_func)
+        def wrapper(*args, **kwargs):
+            default_backend = read_state.read_state
+            pybb_views.read_state = pybb_tags.read_state = util.resolve_class(class_name)
+            try:
+                return test_func(*args, **kwargs)
+            finally:
+                pybb_views.read_state = pybb_tags.read_state = default_backend
+        return wrapper
+    return decorator
+
+
 class SharedTestModule(object):
 
     def create_user(self):
@@ -121,8 +155,10 @@ class FeaturesTest(TestCase, SharedTestModule):
     def setUp(self):
         self.ORIG_PYBB_ENABLE_ANONYMOUS_POST = defaults.PYBB_ENABLE_ANONYMOUS_POST
         self.ORIG_PYBB_PREMODERATION = defaults.PYBB_PREMODERATION
+        self.ORIG_PYBB_NOTIFICATION_EXECUTOR = defaults.PYBB_NOTIFICATION_EXECUTOR
         defaults.PYBB_PREMODERATION = False
         defaults.PYBB_ENABLE_ANONYMOUS_POST = False
+        defaults.PYBB_NOTIFICATION_EXECUTOR = 'pybb.subscription.SynchronousExecutor'
         self.create_user()
         self.create_initial()
         mail.outbox = []
@@ -320,6 +356,7 @@ class FeaturesTest(TestCase, SharedTestModule):
         tree = html.fromstring(client.get(reverse('pybb:index')).content)
         self.assertFalse(tree.xpath('//a[@href="%s"]/parent::td[contains(@class,"unread")]' % f.get_absolute_url()))
 
+    @use_read_state_backend('pybb.read_state.TrackerReadStateBackend')
     def test_read_tracking_multi_user(self):
         topic_1 = self.topic
         topic_2 = Topic(name='topic_2', forum=self.forum, user=self.user)
@@ -406,6 +443,7 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(TopicReadTracker.objects.all().count(), 2)
         self.assertEqual(TopicReadTracker.objects.filter(user=user_bob).count(), 0)
 
+    @use_read_state_backend('pybb.read_state.TrackerReadStateBackend')
     def test_read_tracking_multi_forum(self):
         topic_1 = self.topic
         topic_2 = Topic(name='topic_2', forum=self.forum, user=self.user)
@@ -438,6 +476,7 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(ForumReadTracker.objects.filter(user=self.user).count(), 1)
         self.assertEqual(ForumReadTracker.objects.filter(user=self.user, forum=self.forum).count(), 1)
 
+    @use_read_state_backend('pybb.read_state.TrackerReadStateBackend')
     def test_read_tracker_after_posting(self):
         client = Client()
         client.login(username='zeus', password='zeus')
@@ -1370,6 +1409,7 @@ class FeaturesTest(TestCase, SharedTestModule):
     def tearDown(self):
         defaults.PYBB_ENABLE_ANONYMOUS_POST = self.ORIG_PYBB_ENABLE_ANONYMOUS_POST
         defaults.PYBB_PREMODERATION = self.ORIG_PYBB_PREMODERATION
+        defaults.PYBB_NOTIFICATION_EXECUTOR = self.ORIG_PYBB_NOTIFICATION_EXECUTOR
 
     def test_managing_forums(self):
         _attach_perms_class('pybb.tests.CustomPermissionHandler')
@@ -1498,7 +1538,7 @@ class MoveAndSplitPostTest(TestCase, SharedTestModule):
         self.assertEqual(forum_1.post_count, 0)
         self.assertEqual(forum_2.topic_count, 1)
         self.assertEqual(forum_2.post_count, 6)
-        self.assertEqual(topic.views, 8)  # +1 because topic is currently viewed by moderator
+        self.assertEqual(pybb_tags.pybbm_calc_topic_views(topic), 8)  # +1 because topic is currently viewed by moderator
 
     def test_split_posts_all(self):
         self.create_initial()
@@ -1561,7 +1601,7 @@ class MoveAndSplitPostTest(TestCase, SharedTestModule):
         self.assertEqual(topic_2.post_count, 4)
         self.assertEqual(forum_2.topic_count, 1)
         self.assertEqual(forum_2.post_count, 4)
-        self.assertEqual(topic_2.views, 1)  # +1 because topic is currently viewed by moderator
+        self.assertEqual(pybb_tags.pybbm_calc_topic_views(topic_2), 1)  # +1 because topic is currently viewed by moderator
 
     def test_split_posts_last(self):
         self.create_initial()
@@ -1653,14 +1693,1319 @@ class MoveAndSplitPostTest(TestCase, SharedTestModule):
         self.assertEqual(topic_2.last_post.pk, self.posts[3].pk)
 
 
+class CountersTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+
+    def assertCountersRepaired(self, *objs):
+        for obj in objs:
+            obj = type(obj).objects.get(pk=obj.pk)
+            counters = (obj.post_count, getattr(obj, 'topic_count', None), obj.updated,
+                        obj.last_post_id, getattr(obj, 'head_id', None))
+            obj.update_counters()
+            obj = type(obj).objects.get(pk=obj.pk)
+            self.assertEqual(counters, (obj.post_count, getattr(obj, 'topic_count', None), obj.updated,
+                                        obj.last_post_id, getattr(obj, 'head_id', None)))
+
+    def reply_queries(self):
+        topic = Topic.objects.get(pk=self.topic.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            self.create_post(topic=topic, user=self.user, body='reply')
+        return [q['sql'] for q in ctx.captured_queries]
+
+    def test_reply_cost_does_not_grow_with_forum_size(self):
+        small_forum_queries = self.reply_queries()
+        for i in range(20):
+            topic = Topic.objects.create(name='topic %s' % i, forum=self.forum, user=self.user)
+            for j in range(5):
+                self.create_post(topic=topic, user=self.user, body='post %s' % j)
+        large_forum_queries = self.reply_queries()
+        self.assertEqual(len(small_forum_queries), len(large_forum_queries))
+        # no more recount of the topic's posts and the forum's topics and posts
+        self.assertFalse([sql for sql in large_forum_queries if 'COUNT(' in sql.upper() and
+                          ('"pybb_post"."topic_id"' in sql or '"pybb_topic"."forum_id"' in sql)])
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual(forum.topic_count, 21)
+        self.assertEqual(forum.post_count, 103)
+        self.assertCountersRepaired(self.topic, forum)
+
+    def test_stale_instance_save_keeps_counters(self):
+        topic = Topic.objects.get(pk=self.topic.pk)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        # a reply comes in while a moderator sticks the topic
+        reply = self.create_post(topic=Topic.objects.get(pk=self.topic.pk), user=self.user, body='reply', _sleep=True)
+        topic.sticky = True
+        topic.save()
+        forum.headline = 'headline'
+        forum.save()
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertTrue(topic.sticky)
+        self.assertEqual((topic.post_count, topic.last_post_id, topic.updated), (2, reply.pk, reply.created))
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual(forum.headline, 'headline')
+        self.assertEqual((forum.post_count, forum.last_post_id, forum.updated), (2, reply.pk, reply.created))
+
+        # counters changed on the instance are still saved
+        topic.views = 10
+        topic.save()
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 10)
+
+    def test_counters_on_post_deletion(self):
+        post = self.create_post(topic=self.topic, user=self.user, body='two', _sleep=True)
+        self.assertEqual(self.topic.post_count, 2)
+        self.assertEqual(self.forum.updated, post.created)
+        post.delete()
+        topic = Topic.objects.get(pk=self.topic.pk)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual(topic.post_count, 1)
+        self.assertEqual(topic.updated, self.post.created)
+        self.assertEqual(forum.post_count, 1)
+        self.assertEqual(forum.updated, self.post.created)
+        self.assertCountersRepaired(topic, forum)
+
+    def test_counters_on_post_moved_to_other_topic(self):
+        forum_2 = Forum.objects.create(name='forum 2', category=self.category)
+        topic_2 = Topic.objects.create(name='topic 2', forum=forum_2, user=self.user)
+        self.create_post(topic=topic_2, user=self.user, body='head')
+        post = self.create_post(topic=self.topic, user=self.user, body='moved')
+        post = Post.objects.get(pk=post.pk)
+        post.topic = topic_2
+        post.save()
+        forum_1 = Forum.objects.get(pk=self.forum.pk)
+        forum_2 = Forum.objects.get(pk=forum_2.pk)
+        self.assertEqual((forum_1.topic_count, forum_1.post_count), (1, 1))
+        self.assertEqual((forum_2.topic_count, forum_2.post_count), (1, 2))
+        self.assertEqual(Topic.objects.get(pk=topic_2.pk).post_count, 2)
+        self.assertCountersRepaired(self.topic, topic_2, forum_1, forum_2)
+
+    def test_counters_on_topic_moved_to_other_forum(self):
+        self.create_post(topic=self.topic, user=self.user, body='two')
+        forum_2 = Forum.objects.create(name='forum 2', category=self.category)
+        topic = Topic.objects.get(pk=self.topic.pk)
+        topic.forum = forum_2
+        topic.save()
+        forum_1 = Forum.objects.get(pk=self.forum.pk)
+        forum_2 = Forum.objects.get(pk=forum_2.pk)
+        self.assertEqual((forum_1.topic_count, forum_1.post_count), (0, 0))
+        self.assertEqual((forum_2.topic_count, forum_2.post_count), (1, 2))
+        self.assertEqual(forum_2.updated, topic.updated)
+
+    def test_last_post_and_head(self):
+        self.assertEqual(self.topic.head, self.post)
+        self.assertEqual(self.topic.last_post, self.post)
+        post = self.create_post(topic=self.topic, user=self.user, body='two', _sleep=True)
+        topic = Topic.objects.get(pk=self.topic.pk)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((topic.head_id, topic.last_post_id, forum.last_post_id), (self.post.pk, post.pk, post.pk))
+        post.delete()
+        topic = Topic.objects.get(pk=self.topic.pk)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((topic.head_id, topic.last_post_id, forum.last_post_id), (self.post.pk,) * 3)
+        self.assertCountersRepaired(topic, forum)
+
+    def test_last_post_and_head_on_topic_split(self):
+        post = self.create_post(topic=self.topic, user=self.user, body='two', _sleep=True)
+        last = self.create_post(topic=self.topic, user=self.user, body='three', _sleep=True)
+        self.user.is_superuser = True
+        self.user.save()
+        form = MovePostForm(instance=post, user=self.user,
+                            data={'move_to': self.forum.pk, 'number': 1, 'name': 'splitted'})
+        self.assertTrue(form.is_valid())
+        form.save()
+        topic = Topic.objects.get(pk=self.topic.pk)
+        new_topic = Topic.objects.get(name='splitted')
+        self.assertEqual((topic.head_id, topic.last_post_id), (self.post.pk, self.post.pk))
+        self.assertEqual((new_topic.head_id, new_topic.last_post_id), (post.pk, last.pk))
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).last_post_id, last.pk)
+        self.assertCountersRepaired(topic, new_topic, self.forum)
+
+    def test_last_post_and_head_on_topic_moved_to_other_forum(self):
+        forum_2 = Forum.objects.create(name='forum 2', category=self.category)
+        topic = Topic.objects.get(pk=self.topic.pk)
+        topic.forum = forum_2
+        topic.save()
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).last_post_id, None)
+        self.assertEqual(Forum.objects.get(pk=forum_2.pk).last_post_id, self.post.pk)
+
+    def test_last_post_and_head_backfill(self):
+        migration = import_module('pybb.migrations.0009_last_post_head_fill')
+        post = self.create_post(topic=self.topic, user=self.user, body='two', _sleep=True)
+        Topic.objects.update(head=None, last_post=None)
+        Forum.objects.update(last_post=None)
+        migration.fill_last_post_head(django_apps, None)
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertEqual((topic.head_id, topic.last_post_id), (self.post.pk, post.pk))
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).last_post_id, post.pk)
+
+    def test_listing_queries_do_not_grow_with_forums_and_topics(self):
+        def listing_queries():
+            counts = []
+            for url in (reverse('pybb:index'), self.forum.get_absolute_url()):
+                with CaptureQueriesContext(connection) as ctx:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                counts.append(len(ctx.captured_queries))
+            return counts
+
+        self.login_client()
+        # the pages would count their topics or build the index again after they change
+        for setting in ('PYBB_PAGINATION_COUNT_CACHE_TIMEOUT', 'PYBB_INDEX_CACHE_TIMEOUT'):
+            patcher = mock.patch.object(defaults, setting, 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        listing_queries()  # warm up caches
+        few_queries = listing_queries()
+        for i in range(5):
+            forum = Forum.objects.create(name='forum %s' % i, category=self.category)
+            topic = Topic.objects.create(name='topic %s' % i, forum=self.forum, user=self.user)
+            self.create_post(topic=topic, user=self.user, body='post %s' % i)
+            self.create_post(topic=Topic.objects.create(name='topic', forum=forum, user=self.user),
+                             user=self.user, body='post')
+        # the forum tree snapshot is loaded again once after forums change
+        forum_tree.get_forum_tree()
+        self.assertEqual(few_queries, listing_queries())
+
+    def test_update_counters_command(self):
+        topic_2 = Topic.objects.create(name='topic 2', forum=self.forum, user=self.user)
+        post = self.create_post(topic=topic_2, user=self.user, body='one', _sleep=True)
+        Topic.objects.update(post_count=0, head=None, last_post=None)
+        Forum.objects.update(post_count=5, topic_count=0, last_post=None)
+
+        out = StringIO()
+        call_command('pybb_update_counters', dry_run=True, chunk_size=1, stdout=out)
+        self.assertIn('Topics with wrong counters: 2', out.getvalue())
+        self.assertIn('Forums with wrong counters: 1', out.getvalue())
+        self.assertIn('topic_count 0 -> 2', out.getvalue())
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).post_count, 5)
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('pybb_update_counters', chunk_size=1, stdout=out)
+        self.assertIn('(2/2 chunks)', out.getvalue())
+        # one aggregate and one UPDATE per chunk, whatever the number of posts
+        self.assertEqual(len([q for q in ctx.captured_queries
+                              if q['sql'].startswith(('UPDATE "pybb_topic"', 'UPDATE "pybb_forum"'))]), 3)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((forum.topic_count, forum.post_count, forum.last_post_id), (2, 2, post.pk))
+        self.assertEqual(Topic.objects.get(pk=topic_2.pk).last_post_id, post.pk)
+        self.assertCountersRepaired(self.topic, topic_2, forum)
+
+        out = StringIO()
+        call_command('pybb_update_counters', dry_run=True, stdout=out)
+        self.assertIn('Topics with wrong counters: 0', out.getvalue())
+        self.assertIn('Forums with wrong counters: 0', out.getvalue())
+
+    def test_profile_post_count(self):
+        profile_model = util.get_pybb_profile_model()
+        user = User.objects.get(pk=self.user.pk)
+        profile = util.get_pybb_profile(user)
+        with CaptureQueriesContext(connection) as ctx:
+            post = self.create_post(topic=self.topic, user=user, body='one more')
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT(' in q['sql']])
+        self.assertEqual(profile.post_count, 2)
+        self.assertEqual(profile_model.objects.get(pk=profile.pk).post_count, 2)
+        post.delete()
+        self.assertEqual(profile_model.objects.get(pk=profile.pk).post_count, 1)
+
+        profile_model.objects.update(post_count=7)
+        out = StringIO()
+        call_command('pybb_update_counters', dry_run=True, stdout=out)
+        self.assertIn('post_count 7 -> 1', out.getvalue())
+        call_command('pybb_update_counters', stdout=out)
+        self.assertEqual(profile_model.objects.get(pk=profile.pk).post_count, 1)
+
+
+class TrackedFieldsTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.other_forum = Forum.objects.create(name='other', category=self.category)
+
+    def test_save_without_move_does_not_select(self):
+        topic = Topic.objects.get(pk=self.topic.pk)
+        post = Post.objects.select_related('topic').get(pk=self.post.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            topic.sticky = True
+            topic.save()
+            post.on_moderation = False
+            post.save()
+        self.assertFalse([query for query in ctx.captured_queries
+                          if query['sql'].startswith('SELECT') and
+                          ('FROM "pybb_topic"' in query['sql'] or 'FROM "pybb_post"' in query['sql'])])
+        self.assertFalse(topic.has_changed('forum_id'))
+
+    def test_moves_are_detected(self):
+        topic = Topic.objects.get(pk=self.topic.pk)
+        topic.forum = self.other_forum
+        self.assertTrue(topic.has_changed('forum_id'))
+        self.assertEqual(topic.get_old_value('forum_id'), self.forum.pk)
+        topic.save()
+        self.assertFalse(topic.has_changed('forum_id'))
+        self.assertEqual((Forum.objects.get(pk=self.forum.pk).post_count,
+                          Forum.objects.get(pk=self.other_forum.pk).post_count), (0, 1))
+        # an instance which was not loaded reads the old value from the database
+        topic = Topic(pk=self.topic.pk, forum=self.forum, name=topic.name, user=self.user, slug=topic.slug,
+                      created=topic.created, post_count=topic.post_count, last_post=topic.last_post)
+        self.assertEqual(topic.get_old_value('forum_id'), self.other_forum.pk)
+        topic.save()
+        self.assertEqual((Forum.objects.get(pk=self.forum.pk).post_count,
+                          Forum.objects.get(pk=self.other_forum.pk).post_count), (1, 0))
+
+    def test_update_counters_bypasses_signals(self):
+        handler = mock.Mock()
+        post_save.connect(handler, sender=Topic)
+        post_save.connect(handler, sender=Forum)
+        self.addCleanup(post_save.disconnect, handler, sender=Topic)
+        self.addCleanup(post_save.disconnect, handler, sender=Forum)
+        Topic.objects.update(post_count=0)
+        topic = Topic.objects.get(pk=self.topic.pk)
+        topic.update_counters()
+        Forum.objects.get(pk=self.forum.pk).update_counters()
+        self.assertFalse(handler.called)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).post_count, 1)
+
+    def test_forum_tree_kept_on_counter_saves(self):
+        self.addCleanup(forum_tree.invalidate_forum_tree)
+        tree = forum_tree.get_forum_tree()
+        forum = Forum.objects.get(pk=self.forum.pk)
+        forum.headline = 'headline'
+        forum.save()
+        self.assertIs(forum_tree.get_forum_tree(), tree)
+        forum.hidden = True
+        forum.save()
+        self.assertIsNot(forum_tree.get_forum_tree(), tree)
+
+
+class PurgeTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.spammer = User.objects.create_user('spammer', 'spammer@localhost', 'spammer')
+        self.spam_topic = Topic.objects.create(name='spam', forum=self.forum, user=self.spammer)
+        for i in range(3):
+            self.create_post(topic=self.spam_topic, user=self.spammer, body='spam %d' % i)
+        self.reply = self.create_post(topic=self.spam_topic, user=self.user, body='reply to spam')
+        for i in range(3):
+            self.create_post(topic=self.topic, user=self.spammer, body='spam reply %d' % i)
+        self.other_forum = Forum.objects.create(name='other', category=self.category)
+        self.moved_topic = Topic.objects.create(name='moved', forum=self.other_forum, user=self.user)
+        self.create_post(topic=self.moved_topic, user=self.spammer, body='only spam')
+
+    def assertCountersRepaired(self, *objs):
+        for obj in objs:
+            obj = type(obj).objects.get(pk=obj.pk)
+            counters = (obj.post_count, getattr(obj, 'topic_count', None), obj.last_post_id)
+            obj.update_counters()
+            obj = type(obj).objects.get(pk=obj.pk)
+            self.assertEqual(counters, (obj.post_count, getattr(obj, 'topic_count', None), obj.last_post_id))
+
+    def test_purge_user(self):
+        counts = purge.purge_user(self.spammer, chunk_size=2)
+        self.assertEqual(counts, {'topics': 2, 'posts': 4})
+        self.assertFalse(Post.objects.filter(user=self.spammer).exists())
+        self.assertEqual(list(Topic.objects.all()), [self.topic])
+        self.assertCountersRepaired(self.topic, self.forum, self.other_forum)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).post_count, 1)
+        self.assertEqual((Forum.objects.get(pk=self.forum.pk).topic_count,
+                          Forum.objects.get(pk=self.other_forum.pk).topic_count), (1, 0))
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=self.spammer.pk)).post_count, 0)
+        self.assertEqual(util.get_pybb_profile(User.objects.get(pk=self.user.pk)).post_count, 1)
+
+    def test_queries_do_not_grow_with_posts(self):
+        def purge_queries(posts_count):
+            user = User.objects.create_user('spammer%d' % posts_count, 'spammer@localhost', 'spammer')
+            for i in range(posts_count):
+                self.create_post(topic=self.topic, user=user, body='spam %d' % i)
+            with CaptureQueriesContext(connection) as ctx:
+                purge.purge_user(user)
+            return len(ctx.captured_queries)
+
+        # no per-post recount of profiles, search index or caches
+        self.assertEqual(purge_queries(2), purge_queries(20))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('pybb_purge_user', 'spammer', '--chunk-size', '1', stdout=out)
+        self.assertIn('Successfully purged spammer: 2 topics and 4 posts deleted', out.getvalue())
+        self.assertFalse(User.objects.get(pk=self.spammer.pk).is_active)
+        self.assertFalse(Post.objects.filter(user=self.spammer).exists())
+
+
+class KeysetPaginationTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.patcher = mock.patch.object(defaults, 'PYBB_KEYSET_PAGINATION', True)
+        self.patcher.start()
+        self.addCleanup(self.patcher.stop)
+
+    def create_topics(self, count):
+        updated = timezone.now()
+        for i in range(count):
+            topic = Topic.objects.create(name='topic %d' % i, forum=self.forum, user=self.user)
+            # ties on `updated` are ordered by id
+            Topic.objects.filter(pk=topic.pk).update(updated=updated - datetime.timedelta(minutes=i // 3),
+                                                     sticky=(i % 7 == 0))
+
+    def test_walk_forward_and_backward(self):
+        self.create_topics(25)
+        qs = Topic.objects.order_by('-sticky', '-updated', '-id')
+        expected = list(qs.values_list('id', flat=True))
+        paginator = KeysetPaginator(qs, 10)
+        pages, page = [], paginator.page()
+        self.assertFalse(page.has_previous())
+        while True:
+            pages.append([topic.id for topic in page])
+            if not page.has_next():
+                break
+            page = paginator.page(after=page.next_querystring().split('=')[1])
+        self.assertEqual([len(ids) for ids in pages], [10, 10, 6])
+        self.assertEqual(sum(pages, []), expected)
+        page = paginator.page(before=page.previous_querystring().split('=')[1])
+        self.assertEqual([topic.id for topic in page], pages[1])
+        page = paginator.page(before=page.previous_querystring().split('=')[1])
+        self.assertEqual([topic.id for topic in page], pages[0])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_null_ordering_values(self):
+        self.create_topics(25)
+        Topic.objects.filter(pk__in=Topic.objects.order_by('id').values_list('id', flat=True)[5:15]).update(updated=None)
+        qs = Topic.objects.order_by('-sticky', '-updated', '-id')
+        paginator = KeysetPaginator(qs, 4)
+        expected = list(paginator.object_list.values_list('id', flat=True))
+        self.assertEqual(len(expected), 26)
+        pages, page = [], paginator.page()
+        while True:
+            pages.append([topic.id for topic in page])
+            if not page.has_next():
+                break
+            page = paginator.page(after=page.next_querystring().split('=')[1])
+        self.assertEqual(sum(pages, []), expected)
+        for previous_page in reversed(pages[:-1]):
+            page = paginator.page(before=page.previous_querystring().split('=')[1])
+            self.assertEqual([topic.id for topic in page], previous_page)
+
+        Topic.objects.filter(forum=self.forum).update(updated=None, sticky=False)
+        response = self.client.get(self.forum.get_absolute_url())
+        page = response.context['page_obj']
+        response = self.client.get('%s?%s' % (self.forum.get_absolute_url(), page.next_querystring()))
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_cursor(self):
+        paginator = KeysetPaginator(Topic.objects.order_by('-sticky', '-updated', '-id'), 10)
+        for cursor in ('1.2', 'x.1.2', '2.1.2'):
+            self.assertRaises(InvalidPage, paginator.page, after=cursor)
+        response = self.client.get(self.forum.get_absolute_url(), {'after': 'foo'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_forum_view_without_count_nor_offset(self):
+        self.create_topics(defaults.PYBB_FORUM_PAGE_SIZE * 2)
+        response = self.client.get(self.forum.get_absolute_url())
+        page = response.context['page_obj']
+        self.assertTrue(page.keyset)
+        self.assertContains(response, '?%s' % page.next_querystring())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('%s?%s' % (self.forum.get_absolute_url(), page.next_querystring()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['topic_list']), defaults.PYBB_FORUM_PAGE_SIZE)
+        for query in queries.captured_queries:
+            if 'FROM "pybb_topic"' in query['sql']:
+                self.assertNotIn('COUNT(', query['sql'])
+                self.assertNotIn('OFFSET', query['sql'])
+        # legacy links are still served
+        response = self.client.get(self.forum.get_absolute_url(), {'page': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(getattr(response.context['page_obj'], 'keyset', False))
+
+    def test_post_view_redirect(self):
+        posts = [self.post] + [self.create_post(topic=self.topic, user=self.user, body='post %d' % i)
+                               for i in range(defaults.PYBB_TOPIC_PAGE_SIZE + 3)]
+        target = posts[defaults.PYBB_TOPIC_PAGE_SIZE + 1]
+        self.login_client()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('pybb:post', kwargs={'pk': target.id}))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+        url = response['Location']
+        self.assertIn('?after=', url)
+        response = self.client.get(url.split('#')[0])
+        self.assertEqual(list(response.context['post_list'])[0], target)
+        response = self.client.get(reverse('pybb:post', kwargs={'pk': self.post.id}))
+        self.assertEqual(response['Location'], '%s#post-%d' % (self.topic.get_absolute_url(), self.post.id))
+
+
+class PaginationCountTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def count_queries(self, url, table):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len([query for query in queries.captured_queries
+                    if 'COUNT(' in query['sql'] and 'FROM "%s"' % table in query['sql']])
+
+    def test_unfiltered_listing_uses_counters(self):
+        self.user.is_superuser = True
+        self.user.save()
+        self.login_client()
+        self.assertEqual(self.count_queries(self.forum.get_absolute_url(), 'pybb_topic'), 0)
+        self.assertEqual(self.count_queries(self.topic.get_absolute_url(), 'pybb_post'), 0)
+        response = self.client.get(self.topic.get_absolute_url())
+        self.assertEqual(response.context['paginator'].count, 1)
+
+    def test_anonymous_listing_uses_counters(self):
+        # without premoderation, the permission filters keep all the topics and posts of a visible forum
+        self.assertEqual(self.count_queries(self.forum.get_absolute_url(), 'pybb_topic'), 0)
+        response = self.client.get(self.forum.get_absolute_url())
+        self.assertEqual(response.context['paginator'].count, 1)
+        self.assertTrue(permissions.perms.is_post_filter_noop(AnonymousUser(), self.topic))
+        with mock.patch.object(defaults, 'PYBB_PREMODERATION', lambda user, body: True):
+            self.assertFalse(permissions.perms.is_topic_filter_noop(AnonymousUser(), self.forum))
+            self.assertFalse(permissions.perms.is_post_filter_noop(AnonymousUser(), self.topic))
+        self.forum.hidden = True
+        self.forum.save()
+        self.assertFalse(permissions.perms.is_topic_filter_noop(AnonymousUser(), self.forum))
+
+    @mock.patch.object(defaults, 'PYBB_PREMODERATION', lambda user, body: True)
+    def test_filtered_listing_count_is_cached(self):
+        user = User.objects.create_user('other', 'other@localhost', 'other')
+        self.login_client('other', 'other')
+        self.assertEqual(self.count_queries(self.forum.get_absolute_url(), 'pybb_topic'), 1)
+        self.assertEqual(self.count_queries(self.forum.get_absolute_url(), 'pybb_topic'), 0)
+        self.assertEqual(self.count_queries(self.topic.get_absolute_url(), 'pybb_post'), 1)
+        self.assertEqual(self.count_queries(self.topic.get_absolute_url(), 'pybb_post'), 0)
+        # a new post changes the counter, hence the cache key
+        self.create_post(topic=self.topic, user=user, body='reply')
+        self.assertEqual(self.count_queries(self.topic.get_absolute_url(), 'pybb_post'), 1)
+        response = self.client.get(self.topic.get_absolute_url())
+        self.assertEqual(response.context['paginator'].count, 2)
+
+    @mock.patch.object(defaults, 'PYBB_PREMODERATION', lambda user, body: True)
+    def test_cache_disabled(self):
+        User.objects.create_user('other', 'other@localhost', 'other')
+        self.login_client('other', 'other')
+        with mock.patch.object(defaults, 'PYBB_PAGINATION_COUNT_CACHE_TIMEOUT', 0):
+            self.assertEqual(self.count_queries(self.forum.get_absolute_url(), 'pybb_topic'), 1)
+            self.assertEqual(self.count_queries(self.forum.get_absolute_url(), 'pybb_topic'), 1)
+
+
+class ReadStateTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+        self.create_post(topic=self.topic_2, user=self.user, body='two', _sleep=True)
+        self.forum_2 = Forum.objects.create(name='forum_2', category=self.category)
+        self.topic_3 = Topic.objects.create(name='topic_3', forum=self.forum_2, user=self.user)
+        self.create_post(topic=self.topic_3, user=self.user, body='three', _sleep=True)
+        self.ann = User.objects.create_user('ann', 'ann@localhost', 'ann')
+        self.client.login(username='ann', password='ann')
+
+    def get_topics(self):
+        return list(Topic.objects.filter(pk__in=[self.topic.pk, self.topic_2.pk, self.topic_3.pk]).order_by('pk'))
+
+    def test_watermark_and_read_topics(self):
+        self.client.get(self.topic.get_absolute_url())
+        state = ForumReadState.objects.get(user=self.ann, forum=self.forum)
+        self.assertIsNone(state.watermark)
+        self.assertEqual(list(state.topics), [str(self.topic.pk)])
+        self.assertEqual([t.unread for t in pybb_topic_unread(self.get_topics(), self.ann)], [False, True, True])
+
+        # every topic of the forum is read: the watermark moves and read topics are forgotten
+        self.client.get(self.topic_2.get_absolute_url())
+        state = ForumReadState.objects.get(user=self.ann, forum=self.forum)
+        self.assertIsNotNone(state.watermark)
+        self.assertEqual(state.topics, {})
+        self.assertEqual(ForumReadState.objects.count(), 1)
+        self.assertEqual([t.unread for t in pybb_topic_unread(self.get_topics(), self.ann)], [False, False, True])
+        self.assertEqual([f.unread for f in pybb_forum_unread([self.forum, self.forum_2], self.ann)],
+                         [False, True])
+
+        post = self.create_post(topic=self.topic_2, user=self.user, body='new', _sleep=True)
+        self.assertEqual([t.unread for t in pybb_topic_unread(self.get_topics(), self.ann)], [False, True, True])
+        self.assertTrue(pybb_is_topic_unread(Topic.objects.get(pk=self.topic_2.pk), self.ann))
+        self.assertEqual(read_state.read_state.get_topic_read_date(self.ann, self.topic_2), state.watermark)
+        response = self.client.get(self.topic_2.get_absolute_url() + '?first-unread=1')
+        self.assertRedirects(response, post.get_absolute_url(), fetch_redirect_response=False)
+
+    def test_mark_all_as_read(self):
+        self.client.get(self.topic.get_absolute_url())
+        self.client.get(reverse('pybb:mark_all_as_read'))
+        self.assertEqual(ForumReadState.objects.filter(user=self.ann, topics={}).count(), 2)
+        self.assertEqual([t.unread for t in pybb_topic_unread(self.get_topics(), self.ann)], [False, False, False])
+        self.assertEqual([f.unread for f in pybb_forum_unread([self.forum, self.forum_2], self.ann)],
+                         [False, False])
+
+    def test_unread_checks_query_count(self):
+        self.client.get(self.topic.get_absolute_url())
+        topics = self.get_topics()
+        with self.assertNumQueries(1):
+            pybb_topic_unread(topics, self.ann)
+        self.client.get(reverse('pybb:mark_all_as_read'))
+        forums = list(Forum.objects.all())
+        # read states of the forums, then of the child forums of the read ones
+        with self.assertNumQueries(2):
+            pybb_forum_unread(forums, self.ann)
+
+    def test_many_read_topics(self):
+        topics = Topic.objects.bulk_create([Topic(name='topic %d' % i, forum=self.forum, user=self.user, slug='t%d' % i,
+                                                  created=self.topic.created, updated=self.topic.updated)
+                                            for i in range(1100)])
+        backend = read_state.WatermarkReadStateBackend()
+        with mock.patch.object(defaults, 'PYBB_READ_STATE_MAX_TOPICS', 1000):
+            for topic in topics:
+                backend.mark_topic_read(self.ann, topic)
+        state = ForumReadState.objects.get(user=self.ann, forum=self.forum)
+        self.assertIsNone(state.watermark)
+        # the topics read first are forgotten
+        self.assertEqual(len(state.topics), 1000)
+        self.assertNotIn(str(topics[0].pk), state.topics)
+        self.assertIn(str(topics[-1].pk), state.topics)
+
+    def test_mark_topic_read_queries_do_not_grow_with_forum(self):
+        backend = read_state.WatermarkReadStateBackend()
+
+        def mark_queries(topic):
+            with CaptureQueriesContext(connection) as ctx:
+                backend.mark_topic_read(self.ann, Topic.objects.get(pk=topic.pk))
+            return len(ctx.captured_queries)
+
+        unread_topic = Topic.objects.create(name='unread', forum=self.forum, user=self.user)
+        mark_queries(self.topic)
+        small_forum_queries = mark_queries(self.topic_2)
+        Topic.objects.bulk_create([Topic(name='topic %d' % i, forum=self.forum, user=self.user, slug='t%d' % i,
+                                         created=self.topic.created, updated=self.topic.updated)
+                                   for i in range(50)])
+        self.assertEqual(mark_queries(unread_topic), small_forum_queries)
+        self.assertEqual(len(ForumReadState.objects.get(user=self.ann, forum=self.forum).topics), 3)
+
+    def test_read_topics_before_watermark_are_forgotten(self):
+        backend = read_state.WatermarkReadStateBackend()
+        backend.mark_topic_read(self.ann, self.topic)
+        state = ForumReadState.objects.get(user=self.ann, forum=self.forum)
+        # another tab read the forum meanwhile
+        ForumReadState.objects.filter(pk=state.pk).update(watermark=timezone.now())
+        new_topics = []
+        for name in ('new', 'new_2'):
+            topic = Topic.objects.create(name=name, forum=self.forum, user=self.user)
+            self.create_post(topic=topic, user=self.user, body=name, _sleep=True)
+            new_topics.append(Topic.objects.get(pk=topic.pk))
+        backend.mark_topic_read(self.ann, new_topics[0])
+        state = ForumReadState.objects.get(pk=state.pk)
+        self.assertEqual(list(state.topics), [str(new_topics[0].pk)])
+        self.assertEqual([t.unread for t in pybb_topic_unread(new_topics, self.ann)], [False, True])
+
+    def test_read_trackers_conversion(self):
+        migration = import_module('pybb.migrations.0011_forumreadstate_fill')
+        forum_mark = ForumReadTracker.objects.create(user=self.ann, forum=self.forum)
+        ForumReadTracker.objects.filter(pk=forum_mark.pk).update(time_stamp=self.topic.updated)
+        TopicReadTracker.objects.create(user=self.ann, topic=self.topic_2)
+        TopicReadTracker.objects.create(user=self.ann, topic=self.topic_3)
+        migration.fill_read_states(django_apps, None)
+        self.assertEqual([t.unread for t in pybb_topic_unread(self.get_topics(), self.ann)], [False, False, False])
+        self.assertEqual(ForumReadState.objects.get(forum=self.forum).watermark, self.topic.updated)
+
+
+class NotificationOutboxTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.ORIG_PYBB_DISABLE_NOTIFICATIONS = defaults.PYBB_DISABLE_NOTIFICATIONS
+        self.ORIG_PYBB_NOTIFICATION_EXECUTOR = defaults.PYBB_NOTIFICATION_EXECUTOR
+        defaults.PYBB_DISABLE_NOTIFICATIONS = False
+        defaults.PYBB_NOTIFICATION_EXECUTOR = 'pybb.subscription.OutboxExecutor'
+        self.create_user()
+        self.create_initial()
+        self.subscribers = []
+        for i, language in enumerate(['en', 'en', 'fr']):
+            user = User.objects.create_user('user%s' % i, 'user%s@someserver.com' % i, 'user%s' % i)
+            profile = util.get_pybb_profile(user)
+            profile.language = language
+            profile.save()
+            self.topic.subscribers.add(user)
+            self.subscribers.append(user)
+        Notification.objects.all().delete()
+        mail.outbox = []
+
+    def tearDown(self):
+        defaults.PYBB_DISABLE_NOTIFICATIONS = self.ORIG_PYBB_DISABLE_NOTIFICATIONS
+        defaults.PYBB_NOTIFICATION_EXECUTOR = self.ORIG_PYBB_NOTIFICATION_EXECUTOR
+
+    def test_post_only_enqueues_a_notification(self):
+        post = self.create_post(topic=self.topic, user=self.user, body='reply')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(list(Notification.objects.values_list('type', 'post')),
+                         [(Notification.TYPE_NEW_POST, post.pk)])
+
+        out = StringIO()
+        with mock.patch('pybb.subscription.render_to_string', wraps=render_to_string) as render:
+            call_command('pybb_send_notifications', stdout=out)
+        self.assertIn('1 notifications processed', out.getvalue())
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(u.email for u in self.subscribers))
+        self.assertTrue(all(post.get_absolute_url() in m.body for m in mail.outbox))
+        # subject, text and html bodies rendered once per language
+        self.assertEqual(render.call_count, 6)
+        subjects = dict((m.to[0], m.subject) for m in mail.outbox)
+        self.assertEqual(subjects[self.subscribers[0].email], subjects[self.subscribers[1].email])
+        self.assertNotEqual(subjects[self.subscribers[0].email], subjects[self.subscribers[2].email])
+
+    def test_new_topic_notification(self):
+        user = self.subscribers[0]
+        ForumSubscription.objects.create(user=user, forum=self.forum, type=ForumSubscription.TYPE_NOTIFY)
+        topic = Topic.objects.create(name='new topic', forum=self.forum, user=self.user)
+        self.assertEqual(Notification.objects.get().topic, topic)
+        call_command('pybb_send_notifications', stdout=StringIO())
+        self.assertEqual([m.to for m in mail.outbox], [[user.email]])
+        self.assertIn(topic.get_absolute_url(), mail.outbox[0].body)
+
+    def test_failed_delivery_is_retried(self):
+        self.create_post(topic=self.topic, user=self.user, body='reply')
+        with mock.patch('pybb.subscription.send_mass_html_mail', side_effect=smtplib.SMTPException):
+            for i in range(1, defaults.PYBB_NOTIFICATION_MAX_ATTEMPTS):
+                self.assertEqual(process_outbox(), 1)
+                notification = Notification.objects.get()
+                self.assertEqual(notification.attempts, i)
+                # retried later, with a growing delay
+                self.assertEqual(process_outbox(), 0)
+                delay = notification.next_attempt - timezone.now()
+                self.assertGreater(delay, datetime.timedelta(seconds=defaults.PYBB_NOTIFICATION_RETRY_DELAY * 2 ** (i - 1) - 5))
+                Notification.objects.update(next_attempt=timezone.now())
+            # dropped after the last attempt
+            self.assertEqual(process_outbox(), 1)
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_delivery_outside_of_claim_transaction(self):
+        self.create_post(topic=self.topic, user=self.user, body='reply')
+        atomic_blocks = len(connection.atomic_blocks)
+        delivery_blocks = []
+        with mock.patch('pybb.subscription.deliver_notification',
+                        side_effect=lambda *args, **kwargs: delivery_blocks.append(len(connection.atomic_blocks))):
+            self.assertEqual(process_outbox(), 1)
+        self.assertEqual(delivery_blocks, [atomic_blocks])
+        self.assertFalse(Notification.objects.exists())
+
+    def test_retry_resumes_after_delivered_batches(self):
+        self.create_post(topic=self.topic, user=self.user, body='reply')
+        batches = []
+
+        def send_batch(mails, fail_silently=False):
+            batches.append(mails)
+            if len(batches) == 2:
+                raise smtplib.SMTPException
+            return compat.send_mass_html_mail(mails, fail_silently=fail_silently)
+
+        language = translation.get_language()
+        with mock.patch.object(defaults, 'PYBB_NOTIFICATION_MAIL_BATCH_SIZE', 1), \
+                mock.patch('pybb.subscription.send_mass_html_mail', side_effect=send_batch):
+            self.assertEqual(process_outbox(), 1)
+            self.assertEqual(translation.get_language(), language)
+            notification = Notification.objects.get()
+            self.assertEqual(notification.attempts, 1)
+            self.assertEqual(notification.progress, {'en': self.subscribers[0].pk})
+            Notification.objects.update(next_attempt=timezone.now())
+            self.assertEqual(process_outbox(), 1)
+        self.assertFalse(Notification.objects.exists())
+        # each subscriber received the email once
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(u.email for u in self.subscribers))
+
+    def test_claim_skips_notifications_claimed_by_others(self):
+        self.create_post(topic=self.topic, user=self.user, body='reply')
+        self.create_post(topic=self.topic, user=self.user, body='another reply')
+        notifications = list(Notification.objects.all())
+        until = timezone.now() + datetime.timedelta(minutes=10)
+        # claimed by another worker after it was read
+        Notification.objects.filter(pk=notifications[0].pk).update(next_attempt=until)
+        self.assertEqual(claim_notifications(notifications, until), [notifications[1]])
+        self.assertEqual(Notification.objects.get(pk=notifications[1].pk).next_attempt, until)
+
+    def test_subscribers_queries_are_bounded(self):
+        self.create_post(topic=self.topic, user=self.user, body='reply')
+        # delivery records its progress in the notification: deliver fresh instances
+        deliver_notification(Notification.objects.get())
+        mail.outbox = []
+        notification = Notification.objects.get()
+        with CaptureQueriesContext(connection) as queries:
+            deliver_notification(notification)
+        for i in range(3, 10):
+            user = User.objects.create_user('user%s' % i, 'user%s@someserver.com' % i, 'user%s' % i)
+            self.topic.subscribers.add(user)
+        mail.outbox = []
+        notification = Notification.objects.get()
+        with self.assertNumQueries(len(queries)):
+            deliver_notification(notification)
+        self.assertEqual(len(mail.outbox), 10)
+
+    def test_subscribers_streamed_by_chunks(self):
+        self.create_post(topic=self.topic, user=self.user, body='reply')
+        with mock.patch.object(defaults, 'PYBB_NOTIFICATION_MAIL_BATCH_SIZE', 1):
+            with CaptureQueriesContext(connection) as queries:
+                deliver_notification(Notification.objects.get())
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(u.email for u in self.subscribers))
+        subscribers_table = connection.ops.quote_name(Topic.subscribers.through._meta.db_table)
+        chunks = [q['sql'] for q in queries
+                  if subscribers_table in q['sql'] and not q['sql'].startswith('SELECT DISTINCT')]
+        # 2 non empty chunks for 'en', 1 for 'fr'
+        self.assertEqual(len(chunks), 5)
+        self.assertTrue(all('LIMIT 1' in sql for sql in chunks))
+
+    def test_synchronous_executor(self):
+        with mock.patch.object(defaults, 'PYBB_NOTIFICATION_EXECUTOR', 'pybb.subscription.SynchronousExecutor'):
+            self.create_post(topic=self.topic, user=self.user, body='reply')
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class SearchTestMixin(SharedTestModule):
+    backend_class = search_backends.MemorySearchBackend
+
+    def setUp(self):
+        self.backend = self.backend_class()
+        self.backend.setup()
+        self.backend.clear()
+        self.patcher = mock.patch.object(search, 'search_backend', self.backend)
+        self.patcher.start()
+        self.create_user()
+        self.create_initial(post=False)
+        self.post_1 = self.create_post(topic=self.topic, user=self.user, body='Quick brown [b]fox[/b]')
+        self.post_2 = self.create_post(topic=self.topic, user=self.user, body='lazy brown dog')
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def search(self, query):
+        return sorted(self.backend.filter(Post.objects.all(), query).values_list('pk', flat=True))
+
+    def test_index_on_save_and_delete(self):
+        self.assertEqual(self.search('brown'), [self.post_1.pk, self.post_2.pk])
+        self.assertEqual(self.search('BROWN Fox'), [self.post_1.pk])
+        self.assertEqual(self.search('cat'), [])
+        self.assertEqual(self.search('  '), [])
+        self.post_2.body = 'lazy cat'
+        self.post_2.save()
+        self.assertEqual(self.search('brown'), [self.post_1.pk])
+        self.assertEqual(self.search('cat'), [self.post_2.pk])
+        self.post_1.delete()
+        self.assertEqual(self.search('fox'), [])
+
+    def test_index_on_save_rendering(self):
+        self.backend.clear()
+        post = Post.objects.get(pk=self.post_1.pk)
+        with mock.patch('pybb.models.get_render_version', return_value='new markup'):
+            self.assertTrue(post.save_rendering())
+        self.assertEqual(self.search('fox'), [self.post_1.pk])
+
+    def test_reindex_command(self):
+        self.backend.clear()
+        self.assertEqual(self.search('brown'), [])
+        out = StringIO()
+        call_command('pybb_reindex', chunk_size=1, stdout=out)
+        self.assertIn('Successfully indexed posts: 2', out.getvalue())
+        self.assertEqual(self.search('brown'), [self.post_1.pk, self.post_2.pk])
+
+    def test_search_view(self):
+        hidden_forum = Forum.objects.create(name='hidden', category=self.category, hidden=True)
+        hidden_topic = Topic.objects.create(name='hidden', forum=hidden_forum, user=self.user)
+        hidden_post = self.create_post(topic=hidden_topic, user=self.user, body='brown bear')
+        self.assertEqual(self.get_results(AnonymousUser()), [])
+        self.assertEqual(self.get_results(AnonymousUser(), q='brown'), [self.post_2, self.post_1])
+        self.assertEqual(self.get_results(self.user, q='brown'), [hidden_post, self.post_2, self.post_1])
+
+    def get_results(self, user, **params):
+        request = RequestFactory().get(reverse('pybb:search'), params)
+        request.user = user
+        response = SearchView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        return list(response.context_data['object_list'])
+
+
+class MemorySearchBackendTest(SearchTestMixin, TestCase):
+    pass
+
+
+class DatabaseSearchBackendTest(SearchTestMixin, TestCase):
+    backend_class = search_backends.DatabaseSearchBackend
+
+    def test_reindex_command(self):
+        # nothing is indexed
+        pass
+
+    def test_index_on_save_and_delete(self):
+        self.assertEqual(self.search('BROWN Fox'), [self.post_1.pk])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite backend')
+class SqliteSearchBackendTest(SearchTestMixin, TestCase):
+    backend_class = search_backends.SqliteSearchBackend
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(self.search('"brown" fox*'), [self.post_1.pk])
+        self.assertEqual(self.search('brown NEAR('), [])
+
+    def test_migration(self):
+        migration = import_module('pybb.migrations.0013_post_search_index')
+        schema_editor = mock.Mock(connection=connection, quote_name=connection.ops.quote_name)
+        with connection.cursor() as cursor:
+            schema_editor.execute.side_effect = cursor.execute
+            migration.drop_search_index(django_apps, schema_editor)
+            self.assertNotIn(self.backend.table, connection.introspection.table_names(cursor))
+            migration.create_search_index(django_apps, schema_editor)
+            self.assertIn(self.backend.table, connection.introspection.table_names(cursor))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'PostgreSQL backend')
+class PostgresSearchBackendTest(SearchTestMixin, TestCase):
+    backend_class = search_backends.PostgresSearchBackend
+
+
+class NotificationRenderTest(TestCase, SharedTestModule):
+    templates = {
+        'pybb/mail_templates/test_subject.html': '{% autoescape off %}Hello {{ user.username }}{% endautoescape %}',
+        'pybb/mail_templates/test_body.html': '{% autoescape off %}Dear {{ user }} <{{ user.email }}>, '
+                                              '{{ user.pk }}{% endautoescape %}',
+        'pybb/mail_templates/test_body-html.html': '<p>Dear {{ user.get_username }}</p>',
+    }
+
+    def setUp(self):
+        self.ORIG_PYBB_NOTIFICATION_RENDER_PER_RECIPIENT = defaults.PYBB_NOTIFICATION_RENDER_PER_RECIPIENT
+        self.users = []
+        for i, language in enumerate(['en', 'en', 'fr']):
+            user = User.objects.create_user('user<%s>' % i, 'user%s@someserver.com' % i, 'user%s' % i)
+            profile = util.get_pybb_profile(user)
+            profile.language = language
+            profile.save()
+            self.users.append(User.objects.get(pk=user.pk))
+        mail.outbox = []
+
+    def tearDown(self):
+        defaults.PYBB_NOTIFICATION_RENDER_PER_RECIPIENT = self.ORIG_PYBB_NOTIFICATION_RENDER_PER_RECIPIENT
+
+    def render_to_string(self, template_name, context):
+        return Template(self.templates[template_name]).render(Context(context))
+
+    def send(self):
+        with mock.patch('pybb.subscription.render_to_string', side_effect=self.render_to_string) as render:
+            send_notification(self.users, 'test', {'site': 'example.org'})
+        return render.call_count
+
+    def test_recipient_placeholders(self):
+        self.assertEqual(self.send(), 6)
+        self.assertEqual(len(mail.outbox), 3)
+        for i, message in enumerate(mail.outbox):
+            self.assertEqual(message.to, ['user%s@someserver.com' % i])
+            self.assertEqual(message.subject, 'Hello user<%s>' % i)
+            # attributes which are not recipient fields render as invalid variables
+            self.assertEqual(message.body, 'Dear user<%s> <user%s@someserver.com>, ' % (i, i))
+            self.assertEqual(message.alternatives[0][0], '<p>Dear user&lt;%s&gt;</p>' % i)
+
+    def test_render_per_recipient(self):
+        defaults.PYBB_NOTIFICATION_RENDER_PER_RECIPIENT = True
+        self.assertEqual(self.send(), 9)
+        for i, message in enumerate(mail.outbox):
+            self.assertEqual(message.subject, 'Hello user<%s>' % i)
+            self.assertEqual(message.body, 'Dear user<%s> <user%s@someserver.com>, %s' % (i, i, self.users[i].pk))
+            self.assertEqual(message.alternatives[0][0], '<p>Dear user&lt;%s&gt;</p>' % i)
+
+    def test_no_queries_per_recipient(self):
+        self.users = list(User.objects.filter(pk__in=[user.pk for user in self.users])
+                          .select_related(settings.PYBB_PROFILE_RELATED_NAME).order_by('pk'))
+        with self.assertNumQueries(0):
+            self.send()
+        self.assertEqual(len(mail.outbox), 3)
+
+
+@skipUnless(os.environ.get('PYBB_BENCHMARKS'), 'set PYBB_BENCHMARKS=1 to run benchmarks')
+class NotificationBenchmark(TestCase, SharedTestModule):
+    recipients = 10000
+
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        User.objects.bulk_create([User(username='bench%s' % i, email='bench%s@someserver.com' % i)
+                                  for i in range(self.recipients)])
+        users = User.objects.filter(username__startswith='bench')
+        Profile.objects.bulk_create([Profile(user=user, language=['en', 'fr'][user.pk % 2]) for user in users])
+        self.users = users
+        self.context = {
+            'post': self.post,
+            'post_url': 'http://example.org%s' % self.post.get_absolute_url(),
+            'topic_url': 'http://example.org%s' % self.topic.get_absolute_url(),
+            'delete_url_full': 'http://example.org/delete/',
+        }
+
+    def run_benchmark(self, per_recipient):
+        mail.outbox = []
+        with mock.patch.object(defaults, 'PYBB_NOTIFICATION_RENDER_PER_RECIPIENT', per_recipient):
+            start = time.perf_counter()
+            send_notification(self.users, 'subscription_email', dict(self.context))
+            duration = time.perf_counter() - start
+        self.assertEqual(len(mail.outbox), self.recipients)
+        return duration
+
+    def test_send_notification(self):
+        per_language = self.run_benchmark(per_recipient=False)
+        per_recipient = self.run_benchmark(per_recipient=True)
+        self.assertLess(per_language, per_recipient)
+
+
+class RenderCacheTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+
+    def count_renders(self, func):
+        formatter = util._get_markup_formatter()
+        with mock.patch('pybb.models._get_markup_formatter', return_value=mock.Mock(wraps=formatter)) as get:
+            func()
+        return get.return_value.call_count
+
+    def test_post_rendered_once(self):
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual(post.render_version, util.get_render_version())
+        self.assertEqual(self.count_renders(post.save), 0)
+        post.body = 'new [b]body[/b]'
+        self.assertEqual(self.count_renders(post.save), 1)
+        self.assertEqual(post.body_html, 'new <strong>body</strong>')
+        with mock.patch.object(defaults, 'PYBB_RENDER_VERSION', 'other'):
+            self.assertEqual(self.count_renders(post.save), 1)
+            with mock.patch.object(defaults, 'PYBB_SMILES', {':-)': 'smile.png'}):
+                self.assertEqual(self.count_renders(post.save), 1)
+
+    def test_signature_rendered_on_change(self):
+        profile = util.get_pybb_profile(User.objects.get(pk=self.user.pk))
+        profile.signature = '[b]sign[/b]'
+        profile.save()
+        self.assertEqual(profile.signature_html, '<strong>sign</strong>')
+        profile = util.get_pybb_profile(User.objects.get(pk=self.user.pk))
+        with mock.patch('pybb.profiles.util._get_markup_formatter', return_value=lambda text: text) as get:
+            profile.post_count += 1
+            profile.save()
+            self.assertFalse(get.called)
+            profile.signature = 'changed'
+            profile.save()
+            self.assertTrue(get.called)
+
+    def test_rerender_command(self):
+        post = self.create_post(topic=self.topic, user=self.user, body='[i]second[/i]')
+        Post.objects.filter(pk=post.pk).update(render_version='', body_html='stale', body_text='stale')
+        updated = Topic.objects.get(pk=self.topic.pk).updated
+        out = StringIO()
+        call_command('pybb_rerender', chunk_size=1, stdout=out)
+        self.assertIn('Successfully rendered posts: 1', out.getvalue())
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.body_html, '<em>second</em>')
+        self.assertEqual(post.body_text, 'second')
+        self.assertEqual(post.render_version, util.get_render_version())
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).updated, updated)
+
+        out = StringIO()
+        call_command('pybb_rerender', stdout=out)
+        self.assertIn('Successfully rendered posts: 0', out.getvalue())
+        call_command('pybb_rerender', all=True, signatures=True, stdout=out)
+        self.assertIn('Successfully rendered posts: 2', out.getvalue())
+        self.assertIn('Successfully rendered signatures: 0', out.getvalue())
+
+
+class ForumTreeTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.subforum = Forum.objects.create(name='sub', category=self.category, parent=self.forum)
+        self.subsubforum = Forum.objects.create(name='subsub', category=self.category, parent=self.subforum)
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(forum_tree.invalidate_forum_tree)
+
+    def test_get_parents_without_queries(self):
+        topic = Topic.objects.create(name='deep', forum=self.subsubforum, user=self.user)
+        forum_tree.get_forum_tree()
+        topic = Topic.objects.get(pk=topic.pk)
+        with self.assertNumQueries(0):
+            parents = topic.get_parents()
+            self.assertEqual(parents, [self.category, self.forum, self.subforum, self.subsubforum])
+            self.assertEqual([str(parent) for parent in parents], ['foo', 'xfoo', 'sub', 'subsub'])
+            self.assertEqual(parents[-1].category.slug, self.category.slug)
+        self.assertEqual(self.subsubforum.get_parents(), [self.category, self.forum, self.subforum])
+
+    def test_invalidation(self):
+        tree = forum_tree.get_forum_tree()
+        self.assertNotIn(self.forum.id, tree.hidden_forum_ids)
+        self.category.hidden = True
+        self.category.save()
+        tree = forum_tree.get_forum_tree()
+        self.assertEqual(tree.hidden_forum_ids, frozenset([self.forum.id, self.subforum.id, self.subsubforum.id]))
+        self.subsubforum.parent = self.forum
+        self.subsubforum.name = 'moved'
+        self.subsubforum.save()
+        self.assertEqual([str(parent) for parent in Forum.objects.get(pk=self.subsubforum.pk).get_parents()],
+                         ['foo', 'xfoo'])
+        self.subforum.delete()
+        self.assertNotIn(self.subforum.id, forum_tree.get_forum_tree())
+
+    def test_snapshot_shared_by_cache(self):
+        version = forum_tree.get_forum_tree().version
+        # another process only has the cached snapshot
+        forum_tree._local['tree'] = None
+        with self.assertNumQueries(0):
+            self.assertEqual(forum_tree.get_forum_tree().version, version)
+
+    def test_snapshot_loaded_during_change(self):
+        load_data = forum_tree.ForumTree.load_data
+
+        def load_during_change():
+            data = load_data()
+            # another process hides the forum before the snapshot is cached
+            Forum.objects.filter(pk=self.forum.pk).update(hidden=True)
+            forum_tree.drop_forum_tree()
+            return data
+
+        with mock.patch.object(forum_tree.ForumTree, 'load_data', side_effect=load_during_change):
+            self.assertNotIn(self.forum.id, forum_tree.get_forum_tree().hidden_forum_ids)
+        forum_tree._local['tree'] = None
+        self.assertIn(self.forum.id, forum_tree.get_forum_tree().hidden_forum_ids)
+
+    def test_permissions_do_not_trust_snapshot(self):
+        forum_tree.get_forum_tree()
+        # hidden by another process, whose invalidation did not reach the local cache
+        Forum.objects.filter(pk=self.forum.pk).update(hidden=True)
+        self.assertNotIn(self.forum.id, forum_tree.get_forum_tree().hidden_forum_ids)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertFalse(permissions.perms.may_view_forum(self.user, forum))
+        self.assertNotIn(forum, permissions.perms.filter_forums(self.user, Forum.objects.all()))
+
+    def test_filter_forums(self):
+        hidden = Forum.objects.create(name='hidden', category=self.category, hidden=True)
+        forum_tree.get_forum_tree()
+        with CaptureQueriesContext(connection) as queries:
+            forums = list(permissions.perms.filter_forums(self.user, Forum.objects.all()))
+        self.assertNotIn(hidden, forums)
+        self.assertIn(self.forum, forums)
+        self.assertNotIn('pybb_category', queries.captured_queries[-1]['sql'])
+
+
+class IndexCacheTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.hidden_forum = Forum.objects.create(name='hidden', category=self.category, hidden=True)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def get_index(self):
+        response = self.client.get(reverse('pybb:index'))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def forum_queries(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            result = func()
+        return result, [query['sql'] for query in queries.captured_queries
+                        if 'FROM "pybb_forum"' in query['sql'] or 'FROM "pybb_category"' in query['sql']]
+
+    def test_index_is_cached(self):
+        self.login_client()
+        self.get_index()
+        response, queries = self.forum_queries(self.get_index)
+        self.assertEqual(queries, [])
+        forums = response.context['categories'][0].forums_accessed
+        self.assertEqual([forum.id for forum in forums], [self.forum.id])
+        self.assertEqual(forums[0].last_post, self.post)
+        # per-user unread markers are still computed
+        self.assertTrue(forums[0].unread)
+
+    def test_signatures(self):
+        staff = User.objects.create_user('staff', 'staff@localhost', 'staff')
+        staff.is_staff = True
+        staff.save()
+        get_ids = lambda user: [forum.id for forum in index_cache.get_categories(user)[0].forums_accessed]
+        self.assertEqual(get_ids(self.user), [self.forum.id])
+        self.assertEqual(get_ids(staff), [self.forum.id, self.hidden_forum.id])
+        self.assertEqual(get_ids(AnonymousUser()), [self.forum.id])
+        self.assertEqual(permissions.perms.get_signature(self.user), 'user')
+        self.assertEqual(permissions.perms.get_signature(staff), 'staff')
+        self.assertEqual(permissions.perms.get_signature(AnonymousUser()), 'anonymous')
+        self.assertEqual(len(cache.get(index_cache.INDEX_CACHE_KEY)), 3)
+
+    def test_invalidation(self):
+        self.assertEqual(index_cache.get_categories(self.user)[0].forums_accessed[0].post_count, 1)
+        post = self.create_post(topic=self.topic, user=self.user, body='reply')
+        categories, queries = self.forum_queries(lambda: index_cache.get_categories(self.user))
+        self.assertTrue(queries)
+        self.assertEqual(categories[0].forums_accessed[0].post_count, 2)
+        self.assertEqual(categories[0].forums_accessed[0].last_post, post)
+        Forum.objects.get(pk=self.hidden_forum.pk).save()
+        self.assertIsNone(cache.get(index_cache.INDEX_CACHE_KEY))
+        index_cache.get_categories(self.user)
+        Category.objects.create(name='other')
+        self.assertIsNone(cache.get(index_cache.INDEX_CACHE_KEY))
+
+    def test_invalidation_by_shown_changes_only(self):
+        reply = self.create_post(topic=self.topic, user=self.user, body='reply')
+        index_cache.get_categories(self.user)
+        # changes which the index does not show keep it
+        post = Post.objects.get(pk=self.post.pk)
+        post.body = 'edited'
+        post.save()
+        topic = Topic.objects.get(pk=self.topic.pk)
+        topic.sticky = True
+        topic.save()
+        self.assertIsNotNone(cache.get(index_cache.INDEX_CACHE_KEY))
+        # editing the last post moves the forum's activity date
+        reply = Post.objects.get(pk=reply.pk)
+        reply.body = 'edited'
+        reply.updated = timezone.now()
+        reply.save()
+        self.assertIsNone(cache.get(index_cache.INDEX_CACHE_KEY))
+        index_cache.get_categories(self.user)
+        Post.objects.get(pk=reply.pk).delete()
+        self.assertIsNone(cache.get(index_cache.INDEX_CACHE_KEY))
+        self.assertEqual(index_cache.get_categories(self.user)[0].forums_accessed[0].post_count, 1)
+
+    def test_cache_disabled(self):
+        with mock.patch.object(defaults, 'PYBB_INDEX_CACHE_TIMEOUT', 0):
+            index_cache.get_categories(self.user)
+        self.assertIsNone(cache.get(index_cache.INDEX_CACHE_KEY))
+
+
+class TopicViewsTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        patcher = mock.patch.object(topic_views, 'current_bucket', return_value=1000)
+        self.current_bucket = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_views(self, topics):
+        return [Topic.objects.get(pk=topic.pk).views for topic in topics]
+
+    def get_live_views(self, topics):
+        return [pybb_tags.pybbm_calc_topic_views(Topic.objects.get(pk=topic.pk)) for topic in topics]
+
+    def test_views_are_buffered(self):
+        self.login_client()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.topic.get_absolute_url())
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('UPDATE "pybb_topic"')])
+        User.objects.create_user('bob', 'bob@localhost', 'bob')
+        self.get_with_user(self.topic.get_absolute_url(), 'bob', 'bob')
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 0)
+        self.assertEqual(pybb_tags.pybbm_calc_topic_views(self.topic), 2)
+
+    def test_listing_reads_active_buckets_at_once(self):
+        topics = [self.topic] + [Topic.objects.create(name='topic %d' % i, forum=self.forum, user=self.user)
+                                 for i in range(4)]
+        with mock.patch.object(defaults, 'PYBB_TOPIC_VIEWS_FLUSH_ON_REQUEST', False):
+            topic_views.add_view(topics[1])
+            self.current_bucket.return_value = 1005
+            topic_views.add_view(topics[1])
+            topic_views.add_view(topics[2])
+        with mock.patch.object(topic_views.cache, 'get_many', wraps=cache.get_many) as get_many:
+            topics = pybb_tags.pybbm_calc_topics_views(Topic.objects.filter(pk__in=[t.pk for t in topics]).order_by('pk'))
+            self.assertEqual([pybb_tags.pybbm_calc_topic_views(topic) for topic in topics], [0, 2, 1, 0, 0])
+        # the active buckets, then the views of the topics in the 2 active buckets
+        self.assertEqual(get_many.call_count, 2)
+        self.assertEqual(len(get_many.call_args_list[0][0][0]), 2)
+        self.assertEqual(len(get_many.call_args_list[1][0][0]), 2 * len(topics))
+
+    def test_active_buckets_without_flush(self):
+        with mock.patch.object(defaults, 'PYBB_TOPIC_VIEWS_FLUSH_ON_REQUEST', False):
+            topic_views.add_view(self.topic)
+            self.current_bucket.return_value = 1000 + topic_views.BUCKETS_KEPT // 2
+            topic_views.add_view(self.topic)
+            self.assertEqual(topic_views.get_active_buckets(), [1000, 1000 + topic_views.BUCKETS_KEPT // 2])
+            self.assertEqual(self.get_live_views([self.topic]), [2])
+            # buckets older than the kept ones are dropped
+            self.current_bucket.return_value = 1001 + topic_views.BUCKETS_KEPT
+            self.assertEqual(topic_views.get_active_buckets(), [1000 + topic_views.BUCKETS_KEPT // 2])
+            topic_views.add_view(self.topic)
+            self.assertEqual(cache.get(topic_views.ACTIVE_BUCKETS_KEY),
+                             [1000 + topic_views.BUCKETS_KEPT // 2, 1001 + topic_views.BUCKETS_KEPT])
+
+    def test_closed_buckets_are_flushed(self):
+        topics = [self.topic] + [Topic.objects.create(name='topic %d' % i, forum=self.forum, user=self.user)
+                                 for i in range(3)]
+        with mock.patch.object(defaults, 'PYBB_TOPIC_VIEWS_FLUSH_ON_REQUEST', False):
+            for i, topic in enumerate(topics):
+                for _ in range(i):
+                    topic_views.add_view(topic)
+            self.assertEqual(topic_views.get_buffered_views([topic.id for topic in topics]),
+                             {topics[1].id: 1, topics[2].id: 2, topics[3].id: 3})
+            # the bucket is still open, then in its grace interval
+            self.assertEqual(topic_views.flush_views(), 0)
+            self.current_bucket.return_value = 1001
+            topic_views.add_view(topics[1])
+            self.assertEqual(topic_views.flush_views(), 0)
+            self.assertEqual(self.get_live_views(topics), [0, 2, 2, 3])
+
+            self.current_bucket.return_value = 1002
+            with self.assertNumQueries(1):
+                self.assertEqual(topic_views.flush_views(), 3)
+            self.assertEqual(self.get_views(topics), [0, 1, 2, 3])
+            self.assertEqual(self.get_live_views(topics), [0, 2, 2, 3])
+            self.current_bucket.return_value = 1003
+            self.assertEqual(topic_views.flush_views(), 1)
+            self.assertEqual(self.get_views(topics), [0, 2, 2, 3])
+            self.assertEqual(topic_views.get_buffered_views([topic.id for topic in topics]), {})
+            with self.assertNumQueries(0):
+                self.assertEqual(topic_views.flush_views(), 0)
+        self.assertEqual(topic_views.get_stats(), {'buffered': 7, 'persisted': 7})
+
+    def test_flush_on_request(self):
+        topic_views.add_view(self.topic)
+        self.current_bucket.return_value = 1002
+        topic_views.add_view(self.topic)
+        self.assertEqual(self.get_views([self.topic]), [1])
+        self.assertEqual(self.get_live_views([self.topic]), [2])
+        self.assertEqual(topic_views.get_stats(), {'buffered': 2, 'persisted': 1})
+
+    def test_concurrent_flushes(self):
+        topic_views.add_view(self.topic)
+        self.current_bucket.return_value = 1002
+        cache.add(topic_views.FLUSH_LOCK_KEY, 1)
+        self.assertEqual(topic_views.flush_views(), 0)
+        cache.delete(topic_views.FLUSH_LOCK_KEY)
+        self.assertEqual(topic_views.flush_views(), 1)
+
+    def test_buffer_size(self):
+        with mock.patch.object(defaults, 'PYBB_TOPIC_VIEWS_CACHE_BUFFER', 3):
+            for _ in range(4):
+                topic_views.add_view(self.topic)
+        self.assertEqual(self.get_views([self.topic]), [3])
+        self.assertEqual(topic_views.get_buffered_views([self.topic.id]), {self.topic.id: 1})
+
+    def test_flush_command(self):
+        topic_views.add_view(self.topic)
+        topic_views.add_view(self.topic)
+        self.current_bucket.return_value = 1002
+        out = StringIO()
+        call_command('pybb_flush_views', stdout=out)
+        self.assertIn('Successfully updated topics: 1 (views buffered: 2, persisted: 2)', out.getvalue())
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 2)
+
+    def test_buffer_disabled(self):
+        with mock.patch.object(defaults, 'PYBB_TOPIC_VIEWS_CACHE_BUFFER', None):
+            topic_views.add_view(self.topic)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 1)
+        self.assertEqual(topic_views.get_buffered_views([self.topic.id]), {})
+
+
 class AnonymousTest(TestCase, SharedTestModule):
     def setUp(self):
         self.ORIG_PYBB_ENABLE_ANONYMOUS_POST = defaults.PYBB_ENABLE_ANONYMOUS_POST
         self.ORIG_PYBB_ANONYMOUS_USERNAME = defaults.PYBB_ANONYMOUS_USERNAME
-        self.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER = defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER
+        self.PYBB_TOPIC_VIEWS_CACHE_BUFFER = defaults.PYBB_TOPIC_VIEWS_CACHE_BUFFER
 
         defaults.PYBB_ENABLE_ANONYMOUS_POST = True
         defaults.PYBB_ANONYMOUS_USERNAME = 'Anonymous'
+        cache.clear()
         self.user = User.objects.create_user('Anonymous', 'Anonymous@localhost', 'Anonymous')
         self.category = Category.objects.create(name='foo')
         self.forum = Forum.objects.create(name='xfoo', description='bar', category=self.category)
@@ -1672,7 +3017,7 @@ class AnonymousTest(TestCase, SharedTestModule):
     def tearDown(self):
         defaults.PYBB_ENABLE_ANONYMOUS_POST = self.ORIG_PYBB_ENABLE_ANONYMOUS_POST
         defaults.PYBB_ANONYMOUS_USERNAME = self.ORIG_PYBB_ANONYMOUS_USERNAME
-        defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER = self.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER
+        defaults.PYBB_TOPIC_VIEWS_CACHE_BUFFER = self.PYBB_TOPIC_VIEWS_CACHE_BUFFER
 
     def test_anonymous_posting(self):
         response = self.create_post_via_http(self.client, topic_id=self.topic.id,
@@ -1682,25 +3027,25 @@ class AnonymousTest(TestCase, SharedTestModule):
         self.assertEqual(Post.objects.get(body='test anonymous').user, self.user)
 
     def test_anonymous_cache_topic_views(self):
-        self.assertNotIn(util.build_cache_key('anonymous_topic_views', topic_id=self.topic.id), cache)
+        self.assertEqual(topic_views.get_buffered_views([self.topic.id]), {})
         url = self.topic.get_absolute_url()
         self.client.get(url)
-        self.assertEqual(cache.get(util.build_cache_key('anonymous_topic_views', topic_id=self.topic.id)), 1)
-        for _ in range(defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER - 2):
+        self.assertEqual(topic_views.get_buffered_views([self.topic.id]), {self.topic.id: 1})
+        for _ in range(defaults.PYBB_TOPIC_VIEWS_CACHE_BUFFER - 2):
             self.client.get(url)
         self.assertEqual(Topic.objects.get(id=self.topic.id).views, 0)
-        self.assertEqual(cache.get(util.build_cache_key('anonymous_topic_views', topic_id=self.topic.id)),
-                         defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER - 1)
+        self.assertEqual(topic_views.get_buffered_views([self.topic.id]),
+                         {self.topic.id: defaults.PYBB_TOPIC_VIEWS_CACHE_BUFFER - 1})
         self.client.get(url)
-        self.assertEqual(Topic.objects.get(id=self.topic.id).views, defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER)
-        self.assertEqual(cache.get(util.build_cache_key('anonymous_topic_views', topic_id=self.topic.id)), 0)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).views, defaults.PYBB_TOPIC_VIEWS_CACHE_BUFFER)
+        self.assertEqual(topic_views.get_buffered_views([self.topic.id]), {})
 
         views = Topic.objects.get(id=self.topic.id).views
 
-        defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER = None
+        defaults.PYBB_TOPIC_VIEWS_CACHE_BUFFER = None
         self.client.get(url)
         self.assertEqual(Topic.objects.get(id=self.topic.id).views, views + 1)
-        self.assertEqual(cache.get(util.build_cache_key('anonymous_topic_views', topic_id=self.topic.id)), 0)
+        self.assertEqual(topic_views.get_buffered_views([self.topic.id]), {})
 
 def premoderate_test(user, post):
     """
@@ -1864,6 +3209,54 @@ class AttachmentTest(TestCase, SharedTestModule):
         self.assertEqual(src2, attachments[1].file.url)
         self.assertEqual(src1, src3)
 
+    def create_attachment(self, post):
+        with open(self.file_name, 'rb') as fp:
+            return Attachment.objects.create(post=post, file=SimpleUploadedFile('attachment.png', fp.read()))
+
+    def test_render_without_references(self):
+        self.create_attachment(self.post)
+        post = Post.objects.get(pk=self.post.pk)
+        with self.assertNumQueries(0):
+            post.render(force=True)
+
+    def test_render_with_references(self):
+        attachments = [self.create_attachment(self.post) for i in range(2)]
+        post = Post.objects.get(pk=self.post.pk)
+        post.body = '[img][file-2][/img] [file-3]'
+        with self.assertNumQueries(1):
+            self.assertTrue(post.render())
+        self.assertEqual(post.body_html, '<img src="%s"> [file-3]' % attachments[1].file.url)
+
+    def test_save_rendering(self):
+        post = self.create_post(topic=self.topic, user=self.user, body='[img][file-1][/img]')
+        self.assertFalse(post.save_rendering())
+        attachment = self.create_attachment(post)
+        self.assertTrue(post.save_rendering())
+        self.assertEqual(Post.objects.get(pk=post.pk).body_html, '<img src="%s">' % attachment.file.url)
+
+    def test_edit_post_with_attachment(self):
+        post = self.create_post(topic=self.topic, user=self.user, body='reply')
+        self.login_client()
+        edit_post_url = reverse('pybb:edit_post', kwargs={'pk': post.id})
+        values = {
+            'body': '[img][file-1][/img]',
+            'attachments-TOTAL_FORMS': 1, 'attachments-INITIAL_FORMS': 0,
+            'attachments-MIN_NUM_FORMS': 0, 'attachments-MAX_NUM_FORMS': 1000,
+        }
+        saved = []
+        receiver = lambda instance, **kwargs: saved.append(instance.pk)
+        post_save.connect(receiver, sender=Post)
+        try:
+            with open(self.file_name, 'rb') as fp:
+                values['attachments-0-file'] = fp
+                response = self.client.post(edit_post_url, data=values)
+        finally:
+            post_save.disconnect(receiver, sender=Post)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(saved, [post.pk])
+        post = Post.objects.get(pk=post.pk)
+        self.assertIn('src="%s"' % post.attachments.get().file.url, post.body_html)
+
     def tearDown(self):
         defaults.PYBB_ATTACHMENT_ENABLE = self.PYBB_ATTACHMENT_ENABLE
         defaults.PYBB_PREMODERATION = self.ORIG_PYBB_PREMODERATION
@@ -2076,6 +3469,184 @@ class FiltersTest(TestCase, SharedTestModule):
         self.assertEqual(Post.objects.all()[0].body, 'test\nmultiple empty lines')
 
 
+class PermissionScopeTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.moderator = User.objects.create_user('moderator', 'moderator@localhost', 'moderator')
+        self.forum.moderators.add(self.moderator)
+
+    def check_posts(self, user, posts):
+        for post in posts:
+            permissions.perms.may_view_post(user, post)
+            permissions.perms.may_edit_post(user, post)
+            permissions.perms.may_delete_post(user, post)
+            permissions.perms.may_create_post(user, post.topic)
+
+    def test_queries_per_request_are_constant(self):
+        user = User.objects.get(pk=self.moderator.pk)
+        posts = list(Post.objects.select_related('topic'))
+        forum_tree.get_forum_tree()
+        with permissions.permission_scope():
+            with CaptureQueriesContext(connection) as one_post:
+                self.check_posts(user, posts)
+        for i in range(49):
+            self.create_post(topic=self.topic, user=self.user, body='post %d' % i)
+        user = User.objects.get(pk=self.moderator.pk)
+        posts = list(Post.objects.select_related('topic'))
+        self.assertEqual(len(posts), 50)
+        with permissions.permission_scope():
+            with self.assertNumQueries(len(one_post)):
+                self.check_posts(user, posts)
+
+    def test_context_is_shared_in_scope(self):
+        self.assertIsNot(permissions.get_permission_context(self.user),
+                         permissions.get_permission_context(self.user))
+        with permissions.permission_scope():
+            context = permissions.get_permission_context(self.user)
+            self.assertIs(permissions.get_permission_context(User.objects.get(pk=self.user.pk)), context)
+            self.assertIsNot(permissions.get_permission_context(self.moderator), context)
+        self.assertIsNot(permissions.get_permission_context(self.user), context)
+
+    def test_moderated_and_hidden_forums(self):
+        hidden_category = Category.objects.create(name='hidden', hidden=True)
+        hidden_forum = Forum.objects.create(name='hidden', category=self.category, hidden=True)
+        other_forum = Forum.objects.create(name='other', category=hidden_category)
+        context = permissions.get_permission_context(self.moderator)
+        self.assertEqual(context.moderated_forum_ids, {self.forum.id})
+        self.assertEqual(context.hidden_forum_ids, {hidden_forum.id, other_forum.id})
+        self.assertEqual(permissions.get_permission_context(AnonymousUser()).moderated_forum_ids, set())
+        self.assertTrue(permissions.perms.may_moderate_topic(self.moderator, self.topic))
+        self.assertFalse(permissions.perms.may_moderate_topic(self.user, self.topic))
+        self.assertTrue(permissions.perms.may_delete_post(self.moderator, self.post))
+
+    def test_middleware_scope(self):
+        self.login_client()
+        with mock.patch.object(permissions, 'PermissionContext', wraps=permissions.PermissionContext) as context:
+            response = self.client.get(self.topic.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(context.call_count, len(set(call[0][0].pk for call in context.call_args_list)))
+        self.assertIsNone(permissions._scope.contexts)
+
+    def test_perms_filters_are_registered(self):
+        filters = pybb_tags.register.filters
+        self.assertIn('pybb_may_edit_post', filters)
+        self.assertIn('pybb_may_create_poll', filters)
+        self.assertTrue(filters['pybb_may_edit_post'](self.user, self.post))
+
+
+class ProfileSessionTest(TestCase, SharedTestModule):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.create_user()
+        self.create_initial()
+        self.login_client()
+        profile = util.get_pybb_profile(self.user)
+        profile.language = 'fr'
+        profile.time_zone = 2.0
+        profile.save()
+
+    def request_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('pybb:index'))
+        self.assertEqual(response.status_code, 200)
+        return response, [query['sql'] for query in ctx.captured_queries]
+
+    def test_profile_settings_cached_in_session(self):
+        response, queries = self.request_queries()
+        self.assertEqual(self.client.session[middleware.PROFILE_SESSION_KEY],
+                         {'user': str(self.user.pk), 'version': middleware.get_profile_version(self.user.pk),
+                          'language': 'fr', 'time_zone': 2.0})
+        self.assertEqual(self.client.session['django_language'], 'fr')
+        response, queries = self.request_queries()
+        self.assertEqual(response.wsgi_request.LANGUAGE_CODE, 'fr')
+        self.assertEqual(response.wsgi_request.pybb_time_zone, 2.0)
+        profile_table = util.get_pybb_profile_model()._meta.db_table
+        self.assertFalse([sql for sql in queries if 'FROM "%s"' % profile_table in sql])
+        self.assertFalse([sql for sql in queries if sql.startswith('UPDATE "django_session"')])
+
+    def test_profile_edit_updates_session(self):
+        self.request_queries()
+        response = self.client.get(reverse('pybb:edit_profile'))
+        values = self.get_form_values(response, 'profile-edit')
+        values['language'] = 'en'
+        values['time_zone'] = '3.0'
+        self.client.post(reverse('pybb:edit_profile'), data=values, follow=True)
+        self.assertEqual(self.client.session[middleware.PROFILE_SESSION_KEY]['language'], 'en')
+        self.assertEqual(self.client.session[middleware.PROFILE_SESSION_KEY]['time_zone'], 3.0)
+        response, queries = self.request_queries()
+        self.assertEqual(response.wsgi_request.LANGUAGE_CODE, 'en')
+
+    def test_profile_saved_elsewhere_refreshes_session(self):
+        self.request_queries()
+        profile = util.get_pybb_profile(User.objects.get(pk=self.user.pk))
+        profile.language = 'en'
+        profile.time_zone = 3.0
+        profile.save()
+        response, queries = self.request_queries()
+        self.assertEqual(response.wsgi_request.LANGUAGE_CODE, 'en')
+        self.assertEqual(response.wsgi_request.pybb_time_zone, 3.0)
+        self.assertEqual(self.client.session[middleware.PROFILE_SESSION_KEY]['language'], 'en')
+
+    def test_pybb_time_uses_request_time_zone(self):
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.user.pk)
+        request.pybb_time_zone = 2.0
+        template = Template('{% load pybb_tags %}{% pybb_time a_time %}')
+        context = Context({'user': request.user, 'request': request,
+                           'a_time': timezone.now() - datetime.timedelta(days=3)})
+        with self.assertNumQueries(0):
+            template.render(context)
+
+
+class PermissionQueryPlanTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.create_initial()
+        self.moderator = User.objects.create_user('moderator', 'moderator@localhost', 'moderator')
+        self.other_moderator = User.objects.create_user('other', 'other@localhost', 'other')
+        self.forum.moderators.add(self.moderator, self.other_moderator)
+        self.hidden_forum = Forum.objects.create(name='hidden', category=self.category, hidden=True)
+        self.hidden_topic = Topic.objects.create(name='hidden', forum=self.hidden_forum, user=self.user)
+        self.create_post(topic=self.hidden_topic, user=self.user, body='hidden')
+        self.staff = User.objects.create_user('staff', 'staff@localhost', 'staff')
+        self.staff.is_staff = True
+        self.staff.save()
+
+    def get_querysets(self, user):
+        return [
+            permissions.perms.filter_topics(user, Topic.objects.all()).order_by('-updated', '-id')[:15],
+            permissions.perms.filter_posts(user, Post.objects.all()).order_by('-created', '-id')[:15],
+        ]
+
+    def test_no_distinct_nor_moderators_join(self):
+        for user in (AnonymousUser(), self.user, self.moderator, self.staff):
+            for qs in self.get_querysets(user):
+                sql = str(qs.query).upper()
+                self.assertNotIn('DISTINCT', sql)
+                self.assertNotIn('PYBB_FORUM_MODERATORS', sql)
+                self.assertNotIn('PYBB_CATEGORY', sql)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plans')
+    def test_sqlite_plan_has_no_temp_distinct(self):
+        for user in (AnonymousUser(), self.user, self.moderator):
+            for qs in self.get_querysets(user):
+                self.assertNotIn('DISTINCT', qs.explain())
+
+    def test_results(self):
+        Topic.objects.filter(pk=self.topic.pk).update(on_moderation=True)
+        self.create_post(topic=self.topic, user=self.moderator, body='reply')
+        visible = lambda user: list(permissions.perms.filter_topics(user, Topic.objects.all()))
+        self.assertEqual(visible(self.moderator), [self.topic])
+        self.assertEqual(visible(self.user), [])
+        self.assertEqual(visible(AnonymousUser()), [])
+        self.assertCountEqual(visible(self.staff), [self.hidden_topic])
+        posts = list(permissions.perms.filter_posts(self.moderator, Post.objects.all()))
+        self.assertEqual(len(posts), len(set(posts)))
+        self.assertCountEqual(posts, list(self.topic.posts.all()))
+
+
 class CustomPermissionHandler(permissions.DefaultPermissionHandler):
     """
     a custom permission handler which changes the meaning of "hidden" forum:
@@ -2292,6 +3863,54 @@ def _detach_perms_class():
     pybb_views.perms = permissions.perms = util.resolve_class('pybb.permissions.DefaultPermissionHandler')
 
 
+def legacy_smile_it(s):
+    # previous implementation of smile_it, one replace per smile
+    for smile, url in markup_base.PYBB_SMILES.items():
+        s = s.replace(smile, '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL,
+                                                                     markup_base.PYBB_SMILES_PREFIX, url))
+    return s
+
+
+class SmilesTest(TestCase):
+    def setUp(self):
+        markup_base._SMILES_REPLACERS.clear()
+
+    def tearDown(self):
+        markup_base._SMILES_REPLACERS.clear()
+
+    def test_smile_it(self):
+        text = 'Hello :) o_O :D\n&gt;_&lt; no smile: :-x'
+        self.assertEqual(markup_base.smile_it(text), legacy_smile_it(text))
+        self.assertEqual(markup_base.smile_it('no smile'), 'no smile')
+
+    def test_single_pass(self):
+        smiles = {':)': 'smile.png', ':))': 'laugh.png', 'smile': 'word.png'}
+        with mock.patch.object(markup_base, 'PYBB_SMILES', smiles):
+            self.assertEqual(
+                markup_base.smile_it(':)) :)'),
+                '<img src="%(prefix)slaugh.png" alt="smile" /> <img src="%(prefix)ssmile.png" alt="smile" />' % {
+                    'prefix': settings.STATIC_URL + markup_base.PYBB_SMILES_PREFIX})
+        with mock.patch.object(markup_base, 'PYBB_SMILES', {}):
+            markup_base._SMILES_REPLACERS.clear()
+            self.assertEqual(markup_base.smile_it(':)'), ':)')
+
+
+@skipUnless(os.environ.get('PYBB_BENCHMARKS'), 'set PYBB_BENCHMARKS=1 to run benchmarks')
+class SmilesBenchmark(TestCase):
+    def test_smile_it(self):
+        import timeit
+        smiles = dict(('[smile%s]' % i, 'smile%s.png' % i) for i in range(40))
+        smiles.update(markup_base.PYBB_SMILES)
+        body = ('Lorem ipsum dolor sit amet :) consectetur [smile7] adipiscing elit o_O. ' * 2000)
+        with mock.patch.object(markup_base, 'PYBB_SMILES', smiles):
+            markup_base._SMILES_REPLACERS.clear()
+            self.assertEqual(markup_base.smile_it(body), legacy_smile_it(body))
+            single_pass = min(timeit.repeat(lambda: markup_base.smile_it(body), number=20, repeat=3))
+            legacy = min(timeit.repeat(lambda: legacy_smile_it(body), number=20, repeat=3))
+        markup_base._SMILES_REPLACERS.clear()
+        self.assertLess(single_pass, legacy)
+
+
 class ControlsAndPermissionsTest(TestCase, SharedTestModule):
 
     def create_initial(self, on_moderation=False, closed=False, sticky=False, hidden=False):
@@ -3468,6 +5087,43 @@ class NiceUrlsTest(TestCase, SharedTestModule):
 
         defaults.PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT = original_duplicate_limit
 
+    def test_slug_checked_on_create_or_change_only(self):
+        topic = Topic.objects.get(pk=self.topic.pk)
+        with mock.patch('pybb.signals.create_or_check_slug') as check_slug:
+            topic.views = 10
+            topic.save()
+            topic.name = 'renamed'
+            topic.save(update_fields=['name'])
+        self.assertFalse(check_slug.called)
+        other = Topic.objects.create(name='other', forum=self.forum, user=self.user)
+        other = Topic.objects.get(pk=other.pk)
+        other.slug = self.topic.slug
+        other.save()
+        self.assertEqual(other.slug, '%s-1' % self.topic.slug)
+        other.forum = Forum.objects.create(name='other forum', category=self.category)
+        other.save()
+        self.assertEqual(other.slug, '%s-1' % self.topic.slug)
+        other.slug = self.topic.slug
+        other.save()
+        self.assertEqual(other.slug, self.topic.slug)
+
+    def test_slug_queries_do_not_grow_with_duplicates(self):
+        for i in range(12):
+            Topic.objects.create(name='dolly', forum=self.forum, user=self.user)
+        Topic.objects.filter(slug='dolly-5').delete()
+        with CaptureQueriesContext(connection) as ctx:
+            slug = create_or_check_slug(Topic(name='dolly'), Topic, forum=self.forum)
+        self.assertEqual(slug, 'dolly-12')
+        self.assertEqual(len(ctx.captured_queries), 3)
+
+    def test_free_suffix_below_highest_one(self):
+        Topic.objects.create(name='dolly', forum=self.forum, user=self.user)
+        Topic.objects.create(name='dolly', forum=self.forum, user=self.user, slug='dolly-19')
+        Topic.objects.create(name='dolly', forum=self.forum, user=self.user, slug='dolly-1')
+        with mock.patch.object(defaults, 'PYBB_NICE_URL_SLUG_DUPLICATE_LIMIT', 20):
+            topic = Topic.objects.create(name='dolly', forum=self.forum, user=self.user)
+        self.assertEqual(topic.slug, 'dolly-2')
+
     def test_long_duplicate_slug(self):
         long_name = 'abcde' * 51  # 255 symbols
         topic1 = Topic.objects.create(name=long_name, forum=self.forum, user=self.user)
@@ -3497,6 +5153,45 @@ class NiceUrlsTest(TestCase, SharedTestModule):
             self.topic.get_absolute_url()
             )
 
+    def test_absolute_url_without_queries(self):
+        self.addCleanup(forum_tree.invalidate_forum_tree)
+        forum_tree.get_forum_tree()
+        topic = Topic.objects.get(pk=self.topic.pk)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(topic.get_absolute_url(),
+                             '/c/%s/%s/%s/' % (self.category.slug, self.forum.slug, self.topic.slug))
+            self.assertEqual(forum.get_absolute_url(), '/c/%s/%s/' % (self.category.slug, self.forum.slug))
+        self.category.slug = 'renamed'
+        self.category.save()
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).get_absolute_url(),
+                         '/c/renamed/%s/%s/' % (self.forum.slug, self.topic.slug))
+
+    def test_listing_queries_do_not_grow_with_topics(self):
+        self.addCleanup(cache.clear)
+        self.addCleanup(forum_tree.drop_forum_tree)
+        # the forum tree loaded in the warm up must not be checked again during the measured request
+        patcher = mock.patch.object(forum_tree, 'LOCAL_CHECK_INTERVAL', 3600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def queries(url):
+            forum_tree.drop_forum_tree()
+            cache.clear()
+            self.client.get(url)  # warm up caches
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(ctx.captured_queries)
+
+        urls = (self.forum.get_absolute_url(), reverse('pybb:topic_latest'),
+                reverse('pybb:feed_topics'), reverse('pybb:feed_posts'))
+        few_queries = [queries(url) for url in urls]
+        for i in range(5):
+            topic = Topic.objects.create(name='topic %s' % i, forum=self.forum, user=self.user)
+            self.create_post(topic=topic, user=self.user, body='post %s' % i)
+        self.assertEqual(few_queries, [queries(url) for url in urls])
+
     def test_add_topic(self):
         add_topic_url = reverse('pybb:add_topic', kwargs={'forum_id': self.forum.pk})
         response = self.client.get(add_topic_url)
@@ -3955,7 +5650,7 @@ class TestTemplateTags(TestCase, SharedTestModule):
     def test_pybbm_calc_topic_views(self):
         self.create_user()
         self.create_initial()
-        cache.delete(util.build_cache_key('anonymous_topic_views', topic_id=self.topic.id))
+        cache.clear()
         context = Context({'topic': self.topic})
         template = Template(('{% load pybb_tags %}{{ topic|pybbm_calc_topic_views }}'))
         self.assertEqual(template.render(context), '0')
@@ -0,0 +1,195 @@
+"""
+Write-behind counter of topic views
+
+Views are counted in the cache, in buckets of `PYBB_TOPIC_VIEWS_FLUSH_INTERVAL` seconds. Once a bucket
+is closed, no request writes to it anymore, so it is drained without losing concurrent views: its
+counts are added to `Topic.views` with one UPDATE statement per chunk of topics, then its keys are
+deleted. Closed buckets are drained by the `pybb_flush_views` management command, and by the first
+request of each interval when `PYBB_TOPIC_VIEWS_FLUSH_ON_REQUEST` is set.
+"""
+
+import logging
+import time
+
+from django.core.cache import cache
+from django.db.models import Case, F, IntegerField, Value, When
+
+from pybb import defaults, util
+from pybb.models import Topic
+
+logger = logging.getLogger(__name__)
+
+# buckets are kept (and read for live totals) during this number of intervals at most
+BUCKETS_KEPT = 1440
+# a bucket is drained when it was closed for one interval, so slow requests are done with it
+GRACE_BUCKETS = 1
+
+FLUSHED_BUCKET_KEY = 'pybbm_topic_views_flushed_bucket'
+ACTIVE_BUCKETS_KEY = 'pybbm_topic_views_active_buckets'
+FLUSH_LOCK_KEY = 'pybbm_topic_views_flush_lock'
+BUFFERED_STAT_KEY = 'pybbm_topic_views_buffered'
+PERSISTED_STAT_KEY = 'pybbm_topic_views_persisted'
+
+
+def current_bucket():
+    return int(time.time() // defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL)
+
+
+def get_timeout():
+    return defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL * BUCKETS_KEPT
+
+
+def incr(key, delta=1):
+    """ atomically increments `key`, created if missing """
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, get_timeout())
+        return cache.incr(key, delta)
+
+
+def add_view(topic):
+    """ counts a view of `topic` """
+    buffer_size = defaults.PYBB_TOPIC_VIEWS_CACHE_BUFFER
+    if not buffer_size:
+        Topic.objects.filter(id=topic.id).update(views=F('views') + 1)
+        return
+    bucket = current_bucket()
+    cache_key = util.build_cache_key('topic_views', topic_id=topic.id, bucket=bucket)
+    if cache.add(cache_key, 0, get_timeout()):
+        # first view of the topic in this bucket: register the topic for the flush
+        cache.add(FLUSHED_BUCKET_KEY, bucket - 1, None)
+        index = incr(util.build_cache_key('topic_views_pending_count', bucket=bucket))
+        cache.set(util.build_cache_key('topic_views_pending', bucket=bucket, index=index), topic.id, get_timeout())
+        if index == 1:
+            add_active_bucket(bucket)
+    incr(BUFFERED_STAT_KEY)
+    if incr(cache_key) == buffer_size:
+        # only one request gets this exact value, and views counted meanwhile are kept by decr
+        update_views({topic.id: buffer_size})
+        cache.decr(cache_key, buffer_size)
+    if defaults.PYBB_TOPIC_VIEWS_FLUSH_ON_REQUEST and \
+            cache.add(util.build_cache_key('topic_views_flush_check', bucket=bucket), 1, get_timeout()):
+        flush_views()
+
+
+def get_first_unflushed_bucket(bucket, flushed):
+    return bucket - BUCKETS_KEPT if flushed is None else max(flushed + 1, bucket - BUCKETS_KEPT)
+
+
+def get_unflushed_buckets():
+    bucket = current_bucket()
+    return range(get_first_unflushed_bucket(bucket, cache.get(FLUSHED_BUCKET_KEY)), bucket + 1)
+
+
+def add_active_bucket(bucket):
+    """
+    adds `bucket` to the list of buckets where views were counted, dropping the flushed ones. Only the first
+    topic registered in a bucket calls it, so concurrent writes are unlikely: a lost bucket is only missing
+    from live totals until it is flushed.
+    """
+    cached = cache.get_many([ACTIVE_BUCKETS_KEY, FLUSHED_BUCKET_KEY])
+    first = get_first_unflushed_bucket(bucket, cached.get(FLUSHED_BUCKET_KEY))
+    buckets = set(active for active in cached.get(ACTIVE_BUCKETS_KEY, []) if active >= first)
+    buckets.add(bucket)
+    cache.set(ACTIVE_BUCKETS_KEY, sorted(buckets), get_timeout())
+
+
+def get_active_buckets():
+    """ returns the unflushed buckets where views were counted, read from one key whatever the flush delay """
+    bucket = current_bucket()
+    cached = cache.get_many([ACTIVE_BUCKETS_KEY, FLUSHED_BUCKET_KEY])
+    first = get_first_unflushed_bucket(bucket, cached.get(FLUSHED_BUCKET_KEY))
+    return [active for active in cached.get(ACTIVE_BUCKETS_KEY, []) if first <= active <= bucket]
+
+
+def get_buffered_views(topic_ids):
+    """ returns the views of `topic_ids` not written yet, as a dict by topic id """
+    topic_ids = list(topic_ids)
+    if not topic_ids:
+        return {}
+    keys = dict((util.build_cache_key('topic_views', topic_id=topic_id, bucket=bucket), topic_id)
+                for bucket in get_active_buckets() for topic_id in topic_ids)
+    counts = {}
+    for key, count in cache.get_many(keys).items():
+        if count:
+            counts[keys[key]] = counts.get(keys[key], 0) + count
+    return counts
+
+
+def annotate_topics(topics):
+    """ sets the views not written yet of `topics` as their `buffered_views`, read at once for all of them """
+    topics = list(topics)
+    counts = get_buffered_views(set(topic.id for topic in topics))
+    for topic in topics:
+        topic.buffered_views = counts.get(topic.id, 0)
+    return topics
+
+
+def update_views(counts):
+    """ adds `counts`, a dict of views by topic id, to the topics with one UPDATE statement """
+    counts = dict((topic_id, count) for topic_id, count in counts.items() if count)
+    if not counts:
+        return 0
+    increment = Case(*[When(pk=topic_id, then=Value(count)) for topic_id, count in counts.items()],
+                     default=Value(0), output_field=IntegerField())
+    updated = Topic.objects.filter(pk__in=counts).update(views=F('views') + increment)
+    incr(PERSISTED_STAT_KEY, sum(counts.values()))
+    return updated
+
+
+def drain_bucket(bucket, size, chunk_size=1000):
+    """
+    writes the views counted in the closed `bucket`, where `size` topics were registered, and deletes
+    its keys. Returns the number of updated topics.
+    """
+    count_key = util.build_cache_key('topic_views_pending_count', bucket=bucket)
+    pending_keys = [util.build_cache_key('topic_views_pending', bucket=bucket, index=index)
+                    for index in range(1, size + 1)]
+    topic_ids = sorted(set(cache.get_many(pending_keys).values()))
+    updated = 0
+    for i in range(0, len(topic_ids), chunk_size):
+        keys = dict((util.build_cache_key('topic_views', topic_id=topic_id, bucket=bucket), topic_id)
+                    for topic_id in topic_ids[i:i + chunk_size])
+        counts = dict((keys[key], count) for key, count in cache.get_many(keys).items())
+        updated += update_views(counts)
+        cache.delete_many(list(keys))
+    cache.delete_many(pending_keys + [count_key])
+    return updated
+
+
+def flush_views(chunk_size=1000):
+    """
+    writes the views of the closed buckets to the database, returns the number of updated topics.
+    Concurrent flushes are skipped.
+    """
+    if not cache.add(FLUSH_LOCK_KEY, 1, defaults.PYBB_TOPIC_VIEWS_FLUSH_INTERVAL * 10):
+        return 0
+    try:
+        last_closed = current_bucket() - 1 - GRACE_BUCKETS
+        buckets = [bucket for bucket in get_unflushed_buckets() if bucket <= last_closed]
+        count_keys = dict((util.build_cache_key('topic_views_pending_count', bucket=bucket), bucket)
+                          for bucket in buckets)
+        sizes = dict((count_keys[key], size) for key, size in cache.get_many(count_keys).items())
+        updated = 0
+        for bucket in sorted(sizes):
+            updated += drain_bucket(bucket, sizes[bucket], chunk_size=chunk_size)
+            # live totals stop reading the drained bucket
+            cache.set(FLUSHED_BUCKET_KEY, bucket, None)
+        if buckets:
+            cache.set(FLUSHED_BUCKET_KEY, buckets[-1], None)
+        stats = get_stats()
+        logger.info('Topic views flushed: %d topics updated, %d views buffered, %d views persisted',
+                    updated, stats['buffered'], stats['persisted'])
+        return updated
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+
+
+def get_stats():
+    """ returns the numbers of views buffered and persisted since the counters were created """
+    stats = cache.get_many([BUFFERED_STAT_KEY, PERSISTED_STAT_KEY])
+    return {
+        'buffered': stats.get(BUFFERED_STAT_KEY, 0),
+        'persisted': stats.get(PERSISTED_STAT_KEY, 0),
+    }
@@ -11,6 +11,7 @@ from pybb.views import IndexView, CategoryView, ForumView, TopicView, \
     UserTopics, UserPosts, topic_cancel_poll_vote, block_user, unblock_user, \
     delete_subscription, add_subscription, post_ajax_preview, \
     mark_all_as_read, ForumSubscriptionView, UserEditPrivilegesView
+from pybb.search.views import SearchView
 
 app_name = 'pybbm'
 
@@ -56,6 +57,9 @@ urlpatterns += [
         name='topic_cancel_poll_vote'),
     re_path('^topic/latest/$', LatestTopicsView.as_view(), name='topic_latest'),
 
+    # Search
+    re_path('^search/$', SearchView.as_view(), name='search'),
+
     # Add topic/post
     re_path('^forum/(?P<forum_id>\d+)/topic/add/$', AddPostView.as_view(),
         name='add_topic'),
@@ -1,11 +1,13 @@
 
+import hashlib
 import os
 import warnings
 import uuid
 
 from importlib import import_module
+from django.conf import settings
 from django.utils.translation import gettext as _
-from pybb import compat
+from pybb import compat, defaults
 
 from pybb.compat import get_username_field, get_user_model
 from pybb.defaults import (
@@ -64,6 +66,19 @@ def get_markup_engine(name=None):
     return engine
 
 
+def get_render_version():
+    """
+    Returns a digest of the configuration used to render posts: markup engine, smilies and
+    `PYBB_RENDER_VERSION`. HTML rendered with another version is stale.
+    """
+    engine = PYBB_MARKUP_ENGINES.get(PYBB_MARKUP) if PYBB_MARKUP else None
+    if engine is not None and not isinstance(engine, str):
+        engine = '%s.%s' % (engine.__module__, getattr(engine, '__qualname__', type(engine).__name__))
+    config = (PYBB_MARKUP, engine, sorted(defaults.PYBB_SMILES.items()), defaults.PYBB_SMILES_PREFIX,
+              getattr(settings, 'STATIC_URL', ''), defaults.PYBB_RENDER_VERSION)
+    return hashlib.sha1(repr(config).encode('utf-8')).hexdigest()
+
+
 # TODO In the next major release, delete this function
 def _get_markup_formatter(name=None):
     """
@@ -151,9 +166,27 @@ def get_pybb_profile_model():
         return get_user_model()
 
 
+def get_pybb_profile_user_field():
+    """ returns the name of the profile model field linked to the user (`pk` when the user model is the profile) """
+    from pybb import defaults
+
+    if defaults.PYBB_PROFILE_RELATED_NAME:
+        return get_user_model()._meta.get_field(defaults.PYBB_PROFILE_RELATED_NAME).field.name
+    else:
+        return 'pk'
+
+
 def build_cache_key(key_name, **kwargs):
-    if key_name == 'anonymous_topic_views':
-        return 'pybbm_anonymous_topic_%s_views' % kwargs['topic_id']
+    if key_name == 'topic_views':
+        return 'pybbm_topic_%(topic_id)s_views_%(bucket)s' % kwargs
+    elif key_name == 'topic_views_pending_count':
+        return 'pybbm_topic_views_%(bucket)s_pending' % kwargs
+    elif key_name == 'topic_views_pending':
+        return 'pybbm_topic_views_%(bucket)s_pending_%(index)s' % kwargs
+    elif key_name == 'topic_views_flush_check':
+        return 'pybbm_topic_views_%(bucket)s_flush_check' % kwargs
+    elif key_name == 'pagination_count':
+        return 'pybbm_pagination_count_%(model)s_%(object_id)s_%(total)s_%(updated)s_%(handler)s_%(user_id)s' % kwargs
     else:
         raise ValueError('Wrong key_name parameter passed: %s' % key_name)
 
@@ -2,11 +2,11 @@
 import math
 
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import InvalidPage
 from django.urls import reverse
 from django.contrib import messages
-from django.db.models import F
+from django.db.models import Q
 from django.forms.utils import ErrorList
 from django.http import HttpResponseRedirect, HttpResponse, Http404, HttpResponseBadRequest,\
     HttpResponseForbidden
@@ -17,27 +17,69 @@ from django.views.decorators.http import require_POST
 from django.views.generic.edit import ModelFormMixin
 from django.views.decorators.csrf import csrf_protect
 from django.views import generic
-from pybb import compat, defaults, util
+from pybb import compat, defaults, index_cache, purge, topic_views, util
 from pybb.compat import get_atomic_func
 from pybb.forms import PostForm, MovePostForm, AdminPostForm, AttachmentFormSet, \
     PollAnswerFormSet, PollForm, ForumSubscriptionForm, ModeratorForm
-from pybb.models import Category, Forum, ForumSubscription, Topic, Post, TopicReadTracker, \
-    ForumReadTracker, PollAnswerUser
+from pybb.models import Category, Forum, ForumSubscription, Topic, Post, PollAnswerUser
+from pybb.middleware import store_profile_settings
+from pybb.pagination import CountedPaginator, KeysetPaginator, pure_pagination
 from pybb.permissions import perms
+from pybb.read_state import read_state
 from pybb.templatetags.pybb_tags import pybb_topic_poll_not_voted
 from django.views.generic import CreateView
 
 User = compat.get_user_model()
 username_field = compat.get_username_field()
-Paginator, pure_pagination = compat.get_paginator_class()
 
 
 class PaginatorMixin(object):
+    # views listing querysets ordered by a unique key may be paginated with cursors
+    # when `PYBB_KEYSET_PAGINATION` is set
+    keyset_pagination = False
+
+    def use_keyset_pagination(self):
+        if not (defaults.PYBB_KEYSET_PAGINATION and self.keyset_pagination):
+            return False
+        # legacy ?page=N links are still served by the offset paginator
+        return not self.request.GET.get(self.page_kwarg) or \
+            'after' in self.request.GET or 'before' in self.request.GET
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_keyset_pagination():
+            return super(PaginatorMixin, self).paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        except InvalidPage as e:
+            raise Http404(str(e))
+        return (paginator, page, page.object_list, page.has_other_pages())
+
     def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
-        kwargs = {}
+        kwargs = self.get_count_kwargs()
         if pure_pagination:
             kwargs['request'] = self.request
-        return Paginator(queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs)
+        return CountedPaginator(queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs)
+
+    def get_count_kwargs(self):
+        """ returns the `CountedPaginator` arguments telling how to get the number of listed objects """
+        return {}
+
+    def get_counter_count_kwargs(self, obj, counter, filtered):
+        """
+        uses the denormalized `counter` of `obj` as count when the permission handler did not filter
+        the listing, else caches the count while the counter and the update date do not change
+        """
+        total = getattr(obj, counter)
+        if not filtered:
+            return {'known_count': total}
+        user = self.request.user
+        cache_key = util.build_cache_key(
+            'pagination_count', model=obj._meta.model_name, object_id=obj.pk, total=total,
+            updated=obj.updated.timestamp() if obj.updated else '',
+            handler='%s.%s' % (perms.__class__.__module__, perms.__class__.__name__),
+            user_id=user.pk if user.is_authenticated else 'anonymous')
+        return {'cache_key': cache_key, 'cache_timeout': defaults.PYBB_PAGINATION_COUNT_CACHE_TIMEOUT}
 
 
 class RedirectToLoginMixin(object):
@@ -65,16 +107,8 @@ class IndexView(generic.ListView):
     template_name = 'pybb/index.html'
     context_object_name = 'categories'
 
-    def get_context_data(self, **kwargs):
-        ctx = super(IndexView, self).get_context_data(**kwargs)
-        categories = ctx['categories']
-        for category in categories:
-            category.forums_accessed = perms.filter_forums(self.request.user, category.forums.filter(parent=None))
-        ctx['categories'] = categories
-        return ctx
-
     def get_queryset(self):
-        return perms.filter_categories(self.request.user, Category.objects.all())
+        return index_cache.get_categories(self.request.user)
 
 
 class CategoryView(RedirectToLoginMixin, generic.DetailView):
@@ -98,7 +132,8 @@ class CategoryView(RedirectToLoginMixin, generic.DetailView):
 
     def get_context_data(self, **kwargs):
         ctx = super(CategoryView, self).get_context_data(**kwargs)
-        ctx['category'].forums_accessed = perms.filter_forums(self.request.user, ctx['category'].forums.filter(parent=None))
+        ctx['category'].forums_accessed = perms.filter_forums(
+            self.request.user, ctx['category'].forums.filter(parent=None).select_related('last_post__user'))
         ctx['categories'] = [ctx['category']]
         return ctx
 
@@ -113,6 +148,7 @@ class ForumView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
     context_object_name = 'topic_list'
     template_name = 'pybb/forum.html'
+    keyset_pagination = True
 
     def dispatch(self, request, *args, **kwargs):
         self.forum = self.get_forum(**kwargs)
@@ -134,16 +170,20 @@ class ForumView(RedirectToLoginMixin, PaginatorMixin, generic.ListView):
                 ctx['subscription'] = None
         else:
             ctx['subscription'] = None
-        ctx['forum'].forums_accessed = perms.filter_forums(self.request.user, self.forum.child_forums.all())
+        ctx['forum'].forums_accessed = perms.filter_forums(self.request.user, self.forum.child_forums.select_related('last_post__user'))
         return ctx
 
     def get_queryset(self):
         if not perms.may_view_forum(self.request.user, self.forum):
             raise PermissionDenied
 
-        qs = self.forum.topics.order_by('-sticky', '-updated', '-id').select_related()
-        qs = perms.filter_topics(self.request.user, qs)
-        return qs
+        qs = self.forum.topics.order_by('-sticky', '-updated', '-id').select_related(
+            'forum__category', 'user', 'last_post__user')
+        self.topics_filtered = not perms.is_topic_filter_noop(self.request.user, self.forum)
+        return perms.filter_topics(self.request.user, qs)
+
+    def get_count_kwargs(self):
+        return self.get_counter_count_kwargs(self.forum, 'topic_count', self.topics_filtered)
 
     def get_forum(self, **kwargs):
         if 'pk' in kwargs:
@@ -225,9 +265,10 @@ class LatestTopicsView(PaginatorMixin, generic.ListView):
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
     context_object_name = 'topic_list'
     template_name = 'pybb/latest_topics.html'
+    keyset_pagination = True
 
     def get_queryset(self):
-        qs = Topic.objects.all().select_related()
+        qs = Topic.objects.select_related('forum__category', 'user', 'last_post__user')
         qs = perms.filter_topics(self.request.user, qs)
         return qs.order_by('-updated', '-id')
 
@@ -260,6 +301,7 @@ class TopicView(RedirectToLoginMixin, PaginatorMixin, PybbFormsMixin, generic.Li
     paginate_by = defaults.PYBB_TOPIC_PAGE_SIZE
     template_object_name = 'post_list'
     template_name = 'pybb/topic.html'
+    keyset_pagination = True
 
     def get(self, request, *args, **kwargs):
         if defaults.PYBB_NICE_URL and 'pk' in kwargs:
@@ -277,17 +319,7 @@ class TopicView(RedirectToLoginMixin, PaginatorMixin, PybbFormsMixin, generic.Li
 
         if request.GET.get('first-unread'):
             if request.user.is_authenticated:
-                read_dates = []
-                try:
-                    read_dates.append(TopicReadTracker.objects.get(user=request.user, topic=self.topic).time_stamp)
-                except TopicReadTracker.DoesNotExist:
-                    pass
-                try:
-                    read_dates.append(ForumReadTracker.objects.get(user=request.user, forum=self.topic.forum).time_stamp)
-                except ForumReadTracker.DoesNotExist:
-                    pass
-
-                read_date = read_dates and max(read_dates)
+                read_date = read_state.get_topic_read_date(request.user, self.topic)
                 if read_date:
                     try:
                         first_unread_topic = self.topic.posts.filter(created__gt=read_date).order_by('created', 'id')[0]
@@ -302,22 +334,19 @@ class TopicView(RedirectToLoginMixin, PaginatorMixin, PybbFormsMixin, generic.Li
     def get_queryset(self):
         if not perms.may_view_topic(self.request.user, self.topic):
             raise PermissionDenied
-        if self.request.user.is_authenticated or not defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER:
-            Topic.objects.filter(id=self.topic.id).update(views=F('views') + 1)
-        else:
-            cache_key = util.build_cache_key('anonymous_topic_views', topic_id=self.topic.id)
-            cache.add(cache_key, 0)
-            if cache.incr(cache_key) % defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER == 0:
-                Topic.objects.filter(id=self.topic.id).update(views=F('views') +
-                                                                defaults.PYBB_ANONYMOUS_VIEWS_CACHE_BUFFER)
-                cache.set(cache_key, 0)
-        qs = self.topic.posts.all().select_related('user')
+        topic_views.add_view(self.topic)
+        qs = self.topic.posts.order_by('created', 'id').select_related('user')
         if defaults.PYBB_PROFILE_RELATED_NAME:
             qs = qs.select_related('user__%s' % defaults.PYBB_PROFILE_RELATED_NAME)
+        self.posts_filtered = False
         if not perms.may_moderate_topic(self.request.user, self.topic):
+            self.posts_filtered = not perms.is_post_filter_noop(self.request.user, self.topic)
             qs = perms.filter_posts(self.request.user, qs)
         return qs
 
+    def get_count_kwargs(self):
+        return self.get_counter_count_kwargs(self.topic, 'post_count', self.posts_filtered)
+
     def get_context_data(self, **kwargs):
         ctx = super(TopicView, self).get_context_data(**kwargs)
     
@@ -366,36 +395,10 @@ class TopicView(RedirectToLoginMixin, PaginatorMixin, PybbFormsMixin, generic.Li
     
         return ctx
 
-    @method_decorator(get_atomic_func())
     def mark_read(self):
         if not self.request.user.is_authenticated:
             return
-        try:
-            forum_mark = ForumReadTracker.objects.get(forum=self.topic.forum, user=self.request.user)
-        except ForumReadTracker.DoesNotExist:
-            forum_mark = None
-        if (forum_mark is None) or (forum_mark.time_stamp <= self.topic.updated):
-            topic_mark, topic_mark_new = TopicReadTracker.objects.get_or_create_tracker(topic=self.topic, user=self.request.user)
-            if not topic_mark_new:
-                # Bail early if we already read this thread.
-                if topic_mark.time_stamp >= self.topic.updated:
-                    return
-                topic_mark.save()  # update read time
-
-            # Check, if there are any unread topics in forum
-            readed_trackers = TopicReadTracker.objects.filter(
-                user=self.request.user, topic__forum=self.topic.forum, time_stamp__gte=F('topic__updated'))
-            unread = self.topic.forum.topics.exclude(topicreadtracker__in=readed_trackers)
-            if forum_mark is not None:
-                unread = unread.filter(updated__gte=forum_mark.time_stamp)
-
-            if not unread.exists():
-                # Clear all topic marks for this forum, mark forum as read
-                TopicReadTracker.objects.filter(user=self.request.user, topic__forum=self.topic.forum).delete()
-                forum_mark, forum_mark_new = ForumReadTracker.objects.get_or_create_tracker(
-                    forum=self.topic.forum, user=self.request.user)
-                if not forum_mark_new:
-                    forum_mark.save()  # update read time
+        read_state.mark_topic_read(self.request.user, self.topic)
 
     def get_topic(self, **kwargs):
         if 'pk' in kwargs:
@@ -469,7 +472,7 @@ class PostEditMixin(PybbFormsMixin):
 
         if perms.may_create_poll(self.request.user):
             pollformset = self.get_poll_answer_formset_class()()
-            if getattr(self, 'forum', None) or topic.head == self.object:
+            if getattr(self, 'forum', None) or topic.head_id == self.object.pk:
                 if topic.poll_type != Topic.POLL_TYPE_NONE:
                     pollformset = self.get_poll_answer_formset_class()(
                         self.request.POST, instance=topic
@@ -494,12 +497,16 @@ class PostEditMixin(PybbFormsMixin):
                 errors += e.error_list
             else:
                 self.object.topic = topic
-                self.object.save()
-                if save_attachments:
+                if save_attachments and self.object.pk:
+                    # attachments are saved first, so the post is rendered once with their URLs
                     aformset.save()
-                    if self.object.attachments.count():
-                        # re-parse the body to replace attachment's references by URLs
-                        self.object.save()
+                    self.object.save()
+                else:
+                    self.object.save()
+                    if save_attachments:
+                        aformset.save()
+                        # replace attachment's references by URLs, without saving the post again
+                        self.object.save_rendering()
                 if save_poll_answers:
                     pollformset.save()
                 return HttpResponseRedirect(self.get_success_url())
@@ -567,9 +574,6 @@ class AddPostView(CreateView):
             self.object.save()
             if hasattr(self, 'forum'):
                 topic.save()
-            else:
-                self.topic.post_count = self.topic.posts.count()
-                self.topic.save()
             print(f"form_valid - Post sauvegardé: {self.object.id}")
             return redirect(self.object.topic.get_absolute_url())
         except Exception as e:
@@ -721,6 +725,16 @@ class PostView(RedirectToLoginMixin, generic.RedirectView):
     def get_redirect_url(self, **kwargs):
         if not perms.may_view_post(self.request.user, self.post):
             raise PermissionDenied
+        if defaults.PYBB_KEYSET_PAGINATION:
+            # the page starts after the previous post: one indexed lookup instead of a count
+            previous = self.post.topic.posts.filter(
+                Q(created__lt=self.post.created) | Q(created=self.post.created, id__lt=self.post.id)
+            ).order_by('-created', '-id').values('created', 'id').first()
+            if previous is None:
+                return '%s#post-%d' % (self.post.topic.get_absolute_url(), self.post.id)
+            paginator = KeysetPaginator(Post.objects.order_by('created', 'id'), defaults.PYBB_TOPIC_PAGE_SIZE)
+            return '%s?after=%s#post-%d' % (self.post.topic.get_absolute_url(), paginator.get_cursor(previous),
+                                            self.post.id)
         count = self.post.topic.posts.filter(created__lt=self.post.created).count() + 1
         page = math.ceil(count / float(defaults.PYBB_TOPIC_PAGE_SIZE))
         return '%s?page=%d#post-%d' % (self.post.topic.get_absolute_url(), page, self.post.id)
@@ -761,6 +775,12 @@ class ProfileEditView(generic.UpdateView):
     def dispatch(self, request, *args, **kwargs):
         return super(ProfileEditView, self).dispatch(request, *args, **kwargs)
 
+    def form_valid(self, form):
+        response = super(ProfileEditView, self).form_valid(form)
+        # the middleware takes the language and the time zone from the session
+        store_profile_settings(self.request, self.object)
+        return response
+
     def get_success_url(self):
         return reverse('pybb:edit_profile')
 
@@ -922,10 +942,7 @@ def post_ajax_preview(request):
 
 @login_required
 def mark_all_as_read(request):
-    for forum in perms.filter_forums(request.user, Forum.objects.all()):
-        forum_mark, new = ForumReadTracker.objects.get_or_create_tracker(forum=forum, user=request.user)
-        forum_mark.save()
-    TopicReadTracker.objects.filter(user=request.user).delete()
+    read_state.mark_forums_read(request.user, perms.filter_forums(request.user, Forum.objects.all()))
     msg = _('All forums marked as read')
     messages.success(request, msg, fail_silently=True)
     return redirect(reverse('pybb:index'))
@@ -937,26 +954,7 @@ def block_user(request, username):
     user = get_object_or_404(User, **{username_field: username})
     if not perms.may_block_user(request.user, user):
         raise PermissionDenied
-    user.is_active = False
-    user.save()
-    if 'block_and_delete_messages' in request.POST:
-        # individually delete each post and empty topic to fire method
-        # with forum/topic counters recalculation
-        posts = Post.objects.filter(user=user)
-        topics = posts.values('topic_id').distinct()
-        forums = posts.values('topic__forum_id').distinct()
-        posts.delete()
-        Topic.objects.filter(user=user).delete()
-        for t in topics:
-            try:
-                Topic.objects.get(id=t['topic_id']).update_counters()
-            except Topic.DoesNotExist:
-                pass
-        for f in forums:
-            try:
-                Forum.objects.get(id=f['topic__forum_id']).update_counters()
-            except Forum.DoesNotExist:
-                pass
+    purge.block_user(user, delete_posts='block_and_delete_messages' in request.POST)
     msg = _('User successfuly blocked')
     messages.success(request, msg, fail_silently=True)
     return redirect('pybb:index')